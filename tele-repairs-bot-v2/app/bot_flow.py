@@ -1,11 +1,30 @@
-from typing import List
+import os
+import re
+import asyncio
+import logging
+import tempfile
+from contextlib import contextmanager
+from dataclasses import dataclass
+from typing import Callable, Dict, List, Tuple
 from datetime import datetime
 from telegram import Update, ReplyKeyboardMarkup, ReplyKeyboardRemove, InlineKeyboardMarkup, InlineKeyboardButton
 from telegram.ext import ContextTypes
 
 from .validators import normalize_date, normalize_amount
 from .state import StateStore
-from .sheets import SheetsClient
+from .journal import get_journal
+from .dedupe import get_save_index, fingerprint
+from .mirror import get_mirror
+from .reports import get_reports, render_report
+from .digest import get_digest
+from .sheets import KNOWN_FIELDS
+from .importer import IMPORT_ADMINS, IMPORT_MAX_BYTES, detect_kind, run_import
+from .quick import parse as parse_quick
+from .invoices import INVOICE_MAX_BYTES, INVOICE_SAVE_WAIT, download, extension, get_invoices, link, spawn
+from .metrics import STATE_SECONDS, SAVES, SAVES_IN_FLIGHT, track
+from .tracing import span
+
+log = logging.getLogger("app.bot_flow")
 
 BACK, CANCEL, DONE, SKIP = "Back", "Cancel", "Done", "Skip"
 
@@ -15,13 +34,52 @@ PAIDBY_CHOICES = ["Company","Driver","Warranty","Other"]
 PAID_CHOICES = ["Yes","No"]
 STATUS_CHOICES = ["Open","In Progress","On Hold","Closed"]
 UNIT_TYPE_CHOICES = ["Truck","Trailer"]
+QUICK_CHOICES = {"Type": TYPE_CHOICES, "Category": CATEGORY_CHOICES, "Paid By": PAIDBY_CHOICES,
+                 "Paid?": PAID_CHOICES, "Status": STATUS_CHOICES}
 
 def reply_kb(buttons: List[str]) -> ReplyKeyboardMarkup:
     rows = [buttons[i:i+3] for i in range(0, len(buttons), 3)]
     rows.append([BACK, CANCEL])
     return ReplyKeyboardMarkup(rows, resize_keyboard=True, one_time_keyboard=True)
 
+# клавиатуры собираются один раз при импорте; объекты PTB неизменяемые, их можно переиспользовать
+KB_NAV = ReplyKeyboardMarkup([[BACK, CANCEL]], resize_keyboard=True)
+KB_START = ReplyKeyboardMarkup([["Continue","Cancel"]], resize_keyboard=True)
+KB_DATE = ReplyKeyboardMarkup([["Today","Pick date"], [BACK, CANCEL]], resize_keyboard=True)
+KB_DETAILS = ReplyKeyboardMarkup([[DONE, BACK, CANCEL]], resize_keyboard=True)
+KB_REPORTED_BY = ReplyKeyboardMarkup([["Use my name"], [BACK, CANCEL]], resize_keyboard=True)
+KB_NOTES = ReplyKeyboardMarkup([[SKIP, BACK, CANCEL]], resize_keyboard=True)
+KB_TYPE = reply_kb(TYPE_CHOICES)
+KB_UNIT_TYPE = reply_kb(UNIT_TYPE_CHOICES)
+KB_CATEGORY = reply_kb(CATEGORY_CHOICES)
+KB_PAIDBY = reply_kb(PAIDBY_CHOICES)
+KB_PAID = reply_kb(PAID_CHOICES)
+KB_STATUS = reply_kb(STATUS_CHOICES)
+KB_CONFIRM = InlineKeyboardMarkup([[
+    InlineKeyboardButton("Save", callback_data="save"),
+    InlineKeyboardButton("Edit", callback_data="edit"),
+    InlineKeyboardButton("Cancel", callback_data="cancel_inline"),
+]])
+
+# кнопки под «Saved ✅»: правка уже сохранённой записи
+RECORD_ACTIONS = {"close": ("Close", {"Status": "Closed"}), "paid": ("Mark paid", {"Paid?": "Yes"})}
+
+def record_kb(rec_id: int) -> InlineKeyboardMarkup:
+    return InlineKeyboardMarkup([[InlineKeyboardButton(label, callback_data=f"{action}:{rec_id}")
+                                  for action, (label, _) in RECORD_ACTIONS.items()]])
+
+CONFIRM_FIELDS = ("Date","Type","Unit","Category","Repair","Details","Vendor","Total",
+                  "Paid By","Paid?","Reported By","Status","Notes")
+REQUIRED_FIELDS = ("Date","Type","Unit","Category","Repair","Vendor","Total","Paid By","Paid?","Reported By","Status")
+QUICK_USAGE = ("Quick entry — one message, e.g.\n"
+               "/quick 2025-03-02 TRK 2621 Tires \"replace steer\" Loves 412.50 Company No Open\n"
+               "or one field per line:\nDate: 2025-03-02\nUnit: TRL 55 (TRK 2621)\nRepair: brake chamber\nTotal: 180\n"
+               "Quote multi-word values; without quotes the last word before the total is the shop. "
+               "I'll ask only for what is missing.")
+
 def _hydrate_from_store(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # стор — источник правды: после рестарта или если прошлый шаг обработал другой воркер,
+    # context.user_data пустой или устарел
     ss = StateStore()
     saved = None
     try: saved = ss.get(update.effective_chat.id)
@@ -32,322 +90,547 @@ def _hydrate_from_store(update: Update, context: ContextTypes.DEFAULT_TYPE):
         state, form = saved.get("state"), saved.get("form")
     else:
         state = form = None
-    if form and not context.user_data.get("form"):
-        context.user_data["form"] = form
-    if state and not context.user_data.get("state"):
+    if form is not None:
+        context.user_data["form"] = dict(form)
+    if state:
         context.user_data["state"] = state
 
 def _unit_label(form: dict) -> str:
     return "truck" if (form or {}).get("UnitType") == "TRK" else "trailer" if (form or {}).get("UnitType") == "TRL" else "unit"
 
+# --- шаги анкеты ---
+# обработчик шага получает текст и форму, пишет поле и возвращает следующее состояние;
+# None — ввод не принят (шлём step.error), STAY — остаёмся на шаге (шлём step.stay)
+STAY = "STAY"
+
+@dataclass(frozen=True)
+class Step:
+    prompt: str | Callable[[dict], str]
+    kb: ReplyKeyboardMarkup
+    handle: Callable[[str, dict, Update], str | None]
+    error: str | Callable[[dict], str] = ""
+    field: str = ""        # поле в меню Edit; шаги с одним field правятся вместе
+    stay: str = ""
+    skip: Callable[[dict], bool] | None = None  # шаг не нужен для этой формы (Back его пропускает)
+
+def _pick(field: str, choices: List[str], nxt: str):
+    allowed = frozenset(choices)
+    def handle(text, form, update):
+        if text in allowed:
+            form[field] = text
+            return nxt
+    return handle
+
+def _free_text(field: str, nxt: str):
+    def handle(text, form, update):
+        form[field] = text
+        return nxt
+    return handle
+
+def _on_date(text, form, update):
+    if text == "Pick date":
+        return "DATE_TYPED"
+    iso = normalize_date("today" if text == "Today" else text)
+    if iso:
+        form["Date"] = iso
+        return "TYPE"
+
+def _on_date_typed(text, form, update):
+    iso = normalize_date(text)
+    if iso:
+        form["Date"] = iso
+        return "TYPE"
+
+def _on_unit_type(text, form, update):
+    t = text.strip().lower()
+    if t in ("truck","trailer"):
+        form["UnitType"] = "TRK" if t == "truck" else "TRL"
+        return "UNIT_NUMBER"
+
+def _on_unit_number(text, form, update):
+    num = text.replace("TRK","").replace("TRL","").strip()
+    if not num:
+        return None
+    if form.get("UnitType") == "TRK":
+        form["Unit"] = f"TRK {num}"
+        return "CATEGORY"
+    form["TrailerNum"] = num
+    return "TRAILER_TRUCK"
+
+def _on_trailer_truck(text, form, update):
+    trk = text.replace("TRK","").strip()
+    if trk:
+        form["Unit"] = f"TRL {form.get('TrailerNum','').strip()} ( TRK {trk} )"
+        form.pop("TrailerNum", None)
+        return "CATEGORY"
+
+def _on_repair(text, form, update):
+    form["Repair"] = text
+    if not form.get("_edit"):
+        form["Details"] = ""
+    return "DETAILS"
+
+def _on_details(text, form, update):
+    if text == DONE:
+        return "VENDOR"
+    prev = form.get("Details","").strip()
+    form["Details"] = (f"{prev}\n{text.strip()}".strip() if prev else text.strip())
+    return STAY
+
+def _on_total(text, form, update):
+    amt = normalize_amount(text)
+    if amt:
+        form["Total"] = amt
+        return "PAID_BY"
+
+def _on_reported_by(text, form, update):
+    form["Reported By"] = update.effective_user.full_name if text == "Use my name" else text
+    return "STATUS"
+
+def _on_notes(text, form, update):
+    form["Notes"] = "" if text == SKIP else text
+    return "CONFIRM"
+
+STEPS: Dict[str, Step] = {
+    "DATE": Step("Date of the repair?", KB_DATE, _on_date, "Enter date like 2025-01-31 or tap Today.", field="Date"),
+    "DATE_TYPED": Step("Type date as YYYY-MM-DD", KB_NAV, _on_date_typed, "Enter date like 2025-01-31.", field="Date"),
+    "TYPE": Step("Type?", KB_TYPE, _free_text("Type", "UNIT_TYPE"), "Choose a Type.", field="Type"),
+    "UNIT_TYPE": Step("Unit type?", KB_UNIT_TYPE, _on_unit_type, "Choose: Truck or Trailer.", field="Unit"),
+    "UNIT_NUMBER": Step(lambda f: f"Enter {_unit_label(f)} number.", KB_NAV, _on_unit_number,
+                        lambda f: f"Enter {_unit_label(f)} number.", field="Unit"),
+    "TRAILER_TRUCK": Step("Trailer linked to which truck number?", KB_NAV, _on_trailer_truck,
+                          "Trailer linked to which truck number? e.g. 2621.", field="Unit",
+                          skip=lambda f: f.get("UnitType") != "TRL"),
+    "CATEGORY": Step("Category?", KB_CATEGORY, _pick("Category", CATEGORY_CHOICES, "REPAIR"), "Choose a Category.", field="Category"),
+    "REPAIR": Step("Short title of the work?", KB_NAV, _on_repair, field="Repair"),
+    "DETAILS": Step("Details?", KB_DETAILS, _on_details, field="Details", stay="Add more details or press Done."),
+    "VENDOR": Step("Vendor?", KB_NAV, _free_text("Vendor", "TOTAL"), field="Vendor"),
+    "TOTAL": Step("Total amount?", KB_NAV, _on_total, "Enter a number like 300 or 300.00.", field="Total"),
+    "PAID_BY": Step("Who paid?", KB_PAIDBY, _pick("Paid By", PAIDBY_CHOICES, "PAID"), "Who paid?", field="Paid By"),
+    "PAID": Step("Is it paid?", KB_PAID, _pick("Paid?", PAID_CHOICES, "REPORTED_BY"), "Is it paid?", field="Paid?"),
+    "REPORTED_BY": Step("Reported by?", KB_REPORTED_BY, _on_reported_by, field="Reported By"),
+    "STATUS": Step("Status?", KB_STATUS, _pick("Status", STATUS_CHOICES, "NOTES"), "Choose a status.", field="Status"),
+    "NOTES": Step("Notes (optional).", KB_NOTES, _on_notes, field="Notes"),
+}
+
+# порядок для Back; DATE_TYPED возвращается к DATE
+ORDER = ("DATE","TYPE","UNIT_TYPE","UNIT_NUMBER","TRAILER_TRUCK","CATEGORY","REPAIR","DETAILS",
+         "VENDOR","TOTAL","PAID_BY","PAID","REPORTED_BY","STATUS","NOTES","CONFIRM")
+PREV: Dict[str, str] = {s: ORDER[max(0, i - 1)] for i, s in enumerate(ORDER)}
+PREV["DATE_TYPED"] = "DATE"
+
+# меню Edit: поле → первый шаг, который его спрашивает
+EDIT_FIELDS: Dict[str, str] = {}
+for _state, _step in STEPS.items():
+    EDIT_FIELDS.setdefault(_step.field, _state)
+KB_EDIT = reply_kb(list(EDIT_FIELDS))
+
+def _text_for(value, form: dict) -> str:
+    return value(form) if callable(value) else value
+
+async def _send(update: Update, text: str, kb=None):
+    """Ответ в чат апдейта: на сообщение или под сообщением с нажатой кнопкой."""
+    with span("tg.reply_text"):
+        await update.effective_message.reply_text(text, reply_markup=kb)
+
+async def ask(update: Update, context: ContextTypes.DEFAULT_TYPE, state: str):
+    context.user_data["state"] = state
+    form = context.user_data.setdefault("form", {})
+    if state == "CONFIRM":
+        return await show_confirm(update, context)
+    if state == "EDIT_PICK":
+        await _send(update, "Which field to edit?", KB_EDIT)
+    else:
+        step = STEPS[state]
+        await _send(update, _text_for(step.prompt, form), step.kb)
+    await persist_state(update, context, state)
+
+async def _advance(update: Update, context: ContextTypes.DEFAULT_TYPE, nxt: str):
+    form = context.user_data["form"]
+    editing = form.get("_edit")
+    # в режиме Edit идём дальше только в пределах редактируемого поля, потом сразу к Confirm
+    if editing and (nxt not in STEPS or STEPS[nxt].field != editing):
+        form.pop("_edit", None)
+        nxt = "CONFIRM"
+        # быстрый ввод: дальше следующее незаполненное поле, тем же механизмом, что и Edit
+        if form.get("_fill"):
+            nxt = form["_fill"].pop(0)
+            form["_edit"] = STEPS[nxt].field
+        else:
+            form.pop("_fill", None)
+    return await ask(update, context, nxt)
+
+async def _on_start(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
+    if text.lower() == "continue":
+        return await ask(update, context, "DATE")
+    return await cancel(update, context)
+
+async def _on_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
+    t = text.lower()
+    if t == "save": return await do_save(update, context)
+    if t == "edit": return await ask(update, context, "EDIT_PICK")
+    if t == "cancel": return await cancel(update, context)
+    await _send(update, "Use buttons: Save, Edit, or Cancel.")
+
+async def _on_edit_pick(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
+    state = EDIT_FIELDS.get(text)
+    if not state:
+        return await _send(update, "Pick a field to edit.", KB_EDIT)
+    form = context.user_data["form"]
+    form["_edit"] = text
+    if text == "Details":
+        form["Details"] = ""
+    return await ask(update, context, state)
+
+def _missing_steps(form: dict) -> List[str]:
+    steps = []
+    for field in REQUIRED_FIELDS:
+        if form.get(field):
+            continue
+        # номер прицепа уже есть — спрашиваем только тягач
+        steps.append("TRAILER_TRUCK" if field == "Unit" and form.get("TrailerNum") else EDIT_FIELDS[field])
+    return steps
+
+async def _start_quick(update: Update, context: ContextTypes.DEFAULT_TYPE, form: dict, errors: List[str]):
+    with track(STATE_SECONDS.labels("QUICK")):
+        form.setdefault("Date", normalize_date("today"))
+        form.setdefault("Type", "Other")
+        if update.effective_user:
+            form.setdefault("Reported By", update.effective_user.full_name)
+        todo = _missing_steps(form)
+        context.user_data["form"] = form
+        notes = ["Couldn't read: " + "; ".join(errors)] if errors else []
+        if todo:
+            notes.append("Still need: " + ", ".join(STEPS[s].field for s in todo))
+        if notes:
+            await _send(update, "\n".join(notes))
+        if not todo:
+            return await ask(update, context, "CONFIRM")
+        form["_fill"], nxt = todo[1:], todo[0]
+        form["_edit"] = STEPS[nxt].field
+        return await ask(update, context, nxt)
+
+async def _on_quick(update: Update, context: ContextTypes.DEFAULT_TYPE, text: str):
+    form, errors = parse_quick(text, QUICK_CHOICES)
+    if not form:
+        return await _send(update, QUICK_USAGE, KB_NAV)
+    return await _start_quick(update, context, form, errors)
+
+# состояния, где ввод — это команда, а не значение поля
+ACTIONS = {"START": _on_start, "CONFIRM": _on_confirm, "EDIT_PICK": _on_edit_pick, "QUICK": _on_quick}
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("Create a new repair record.", reply_markup=ReplyKeyboardMarkup([["Continue","Cancel"]], resize_keyboard=True))
+    await update.message.reply_text("Create a new repair record.", reply_markup=KB_START)
     context.user_data["state"] = "START"
     context.user_data["form"] = {}
+    await persist_state(update, context, "START")
 
 async def new(update: Update, context: ContextTypes.DEFAULT_TYPE):
     StateStore().clear(update.effective_chat.id)
+    get_invoices().discard(update.effective_chat.id)
     context.user_data.clear()
-    context.user_data["state"] = "DATE"
     context.user_data["form"] = {}
-    await ask_date(update, context)
+    await ask(update, context, "DATE")
+
+async def quick(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """/quick <запись> — вся анкета одним сообщением; без текста ждём запись следующим сообщением."""
+    StateStore().clear(update.effective_chat.id)
+    get_invoices().discard(update.effective_chat.id)
+    context.user_data.clear()
+    parts = update.message.text.split(maxsplit=1)
+    if len(parts) > 1:
+        return await _on_quick(update, context, parts[1])
+    context.user_data["form"] = {}
+    context.user_data["state"] = "QUICK"
+    await _send(update, QUICK_USAGE, KB_NAV)
+    await persist_state(update, context, "QUICK")
 
 async def cancel(update: Update, context: ContextTypes.DEFAULT_TYPE):
     StateStore().clear(update.effective_chat.id)
+    get_invoices().discard(update.effective_chat.id)
     context.user_data.clear()
-    await update.message.reply_text("Cancelled.", reply_markup=ReplyKeyboardRemove())
+    await update.effective_message.reply_text("Cancelled.", reply_markup=ReplyKeyboardRemove())
 
 async def handle_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    with span("hydrate"):
+        _hydrate_from_store(update, context)
     text = update.message.text.strip()
     if text == CANCEL: return await cancel(update, context)
     if text == BACK:   return await go_back(update, context)
 
-    state = context.user_data.get("state","DATE")
-    form = context.user_data.get("form", {})
-
-    if state == "START":
-        if text.lower() == "continue":
-            context.user_data["state"] = "DATE"
-            return await ask_date(update, context)
-        return await cancel(update, context)
-
-    if state == "DATE":
-        if text == "Today":
-            form["Date"] = normalize_date("today")
-            context.user_data["state"] = "TYPE"
-            return await ask_type(update, context)
-        if text == "Pick date":
-            await update.message.reply_text("Type date as YYYY-MM-DD", reply_markup=ReplyKeyboardMarkup([[BACK, CANCEL]], resize_keyboard=True))
-            context.user_data["state"] = "DATE_TYPED"
-            return
-        iso = normalize_date(text)
-        if iso:
-            form["Date"] = iso
-            context.user_data["state"] = "TYPE"
-            return await ask_type(update, context)
-        await update.message.reply_text("Enter date like 2025-01-31 or tap Today.", reply_markup=ReplyKeyboardMarkup([["Today","Pick date"], [BACK, CANCEL]], resize_keyboard=True))
-        return
-
-    if state == "DATE_TYPED":
-        iso = normalize_date(text)
-        if iso:
-            form["Date"] = iso
-            context.user_data["state"] = "TYPE"
-            return await ask_type(update, context)
-        await update.message.reply_text("Enter date like 2025-01-31.", reply_markup=ReplyKeyboardMarkup([[BACK, CANCEL]], resize_keyboard=True))
-        return
-
-    if state == "TYPE":
-        # принимаем любой текст как тип
-        if text:
-            form["Type"] = text
-            context.user_data["form"] = form
-            context.user_data["state"] = "UNIT_TYPE"
-            return await ask_unit_type(update, context)
-        await update.message.reply_text("Choose a Type.", reply_markup=reply_kb(TYPE_CHOICES))
-        return
-
-    if state == "UNIT_TYPE":
-        t = text.strip().lower()
-        if t in ["truck","trailer"]:
-            form["UnitType"] = "TRK" if t == "truck" else "TRL"
-            context.user_data["form"] = form
-            context.user_data["state"] = "UNIT_NUMBER"
-            return await ask_unit_number(update, context)
-        await update.message.reply_text("Choose: Truck or Trailer.", reply_markup=reply_kb(UNIT_TYPE_CHOICES))
-        return
+    state = context.user_data.get("state") or "DATE"
+    form = context.user_data.setdefault("form", {})
 
-    if state == "UNIT_NUMBER":
-        num = text.replace("TRK","").replace("TRL","").strip()
-        if not num:
-            await update.message.reply_text(f"Enter {_unit_label(form)} number.", reply_markup=ReplyKeyboardMarkup([[BACK, CANCEL]], resize_keyboard=True))
-            return
-        if form.get("UnitType") == "TRK":
-            form["Unit"] = f"TRK {num}"
-            context.user_data["state"] = "CATEGORY"
-            return await ask_category(update, context)
-        form["TrailerNum"] = num
-        context.user_data["state"] = "TRAILER_TRUCK"
-        return await ask_trailer_truck(update, context)
-
-    if state == "TRAILER_TRUCK":
-        trk = text.replace("TRK","").strip()
-        if not trk:
-            await update.message.reply_text("Trailer linked to which truck number? e.g. 2621.", reply_markup=ReplyKeyboardMarkup([[BACK, CANCEL]], resize_keyboard=True))
-            return
-        form["Unit"] = f"TRL {form.get('TrailerNum','').strip()} ( TRK {trk} )"
-        form.pop("TrailerNum", None)
-        context.user_data["state"] = "CATEGORY"
-        return await ask_category(update, context)
-
-    if state == "CATEGORY":
-        if text in CATEGORY_CHOICES:
-            form["Category"] = text
-            context.user_data["state"] = "REPAIR"
-            return await ask_repair(update, context)
-        await update.message.reply_text("Choose a Category.", reply_markup=reply_kb(CATEGORY_CHOICES))
-        return
+    action = ACTIONS.get(state)
+    if action:
+        return await action(update, context, text)
 
-    if state == "REPAIR":
-        form["Repair"] = text
-        context.user_data["state"] = "DETAILS"
-        form["Details"] = ""
-        return await ask_details(update, context)
-
-    if state == "DETAILS":
-        if text == DONE:
-            context.user_data["state"] = "VENDOR"
-            return await ask_vendor(update, context)
-        prev = form.get("Details","").strip()
-        form["Details"] = (f"{prev}\n{text.strip()}".strip() if prev else text.strip())
-        await update.message.reply_text("Add more details or press Done.", reply_markup=ReplyKeyboardMarkup([[DONE, BACK, CANCEL]], resize_keyboard=True))
-        return
-
-    if state == "VENDOR":
-        form["Vendor"] = text
-        context.user_data["state"] = "TOTAL"
-        return await ask_total(update, context)
-
-    if state == "TOTAL":
-        amt = normalize_amount(text)
-        if not amt:
-            await update.message.reply_text("Enter a number like 300 or 300.00.", reply_markup=ReplyKeyboardMarkup([[BACK, CANCEL]], resize_keyboard=True))
-            return
-        form["Total"] = amt
-        context.user_data["state"] = "PAID_BY"
-        return await ask_paid_by(update, context)
-
-    if state == "PAID_BY":
-        if text in PAIDBY_CHOICES:
-            form["Paid By"] = text
-            context.user_data["state"] = "PAID"
-            return await ask_paid(update, context)
-        await update.message.reply_text("Who paid?", reply_markup=reply_kb(PAIDBY_CHOICES))
-        return
-
-    if state == "PAID":
-        if text in PAID_CHOICES:
-            form["Paid?"] = text
-            context.user_data["state"] = "REPORTED_BY"
-            return await ask_reported_by(update, context)
-        await update.message.reply_text("Is it paid?", reply_markup=reply_kb(PAID_CHOICES))
-        return
-
-    if state == "REPORTED_BY":
-        form["Reported By"] = update.effective_user.full_name if text == "Use my name" else text
-        context.user_data["state"] = "STATUS"
-        return await ask_status(update, context)
-
-    if state == "STATUS":
-        if text in STATUS_CHOICES:
-            form["Status"] = text
-            context.user_data["state"] = "NOTES"
-            return await ask_notes(update, context)
-        await update.message.reply_text("Choose a status.", reply_markup=reply_kb(STATUS_CHOICES))
-        return
-
-    if state == "NOTES":
-        form["Notes"] = "" if text == SKIP else text
-        context.user_data["state"] = "CONFIRM"
-        return await show_confirm(update, context)
-
-    if state == "CONFIRM":
-        if text.lower() == "save":  return await do_save(update, context)
-        if text.lower() == "edit":
-            context.user_data["state"] = "DATE"
-            await update.message.reply_text("Editing. Let's start again from Date.")
-            return await ask_date(update, context)
-        if text.lower() == "cancel": return await cancel(update, context)
-        await update.message.reply_text("Use buttons: Save, Edit, or Cancel.")
-        return
-
-# ask* helpers
-async def ask_date(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("Date of the repair?", reply_markup=ReplyKeyboardMarkup([["Today","Pick date"], [BACK, CANCEL]], resize_keyboard=True))
-    await persist_state(update, context, "DATE")
-
-async def ask_type(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("Type?", reply_markup=reply_kb(TYPE_CHOICES))
-    await persist_state(update, context, "TYPE")
-
-async def ask_unit_type(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("Unit type?", reply_markup=reply_kb(UNIT_TYPE_CHOICES))
-    await persist_state(update, context, "UNIT_TYPE")
-
-async def ask_unit_number(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text(f"Enter {_unit_label(context.user_data.get('form', {}))} number.", reply_markup=ReplyKeyboardMarkup([[BACK, CANCEL]], resize_keyboard=True))
-    await persist_state(update, context, "UNIT_NUMBER")
-
-async def ask_trailer_truck(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("Trailer linked to which truck number?", reply_markup=ReplyKeyboardMarkup([[BACK, CANCEL]], resize_keyboard=True))
-    await persist_state(update, context, "TRAILER_TRUCK")
-
-async def ask_category(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("Category?", reply_markup=reply_kb(CATEGORY_CHOICES))
-    await persist_state(update, context, "CATEGORY")
-
-async def ask_repair(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("Short title of the work?", reply_markup=ReplyKeyboardMarkup([[BACK, CANCEL]], resize_keyboard=True))
-    await persist_state(update, context, "REPAIR")
-
-async def ask_details(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("Details?", reply_markup=ReplyKeyboardMarkup([[DONE, BACK, CANCEL]], resize_keyboard=True))
-    await persist_state(update, context, "DETAILS")
-
-async def ask_vendor(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("Vendor?", reply_markup=ReplyKeyboardMarkup([[BACK, CANCEL]], resize_keyboard=True))
-    await persist_state(update, context, "VENDOR")
-
-async def ask_total(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("Total amount?", reply_markup=ReplyKeyboardMarkup([[BACK, CANCEL]], resize_keyboard=True))
-    await persist_state(update, context, "TOTAL")
-
-async def ask_paid_by(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("Who paid?", reply_markup=reply_kb(PAIDBY_CHOICES))
-    await persist_state(update, context, "PAID_BY")
-
-async def ask_paid(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("Is it paid?", reply_markup=reply_kb(PAID_CHOICES))
-    await persist_state(update, context, "PAID")
-
-async def ask_reported_by(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("Reported by?", reply_markup=ReplyKeyboardMarkup([["Use my name"], [BACK, CANCEL]], resize_keyboard=True))
-    await persist_state(update, context, "REPORTED_BY")
-
-async def ask_status(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("Status?", reply_markup=reply_kb(STATUS_CHOICES))
-    await persist_state(update, context, "STATUS")
-
-async def ask_notes(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    await update.message.reply_text("Notes (optional).", reply_markup=ReplyKeyboardMarkup([[SKIP, BACK, CANCEL]], resize_keyboard=True))
-    await persist_state(update, context, "NOTES")
+    step = STEPS.get(state) or STEPS["DATE"]
+    with track(STATE_SECONDS.labels(state if state in STEPS else "DATE")):
+        with span(f"step.{state}"):
+            nxt = step.handle(text, form, update)
+        if nxt is None:
+            return await _send(update, _text_for(step.error, form), step.kb)
+        if nxt == STAY:
+            await _send(update, step.stay, step.kb)
+            return await persist_state(update, context, state)
+        return await _advance(update, context, nxt)
 
 async def show_confirm(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    f = context.user_data.get("form", {})
+    f = context.user_data.setdefault("form", {})
     f.setdefault("Notes", "")
-    summary = (
-        "Confirm:\n"
-        f"Date: {f.get('Date','')}\n"
-        f"Type: {f.get('Type','')}\n"
-        f"Unit: {f.get('Unit','')}\n"
-        f"Category: {f.get('Category','')}\n"
-        f"Repair: {f.get('Repair','')}\n"
-        f"Details: {f.get('Details','')}\n"
-        f"Vendor: {f.get('Vendor','')}\n"
-        f"Total: {f.get('Total','')}\n"
-        f"Paid By: {f.get('Paid By','')}\n"
-        f"Paid?: {f.get('Paid?','')}\n"
-        f"Reported By: {f.get('Reported By','')}\n"
-        f"Status: {f.get('Status','')}\n"
-        f"Notes: {f.get('Notes','')}\n"
-    )
-    kb = InlineKeyboardMarkup([[
-        InlineKeyboardButton("Save", callback_data="save"),
-        InlineKeyboardButton("Edit", callback_data="edit"),
-        InlineKeyboardButton("Cancel", callback_data="cancel_inline"),
-    ]])
-    await update.message.reply_text(summary, reply_markup=kb)
+    summary = "Confirm:\n" + "".join(f"{k}: {f.get(k,'')}\n" for k in CONFIRM_FIELDS)
+    attached = len(get_invoices().pending(update.effective_chat.id))
+    if attached:
+        summary += f"Invoices: {attached} attached\n"
+    await _send(update, summary, KB_CONFIRM)
     await persist_state(update, context, "CONFIRM")
 
 async def go_back(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    order = ["DATE","TYPE","UNIT_TYPE","UNIT_NUMBER","TRAILER_TRUCK","CATEGORY","REPAIR","DETAILS","VENDOR","TOTAL","PAID_BY","PAID","REPORTED_BY","STATUS","NOTES","CONFIRM"]
+    form = context.user_data.setdefault("form", {})
     st = context.user_data.get("state","DATE")
-    idx = order.index(st) if st in order else 0
-    prev = order[max(0, idx-1)]
-    m = {
-        "DATE": ask_date, "TYPE": ask_type, "UNIT_TYPE": ask_unit_type, "UNIT_NUMBER": ask_unit_number,
-        "TRAILER_TRUCK": ask_trailer_truck, "CATEGORY": ask_category, "REPAIR": ask_repair, "DETAILS": ask_details,
-        "VENDOR": ask_vendor, "TOTAL": ask_total, "PAID_BY": ask_paid_by, "PAID": ask_paid,
-        "REPORTED_BY": ask_reported_by, "STATUS": ask_status, "NOTES": ask_notes, "CONFIRM": show_confirm,
-    }[prev]
-    context.user_data["state"] = prev
-    return await m(update, context)
+    # Back посреди Edit или из меню полей — обратно к Confirm, без пересборки анкеты
+    form.pop("_fill", None)
+    if form.pop("_edit", None) or st == "EDIT_PICK":
+        return await ask(update, context, "CONFIRM")
+    prev = PREV.get(st, "DATE")
+    while prev in STEPS and STEPS[prev].skip and STEPS[prev].skip(form):
+        prev = PREV[prev]
+    return await ask(update, context, prev)
+
+def _money(v) -> str:
+    return "" if v is None else f"{v:.2f}"
+
+async def history(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    unit = " ".join(context.args or []).strip()
+    if not unit:
+        return await _send(update, "Usage: /history TRK 2621")
+    rows = get_mirror().history(unit)
+    if not rows:
+        return await _send(update, f"No repairs found for {unit}.")
+    lines = [f"{r['date']} · {r['category']} · {r['repair']} · {r['vendor']} · {_money(r['total'])} · {r['status']}"
+             for r in rows]
+    await _send(update, f"Last repairs for {rows[0]['unit']}:\n" + "\n".join(lines))
+
+async def report(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    period = " ".join(context.args or []).strip() or None
+    try:
+        rep = await asyncio.to_thread(get_reports().get, period)
+    except ValueError as e:
+        return await _send(update, f"{e}. Usage: /report 2025-03")
+    await _send(update, render_report(rep))
+
+async def digest(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await _send(update, get_digest().text())
+
+async def subscribe(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    chat = update.effective_chat
+    added = get_digest().subscribers.add(chat.id, chat.title or chat.full_name or "")
+    await _send(update, "This chat will get the daily fleet digest. /unsubscribe to stop."
+                if added else "This chat is already subscribed.")
+
+async def unsubscribe(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    removed = get_digest().subscribers.remove(update.effective_chat.id)
+    await _send(update, "Unsubscribed from the daily digest." if removed else "This chat is not subscribed.")
+
+async def import_document(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    doc = update.message.document
+    if update.effective_user is None or update.effective_user.id not in IMPORT_ADMINS:
+        return await _send(update, "Bulk import is not enabled for you.")
+    try:
+        kind = detect_kind(doc.file_name, doc.mime_type)
+    except ValueError as e:
+        return await _send(update, str(e))
+    if doc.file_size and doc.file_size > IMPORT_MAX_BYTES:
+        return await _send(update, f"File is too large (max {IMPORT_MAX_BYTES // (1024 * 1024)} MB).")
+    status = await update.message.reply_text("Importing…")
+    loop = asyncio.get_running_loop()
+
+    def progress(rep):
+        # зовётся из потока импорта не чаще PROGRESS_EVERY
+        text = f"Importing… {rep.rows} rows read, {rep.imported} queued, {rep.error_count} errors"
+        asyncio.run_coroutine_threadsafe(status.edit_text(text), loop)
+
+    fd, path = tempfile.mkstemp(suffix="." + kind)
+    os.close(fd)
+    try:
+        await (await doc.get_file()).download_to_drive(path)
+        rep = await asyncio.to_thread(run_import, path, kind, progress)
+    except (ValueError, RuntimeError) as e:
+        return await status.edit_text(f"Import failed: {e}")
+    finally:
+        os.unlink(path)
+    await status.edit_text(rep.render())
+
+async def attach_invoice(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    """Фото или PDF счёта во время анкеты; ссылка попадёт в InvoiceLink при Save."""
+    _hydrate_from_store(update, context)
+    if not context.user_data.get("state"):
+        return await _send(update, "Send invoices while filling a record: start with /new or /quick.")
+    msg = update.message
+    if msg.photo:
+        f, ext = msg.photo[-1], ".jpg"  # самый крупный размер
+    else:
+        f, ext = msg.document, extension(msg.document.mime_type, msg.document.file_name)
+        if ext is None:
+            return await _send(update, "Invoices can be photos, images or PDF files.")
+    if f.file_size and f.file_size > INVOICE_MAX_BYTES:
+        return await _send(update, f"File is too large (max {INVOICE_MAX_BYTES // (1024 * 1024)} MB).")
+    store, chat_id = get_invoices(), update.effective_chat.id
+    name = store.known(f.file_unique_id)
+    if name:
+        # тот же файл уже скачан — повторно не качаем
+        store.add(chat_id, f.file_unique_id, name)
+        return await _send(update, "Invoice attached ✅")
+    # скачивание — отдельной задачей: шард диспетчера не ждёт большой файл, соседние чаты не стоят
+    store.track(chat_id, spawn(_store_invoice(update, f, ext)))
+
+# в file_path Bot API зашит токен бота: в лог сообщение об ошибке идёт без него
+_FILE_URL_TOKEN = re.compile(r"/bot[^/\s]+/")
+
+async def _store_invoice(update: Update, f, ext: str) -> str | None:
+    try:
+        tg_file = await f.get_file()
+        name = await download(tg_file.file_path, ext)
+    except Exception as e:
+        log.warning("invoice download failed: %s: %s", type(e).__name__, _FILE_URL_TOKEN.sub("/bot<token>/", str(e)))
+        await _send(update, "Couldn't store the invoice, please send it again.")
+        return None
+    if get_invoices().add(update.effective_chat.id, f.file_unique_id, name, asyncio.current_task()):
+        await _send(update, "Invoice attached ✅")
+    return name
+
+async def _attach_late(update: Update, rec_id: int, tasks: List[asyncio.Task]):
+    """Файлы, докачавшиеся после Save: их ссылки дописываются в InvoiceLink уже сохранённой записи."""
+    done, _ = await asyncio.wait(tasks, timeout=INVOICE_SAVE_WAIT)
+    links = [link(t.result()) for t in done if not t.cancelled() and t.exception() is None and t.result()]
+    if not links:
+        return
+    journal = get_journal()
+
+    def _edit():
+        rec = journal.current(rec_id) or {}
+        return journal.edit(rec_id, {"InvoiceLink": " ".join(filter(None, [rec.get("InvoiceLink", "")] + links))})[0]
+    if await asyncio.to_thread(_edit):
+        await _send(update, f"Invoice attached to #{rec_id} ✅")
+
+_REC_ID = re.compile(r"#(\d+)")
+
+def _record_id(update: Update, context: ContextTypes.DEFAULT_TYPE) -> int | None:
+    """id записи из аргумента (/close 17, /close #17) или из ответа на сообщение «Saved ✅ (#17)»."""
+    arg = " ".join(context.args or []).strip().lstrip("#")
+    if arg.isdigit():
+        return int(arg)
+    replied = update.message.reply_to_message if update.message else None
+    m = _REC_ID.search(getattr(replied, "text", None) or "")
+    return int(m.group(1)) if m else None
+
+async def _edit_record(update: Update, rec_id: int, action: str) -> str:
+    _, fields = RECORD_ACTIONS[action]
+    # править можно только записи своего чата; админы (IMPORT_ADMINS) — любые, в том числе импортированные
+    user = update.effective_user
+    owner = None if user is not None and user.id in IMPORT_ADMINS else update.effective_chat.id
+    where, _ = await asyncio.to_thread(get_journal().edit, rec_id, fields, owner)
+    if where is None:
+        return f"Record #{rec_id} not found."
+    # в журнале — уйдёт в лист вместе со строкой; иначе Flusher допишет правку пачкой
+    return f"#{rec_id}: " + ", ".join(f"{k} → {v}" for k, v in fields.items()) + " ✅"
+
+async def _record_command(update: Update, context: ContextTypes.DEFAULT_TYPE, action: str):
+    rec_id = _record_id(update, context)
+    if rec_id is None:
+        return await _send(update, f"Usage: /{action} 17 — or reply /{action} to a “Saved ✅ (#17)” message.")
+    await _send(update, await _edit_record(update, rec_id, action))
+
+async def close(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await _record_command(update, context, "close")
+
+async def paid(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    await _record_command(update, context, "paid")
+
+# апдейты пользователя в обработке, по (арендатор, user id)
+_user_busy: Dict[Tuple[str, int], int] = {}
+
+@contextmanager
+def user_data_scope(application, tenant: str, update: Update):
+    """Анкета хранится только в StateStore (см. _hydrate_from_store): после апдейта копию в user_data PTB
+    выбрасываем, иначе у каждого водителя, хоть раз открывшего /new, она висела бы в памяти до рестарта.
+    Диспетчер шардирует по чатам, и один водитель в двух чатах обрабатывается параллельно: выбрасываем,
+    только когда у него не осталось апдейтов в обработке, иначе сосед потеряет form посреди шага."""
+    user = update.effective_user
+    if user is None:
+        yield
+        return
+    key = (tenant, user.id)
+    _user_busy[key] = _user_busy.get(key, 0) + 1
+    try:
+        yield
+    finally:
+        left = _user_busy.pop(key) - 1
+        if left:
+            _user_busy[key] = left
+        else:
+            application.drop_user_data(user.id)
 
 async def persist_state(update: Update, context: ContextTypes.DEFAULT_TYPE, new_state: str):
-    StateStore().set(update.effective_chat.id, new_state, context.user_data.get("form", {}))
+    with span("persist_state"):
+        StateStore().set(update.effective_chat.id, new_state, context.user_data.get("form", {}))
 
 # callbacks + save
 async def handle_callback(update: Update, context: ContextTypes.DEFAULT_TYPE):
     _hydrate_from_store(update, context)
     q = update.callback_query
     data = (q.data or "").lower()
+    action, _, rec = data.partition(":")
+    if action in RECORD_ACTIONS and rec.isdigit():
+        text = await _edit_record(update, int(rec), action)
+        await q.answer(text)
+        try: await q.edit_message_text(f"{q.message.text}\n{text}", reply_markup=q.message.reply_markup)
+        except Exception: pass
+        return
     await q.answer()
     if data == "cancel_inline":
         StateStore().clear(update.effective_chat.id); context.user_data.clear()
+        get_invoices().discard(update.effective_chat.id)
         try: await q.edit_message_text("Cancelled.")
         except Exception: await q.message.reply_text("Cancelled.")
         return
     if data == "edit":
-        context.user_data["state"] = "DATE"
-        try: await q.edit_message_text("Editing. Let's start again from Date.")
-        except Exception: await q.message.reply_text("Editing. Let's start again from Date.")
-        await ask_date(update, context); return
+        try: await q.edit_message_text("Editing.")
+        except Exception: await q.message.reply_text("Editing.")
+        await ask(update, context, "EDIT_PICK"); return
     if data == "save":
         try: await q.edit_message_text("Saving…")
         except Exception: await q.message.reply_text("Saving…")
         await do_save(update, context)
 
+def _already_saved(rec_id: int | None) -> str:
+    return f"Already saved ✅ (#{rec_id})" if rec_id else "Already saved ✅"
+
 async def do_save(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    SAVES_IN_FLIGHT.inc()
+    try:
+        SAVES.labels(await _save(update, context)).inc()
+    except Exception:
+        SAVES.labels("error").inc()
+        raise
+    finally:
+        SAVES_IN_FLIGHT.dec()
+
+async def _save(update: Update, context: ContextTypes.DEFAULT_TYPE) -> str:
+    """Возвращает исход для метрик: saved / duplicate / missing / error."""
+    # ретрай апдейта от Telegram и повторное нажатие Save под тем же Confirm узнаём до любых проверок:
+    # анкета к этому моменту уже очищена
+    idx = get_save_index()
+    msg_key = f"{update.update_id}|{update.effective_chat.id}:{getattr(update.effective_message,'message_id','0')}"
+    keys = [msg_key]
+    if getattr(update, "callback_query", None):
+        keys.append(f"cb:{update.effective_chat.id}:{update.callback_query.message.message_id}")
+    seen, rec_id = await idx.find(keys)
+    if seen:
+        await _send(update, _already_saved(rec_id))
+        return "duplicate"
+
     _hydrate_from_store(update, context)
     f = context.user_data.get("form", {}) or {}
     if not f.get("Date"): f["Date"] = normalize_date("today")
@@ -355,31 +638,45 @@ async def do_save(update: Update, context: ContextTypes.DEFAULT_TYPE):
     context.user_data["form"] = f
     StateStore().set(update.effective_chat.id, context.user_data.get("state","CONFIRM"), f)
 
-    required = ["Date","Type","Unit","Category","Repair","Vendor","Total","Paid By","Paid?","Reported By","Status"]
-    miss = [k for k in required if not f.get(k)]
+    miss = [k for k in REQUIRED_FIELDS if not f.get(k)]
     if miss:
-        msg = "Missing fields: " + ", ".join(miss)
-        if getattr(update, "callback_query", None): await update.callback_query.message.reply_text(msg)
-        else: await update.message.reply_text(msg)
-        return
+        await _send(update, "Missing fields: " + ", ".join(miss))
+        return "missing"
+
+    keys.append(fingerprint(update.effective_chat.id, f))
+    seen, rec_id = await idx.find(keys[-1:])
+    if seen:
+        StateStore().clear(update.effective_chat.id); context.user_data.clear()
+        get_invoices().discard(update.effective_chat.id)
+        await _send(update, _already_saved(rec_id))
+        return "duplicate"
+    # недокачанные счета Save не ждёт: они допишутся в запись сами (см. _attach_late)
+    invoices, late = get_invoices().detach(update.effective_chat.id)
 
     row = [
         f.get("Date",""), f.get("Type",""), f.get("Unit",""), f.get("Category",""),
         f.get("Repair",""), f.get("Details",""), f.get("Vendor",""), f.get("Total",""),
         f.get("Paid By",""), f.get("Paid?",""), f.get("Reported By",""), f.get("Status",""),
-        f.get("Notes",""), "", f"{update.update_id}|{update.effective_chat.id}:{getattr(update.effective_message,'message_id','0')}",
+        f.get("Notes",""), " ".join(invoices), msg_key,
         datetime.utcnow().isoformat(timespec="seconds")+"Z",
     ]
 
+    # подтверждаем, как только строка легла в локальный журнал; в Sheets её допишет Flusher
+    idx.reserve(keys)
     try:
-        row_index = SheetsClient().append_repair_row(row)
+        with span("journal.append"):
+            rec_id = await asyncio.to_thread(get_journal().append, msg_key, row, keys, update.effective_chat.id)
     except Exception as e:
-        txt = f"Sheets error: {type(e).__name__}: {e}"
-        if getattr(update, "callback_query", None): await update.callback_query.message.reply_text(txt)
-        else: await update.message.reply_text(txt)
-        return
+        idx.release(keys)
+        get_invoices().reattach(update.effective_chat.id, late)
+        await _send(update, f"Save error: {type(e).__name__}: {e}")
+        return "error"
+    idx.remember(keys, rec_id)
+    get_digest().agg.add(dict(zip(KNOWN_FIELDS, row)))
 
     StateStore().clear(update.effective_chat.id); context.user_data.clear()
-    msg_ok = f"Saved ✅ (row {row_index})"
-    if getattr(update, "callback_query", None): await update.callback_query.message.reply_text(msg_ok)
-    else: await update.message.reply_text(msg_ok)
+    get_invoices().discard(update.effective_chat.id)
+    await _send(update, f"Saved ✅ (#{rec_id})", record_kb(rec_id))
+    if late:
+        spawn(_attach_late(update, rec_id, late))
+    return "saved"
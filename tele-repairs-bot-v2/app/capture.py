@@ -0,0 +1,148 @@
+import os
+import re
+import gzip
+import hmac
+import json
+import time
+import queue
+import shutil
+import hashlib
+import logging
+import threading
+from typing import List
+
+from .metrics import CAPTURE_DROPPED
+
+log = logging.getLogger("app.capture")
+
+# запись входящих апдейтов для bench.replay; пустой CAPTURE_DIR — выключено
+CAPTURE_DIR = os.getenv("CAPTURE_DIR", "").strip()
+# размер файла до ротации; закрытые файлы сжимаются в .gz
+CAPTURE_MAX_BYTES = int(os.getenv("CAPTURE_MAX_BYTES", str(16 * 1024 * 1024)))
+CAPTURE_KEEP = int(os.getenv("CAPTURE_KEEP", "10"))
+# ключ псевдонимов id; без него — случайный на процесс (тогда разные записи одного чата не склеиваются)
+CAPTURE_SALT = os.getenv("CAPTURE_SALT", "").encode() or os.urandom(16)
+CAPTURE_QUEUE = 10000
+
+# имена и контакты — из текста не выделить, поэтому заменяются целиком
+_PII_KEYS = {"first_name", "last_name", "username", "phone_number", "vcard", "email", "bio", "title"}
+_ID_KEYS = {"id", "user_id", "chat_id", "sender_chat_id"}
+_FILE_KEYS = {"file_id", "file_unique_id"}
+_DROP_KEYS = {"location", "venue", "contact", "photo_url", "invite_link"}
+_TEXT_KEYS = {"text", "caption", "data", "query"}
+_REDACT = [
+    (re.compile(r"\b\d{6,12}:[A-Za-z0-9_-]{30,}\b"), "<token>"),
+    (re.compile(r"[\w.+-]+@[\w-]+\.[\w.-]+"), "<email>"),
+]
+# телефон — от 10 цифр с разделителями; даты (8 цифр) и суммы сюда не попадают
+_PHONE = re.compile(r"\+?\d[\d ()-]{8,}\d")
+
+def _pseudo(v: int) -> int:
+    """Стабильный псевдоним id: один чат — один id во всей записи, знак (группа/личка) сохраняется."""
+    h = int.from_bytes(hmac.new(CAPTURE_SALT, str(abs(v)).encode(), hashlib.sha256).digest()[:5], "big")
+    return -h if v < 0 else h
+
+def _text(s: str) -> str:
+    for rx, repl in _REDACT:
+        s = rx.sub(repl, s)
+    return _PHONE.sub(lambda m: "<phone>" if sum(c.isdigit() for c in m.group()) >= 10 else m.group(), s)
+
+def redact(obj, key: str = ""):
+    """Копия апдейта без токенов и персональных данных; форма (длины, сущности, типы полей) сохраняется."""
+    if isinstance(obj, dict):
+        out = {}
+        for k, v in obj.items():
+            if k in _DROP_KEYS:
+                continue
+            if k in _PII_KEYS and isinstance(v, str):
+                out[k] = "x" * len(v)
+            else:
+                out[k] = redact(v, k)
+        return out
+    if isinstance(obj, list):
+        return [redact(v, key) for v in obj]
+    if key in _ID_KEYS and isinstance(obj, int) and not isinstance(obj, bool):
+        return _pseudo(obj)
+    if key in _FILE_KEYS and isinstance(obj, str):
+        return hashlib.sha256(CAPTURE_SALT + obj.encode()).hexdigest()[:32]
+    if key in _TEXT_KEYS and isinstance(obj, str):
+        return _text(obj)
+    return obj
+
+class Capture:
+    """Append-only NDJSON: {"t": unix-время приёма, "tenant": ..., "u": апдейт}. Пишет фоновый поток,
+    вебхук только кладёт строку в очередь; при отставании записи апдейты теряются, а не копятся."""
+
+    def __init__(self, directory: str, max_bytes: int = CAPTURE_MAX_BYTES, keep: int = CAPTURE_KEEP):
+        self.dir, self.max_bytes, self.keep = directory, max_bytes, keep
+        os.makedirs(directory, exist_ok=True)
+        self._q: queue.Queue = queue.Queue(CAPTURE_QUEUE)
+        self._f = None
+        self._size = 0
+        self._thread = threading.Thread(target=self._run, name="capture", daemon=True)
+        self._thread.start()
+
+    def record(self, payload: dict, tenant: str):
+        try:
+            self._q.put_nowait((time.time(), tenant, payload))
+        except queue.Full:
+            CAPTURE_DROPPED.inc()
+
+    def _open(self):
+        now = time.time()
+        path = os.path.join(self.dir, time.strftime("capture-%Y%m%d-%H%M%S", time.gmtime(now)) + f"{now % 1:.3f}"[1:] + ".ndjson")
+        self._f = open(path, "ab")
+        self._size = self._f.tell()
+
+    def _rotate(self):
+        path = self._f.name
+        self._f.close()
+        self._f = None
+        with open(path, "rb") as src, gzip.open(path + ".gz", "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        os.unlink(path)
+        for old in files(self.dir)[:-self.keep] if self.keep > 0 else ():
+            os.unlink(old)
+
+    def _run(self):
+        while True:
+            item = self._q.get()
+            if item is None:
+                break
+            try:
+                t, tenant, payload = item
+                if self._f is None:
+                    self._open()
+                line = (json.dumps({"t": round(t, 3), "tenant": tenant, "u": redact(payload)},
+                                   ensure_ascii=False, separators=(",", ":")) + "\n").encode()
+                self._f.write(line)
+                self._size += len(line)
+                if self._q.empty():
+                    self._f.flush()  # пачкой: одна запись на диск на разбор очереди
+                if self._size >= self.max_bytes:
+                    self._rotate()
+            except Exception:
+                log.exception("capture write failed")
+        if self._f is not None:
+            self._f.close()
+
+    def close(self):
+        self._q.put(None)
+        self._thread.join(timeout=5)
+
+def files(directory: str) -> List[str]:
+    """Файлы записи по порядку: сжатые закрытые и текущий."""
+    names = sorted(n for n in os.listdir(directory) if n.startswith("capture-") and n.endswith((".ndjson", ".ndjson.gz")))
+    return [os.path.join(directory, n) for n in names]
+
+_capture: Capture | None = None
+
+def get_capture() -> Capture | None:
+    global _capture
+    if _capture is None and CAPTURE_DIR:
+        _capture = Capture(CAPTURE_DIR)
+    return _capture
+
+def shutdown():
+    if _capture is not None:
+        _capture.close()
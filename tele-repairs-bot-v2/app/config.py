@@ -1,13 +1,59 @@
 import os
-from dataclasses import dataclass
+import re
+import json
+from dataclasses import dataclass, fields
+from typing import Dict
+
+DEFAULT_TENANT = "default"
 
 @dataclass
 class Settings:
     TELEGRAM_BOT_TOKEN: str
     WEBHOOK_SECRET_TOKEN: str
+    NAME: str = DEFAULT_TENANT
+    SPREADSHEET_ID: str = ""
+    WORKSHEET_GID: str = ""
+    WORKSHEET_TITLE: str = ""
+
+    def data_name(self, name: str) -> str:
+        """Файл в DATA_DIR: у арендатора по умолчанию — там же, где раньше, у остальных — в своём подкаталоге."""
+        return name if self.NAME == DEFAULT_TENANT else os.path.join(self.NAME, name)
 
 def load_settings() -> Settings:
     return Settings(
         TELEGRAM_BOT_TOKEN=os.environ["TELEGRAM_BOT_TOKEN"],
         WEBHOOK_SECRET_TOKEN=os.environ["WEBHOOK_SECRET_TOKEN"],
+        SPREADSHEET_ID=os.getenv("SPREADSHEET_ID", ""),
+        WORKSHEET_GID=os.getenv("WORKSHEET_GID", ""),
+        WORKSHEET_TITLE=os.getenv("WORKSHEET_TITLE", "").strip(),
     )
+
+_NAME = re.compile(r"[A-Za-z0-9_-]+")
+
+def load_tenants() -> Dict[str, Settings]:
+    """TENANTS — JSON-список (или путь к JSON-файлу) объектов с полями Settings, например
+    [{"name": "acme", "telegram_bot_token": "...", "webhook_secret_token": "...", "spreadsheet_id": "..."}].
+    Без TENANTS — один арендатор из переменных окружения, как раньше."""
+    raw = os.getenv("TENANTS", "").strip()
+    if not raw:
+        s = load_settings()
+        return {s.NAME: s}
+    if not raw.startswith("["):
+        with open(raw) as f:
+            raw = f.read()
+    known = {f.name for f in fields(Settings)}
+    out: Dict[str, Settings] = {}
+    for item in json.loads(raw):
+        item = {k.upper(): str(v) for k, v in item.items()}
+        unknown = set(item) - known
+        if unknown:
+            raise RuntimeError(f"TENANTS: unknown fields {sorted(unknown)}")
+        s = Settings(**item)
+        if not _NAME.fullmatch(s.NAME):
+            raise RuntimeError(f"TENANTS: bad tenant name {s.NAME!r}")
+        if s.NAME in out or any(t.WEBHOOK_SECRET_TOKEN == s.WEBHOOK_SECRET_TOKEN for t in out.values()):
+            raise RuntimeError(f"TENANTS: duplicate name or webhook secret for {s.NAME!r}")
+        out[s.NAME] = s
+    if not out:
+        raise RuntimeError("TENANTS is empty")
+    return out
@@ -0,0 +1,14 @@
+import os
+import sqlite3
+
+# локальные файлы (журнал, состояние, кеши) живут здесь; на Render — persistent disk
+DATA_DIR = os.getenv("DATA_DIR", "data")
+
+def connect(name: str, synchronous: str = "NORMAL") -> sqlite3.Connection:
+    """SQLite в WAL-режиме: читатели не блокируют писателя, файл можно делить между воркерами."""
+    path = os.path.join(DATA_DIR, name)
+    os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+    conn = sqlite3.connect(path, timeout=10, isolation_level=None, check_same_thread=False)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(f"PRAGMA synchronous={synchronous}")
+    return conn
@@ -0,0 +1,108 @@
+import os
+import time
+import asyncio
+import hashlib
+import logging
+from collections import OrderedDict
+from typing import Iterable, List, Tuple
+
+from .journal import Journal, get_journal
+from .ratelimit import BACKGROUND
+from .tenants import PerTenant
+from .sheets import SheetsClient, get_async_sheets
+
+log = logging.getLogger("app.dedupe")
+
+# одинаковая анкета из того же чата в пределах окна — это двойное нажатие Save, а не новая запись
+FINGERPRINT_WINDOW = float(os.getenv("DEDUPE_WINDOW", "600"))
+# в памяти — только ключи моложе окна и не больше этого числа; остальные ищутся в save_keys журнала
+DEDUPE_MEM_KEYS = int(os.getenv("DEDUPE_MEM_KEYS", "10000"))
+
+_FP_FIELDS = ("Date","Type","Unit","Category","Repair","Details","Vendor","Total",
+              "Paid By","Paid?","Reported By","Status","Notes")
+_PENDING = -1  # ключ занят сохранением, которое ещё не дошло до журнала
+
+def fingerprint(chat_id: int, form: dict) -> str:
+    h = hashlib.blake2b(digest_size=12)
+    h.update(str(chat_id).encode())
+    for k in _FP_FIELDS:
+        h.update(b"\x1f" + str(form.get(k, "")).encode())
+    return "fp:" + h.hexdigest()
+
+class SaveIndex:
+    """MsgKey/отпечаток анкеты → id записи в журнале. Память сверху (свежие ключи, в порядке записи),
+    save_keys журнала снизу: туда попадают все ключи, так что вытесненный из памяти не теряется."""
+
+    def __init__(self, journal: Journal):
+        self._journal = journal
+        self._mem: "OrderedDict[str, Tuple[int | None, float]]" = OrderedDict()
+
+    def _fresh(self, key: str, ts: float) -> bool:
+        return not key.startswith("fp:") or time.time() - ts < FINGERPRINT_WINDOW
+
+    def _hit(self, key: str, hit: Tuple[int | None, float] | None) -> Tuple[bool, int | None]:
+        if hit is None or not self._fresh(key, hit[1]):
+            return False, None
+        return True, (None if hit[0] == _PENDING else hit[0])
+
+    def _put(self, key: str, value: Tuple[int | None, float]):
+        self._mem[key] = value
+        self._mem.move_to_end(key)
+        horizon = value[1] - FINGERPRINT_WINDOW
+        while len(self._mem) > DEDUPE_MEM_KEYS or next(iter(self._mem.values()))[1] < horizon:
+            self._mem.popitem(last=False)
+
+    def lookup(self, key: str) -> Tuple[bool, int | None]:
+        """(найден, rec_id). rec_id None — ключ пришёл из листа или сохранение ещё идёт.
+        Блокирующий (промах читает журнал с диска) — для потоков вроде импорта; в цикле событий — find()."""
+        hit = self._mem.get(key)
+        # другой воркер мог записать ключ в общий журнал, или ключ уже вытеснен из памяти
+        return self._hit(key, hit if hit is not None else self._journal.find_key(key))
+
+    async def find(self, keys: List[str]) -> Tuple[bool, int | None]:
+        """Первый найденный из keys. Память — сразу, промахи — одним походом в журнал в потоке."""
+        misses = []
+        for k in keys:
+            hit = self._mem.get(k)
+            if hit is None:
+                misses.append(k)
+            elif self._fresh(k, hit[1]):
+                return self._hit(k, hit)
+        return await asyncio.to_thread(self._find_stored, misses) if misses else (False, None)
+
+    def _find_stored(self, keys: List[str]) -> Tuple[bool, int | None]:
+        for k in keys:
+            found = self._hit(k, self._journal.find_key(k))
+            if found[0]:
+                return found
+        return False, None
+
+    def reserve(self, keys: Iterable[str]):
+        now = time.time()
+        for k in keys:
+            self._put(k, (_PENDING, now))
+
+    def release(self, keys: Iterable[str]):
+        for k in keys:
+            self._mem.pop(k, None)
+
+    def remember(self, keys: Iterable[str], rec_id: int | None):
+        now = time.time()
+        for k in keys:
+            self._put(k, (rec_id, now))
+
+    async def seed_from_sheet(self):
+        """Один раз при старте подтягивает колонку MsgKey, чтобы ретраи старых апдейтов не задваивали строки."""
+        try:
+            keys = [k for k in await get_async_sheets().run(SheetsClient.column_values, "MsgKey", priority=BACKGROUND) if k]
+        except Exception as e:
+            log.warning("MsgKey seed skipped: %s", e)
+            return
+        # только в журнал: в памяти держим свежие ключи, а ретрай старого апдейта найдёт lookup в save_keys
+        await asyncio.to_thread(self._journal.add_keys, keys)
+        log.info("MsgKey index seeded with %d keys", len(keys))
+
+_indexes: PerTenant[SaveIndex] = PerTenant(lambda t: SaveIndex(get_journal()))
+
+def get_save_index() -> SaveIndex:
+    return _indexes.get()
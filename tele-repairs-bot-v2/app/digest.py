@@ -0,0 +1,353 @@
+import os
+import time
+import heapq
+import asyncio
+import logging
+import warnings
+import threading
+from collections import defaultdict
+from datetime import datetime, time as dtime, timedelta, timezone
+from typing import Awaitable, Callable, Dict, Iterable, List
+from zoneinfo import ZoneInfo
+
+from .db import connect
+from .journal import get_journal
+from .mirror import Mirror, get_mirror, iso_date, to_amount, unit_key
+from .ratelimit import BACKGROUND
+from .tenants import PerTenant, use
+
+log = logging.getLogger("app.digest")
+
+# ежедневная сводка подписанным чатам, HH:MM в DIGEST_TZ; пусто — не рассылать (/digest работает всегда)
+DIGEST_TIME = os.getenv("DIGEST_TIME", "08:00").strip()
+DIGEST_TZ = ZoneInfo(os.getenv("DIGEST_TZ", "UTC"))
+# как часто бегущие итоги пересчитываются по зеркалу листа (правки руками, удалённые строки)
+DIGEST_RECONCILE_INTERVAL = float(os.getenv("DIGEST_RECONCILE_INTERVAL", "3600"))
+DIGEST_TOP_UNITS = int(os.getenv("DIGEST_TOP_UNITS", "5"))
+# одновременных отправок; темп задаёт TelegramLimiter, фоновая рассылка уступает ответам водителям
+DIGEST_SEND_CONCURRENCY = 8
+CLOSED, PAID = "Closed", "Yes"
+_HOURS = 48  # часовые корзины «новых» за двое суток: окно 24 часа всегда целиком в памяти
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS subscribers (
+    chat_id INTEGER PRIMARY KEY,
+    title TEXT,
+    created_at REAL NOT NULL
+);
+"""
+
+def _hour(created_at) -> int | None:
+    t = str(created_at or "").strip().rstrip("Z")
+    try:
+        return int(datetime.fromisoformat(t).replace(tzinfo=timezone.utc).timestamp()) // 3600
+    except ValueError:
+        return None
+
+def _month(now: float) -> str:
+    return datetime.fromtimestamp(now, DIGEST_TZ).strftime("%Y-%m")
+
+class Aggregates:
+    """Бегущие итоги для сводки. Меняются на каждом сохранении и правке; сводка собирается из них
+    без чтения строк: статусы, неоплаченное по Paid By, траты по юнитам за месяц, новые по часам."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.status: Dict[str, int] = defaultdict(int)
+        self.unpaid: Dict[str, List[float]] = defaultdict(lambda: [0, 0.0])
+        self.units: Dict[str, Dict[str, float]] = defaultdict(lambda: defaultdict(float))
+        self.hours: Dict[int, List[float]] = defaultdict(lambda: [0, 0.0])
+        self.reconciled_at = 0.0
+        self._since: List[tuple] | None = None  # сохранения и правки, пришедшие во время пересчёта
+
+    def _apply(self, rec: Dict[str, object], sign: int):
+        total = to_amount(rec.get("Total")) or 0.0
+        self.status[str(rec.get("Status") or "").strip() or "—"] += sign
+        if str(rec.get("Paid?") or "").strip() != PAID:
+            u = self.unpaid[str(rec.get("Paid By") or "").strip() or "—"]
+            u[0] += sign
+            u[1] += sign * total
+        self.units[iso_date(rec.get("Date"))[:7]][unit_key(str(rec.get("Unit") or ""))] += sign * total
+        h = _hour(rec.get("CreatedAt"))
+        if h is not None and h > time.time() // 3600 - _HOURS:
+            b = self.hours[h]
+            b[0] += sign
+            b[1] += sign * total
+
+    def add(self, rec: Dict[str, object]):
+        with self._lock:
+            self._apply(rec, 1)
+            if self._since is not None:
+                self._since.append((str(rec.get("MsgKey") or ""), rec, None))
+
+    def on_edit(self, old: Dict[str, object], changed: Dict[str, str]):
+        """Слушатель Journal.edit: запись до правки и поменявшиеся поля."""
+        with self._lock:
+            self._apply(old, -1)
+            self._apply({**old, **changed}, 1)
+            if self._since is not None:
+                self._since.append((str(old.get("MsgKey") or ""), old, changed))
+
+    def snapshot(self, now: float | None = None) -> Dict[str, object]:
+        """Всё, что нужно сводке; размер не зависит от числа строк в листе."""
+        now = now or time.time()
+        h0 = int(now // 3600)
+        with self._lock:
+            for h in [h for h in self.hours if h <= h0 - _HOURS]:
+                del self.hours[h]
+            new = [b for h, b in self.hours.items() if h > h0 - 24]
+            month = _month(now)
+            for m in [m for m in self.units if m < month]:
+                del self.units[m]
+            units = self.units.get(month, {})
+            return {
+                "new_count": int(sum(b[0] for b in new)),
+                "new_total": round(sum(b[1] for b in new), 2),
+                "open": {s: n for s, n in self.status.items() if n > 0 and s != CLOSED},
+                "unpaid": {k: (int(n), round(t, 2)) for k, (n, t) in self.unpaid.items() if n > 0},
+                "top_units": heapq.nlargest(DIGEST_TOP_UNITS, ((round(t, 2), u) for u, t in units.items() if t > 0)),
+            }
+
+    # --- сверка с листом ---
+    def reconcile(self, mirror: Mirror):
+        """Пересчёт по зеркалу (группировками SQLite) плюс строки журнала, ещё не дошедшие до листа."""
+        def _start():
+            with self._lock:
+                self._since = []
+
+        # _since включается под замком журнала, как и вызываются слушатели правок (on_edit):
+        # правка попадает ровно в одно из двух — в прочитанный журнал или в _since
+        try:
+            pending, edits = get_journal().pending(_start)
+        except BaseException:
+            with self._lock:
+                self._since = None
+            raise
+        try:
+            fresh = Aggregates()
+            for st, n in mirror.query("SELECT status, COUNT(*) FROM repairs GROUP BY status"):
+                fresh.status[st.strip() or "—"] += n
+            for pb, n, t in mirror.query(
+                    "SELECT paid_by, COUNT(*), SUM(COALESCE(total, 0)) FROM repairs WHERE paid != ? GROUP BY paid_by",
+                    (PAID,)):
+                u = fresh.unpaid[pb.strip() or "—"]
+                u[0] += n
+                u[1] += t or 0.0
+            for month, unit, t in mirror.query(
+                    "SELECT substr(date, 1, 7), unit_key, SUM(COALESCE(total, 0)) FROM repairs WHERE date >= ? "
+                    "GROUP BY 1, 2", (_month(time.time()) + "-01",)):
+                fresh.units[month][unit] += t or 0.0
+            lo = datetime.fromtimestamp((time.time() // 3600 - _HOURS + 1) * 3600, timezone.utc)
+            for hour, n, t in mirror.query(
+                    "SELECT substr(created_at, 1, 13), COUNT(*), SUM(COALESCE(total, 0)) FROM repairs "
+                    "WHERE created_at >= ? GROUP BY 1", (lo.strftime("%Y-%m-%dT%H"),)):
+                h = _hour(hour + ":00")
+                if h is not None:
+                    fresh.hours[h] = [n, t or 0.0]
+            # правки, ещё не дошедшие до листа: в зеркале у этих строк старые значения
+            for key, rec in _mirror_records(mirror, list(edits)).items():
+                fresh._apply(rec, -1)
+                fresh._apply({**rec, **edits[key]}, 1)
+            # Flusher мог успеть записать строку между чтением журнала и зеркала: такие уже посчитаны
+            keys = {str(rec.get("MsgKey") or "") for rec in pending}
+            in_mirror = _present(mirror, list(keys))
+            for rec in pending:
+                if rec.get("MsgKey") not in in_mirror:
+                    fresh._apply(rec, 1)
+        except BaseException:
+            with self._lock:
+                self._since = None
+            raise
+        with self._lock:
+            for key, rec, changed in self._since:
+                if changed is None:
+                    if key not in keys and key not in _present(mirror, [key]):
+                        fresh._apply(rec, 1)
+                    continue
+                # правку, уже дошедшую через Flusher до зеркала, зеркало и посчитало
+                m = _mirror_records(mirror, [key]).get(key)
+                if m is not None and all(str(m.get(k) or "").strip() == v for k, v in changed.items()):
+                    continue
+                fresh._apply(rec, -1)
+                fresh._apply({**rec, **changed}, 1)
+            self.status, self.unpaid, self.units, self.hours = fresh.status, fresh.unpaid, fresh.units, fresh.hours
+            self._since = None
+            self.reconciled_at = time.time()
+
+def _present(mirror: Mirror, keys: List[str]) -> set:
+    out = set()
+    for i in range(0, len(keys), 500):
+        part = keys[i:i + 500]
+        out.update(k for (k,) in mirror.query(f"SELECT key FROM repairs WHERE key IN ({','.join('?' * len(part))})", tuple(part)))
+    return out
+
+def _mirror_records(mirror: Mirror, keys: List[str]) -> Dict[str, Dict[str, object]]:
+    out = {}
+    for i in range(0, len(keys), 500):
+        part = keys[i:i + 500]
+        for key, d, u, t, pb, p, st, c in mirror.query(
+                f"SELECT key, date, unit, total, paid_by, paid, status, created_at FROM repairs "
+                f"WHERE key IN ({','.join('?' * len(part))})", tuple(part)):
+            out[key] = {"Date": d, "Unit": u, "Total": t, "Paid By": pb, "Paid?": p, "Status": st, "CreatedAt": c}
+    return out
+
+class Subscribers:
+    """Чаты, куда уходит ежедневная сводка (/subscribe, /unsubscribe)."""
+
+    def __init__(self, name: str = "digest.sqlite3"):
+        self._db = connect(name)
+        self._db.executescript(_SCHEMA)
+        self._lock = threading.Lock()
+
+    def add(self, chat_id: int, title: str = "") -> bool:
+        with self._lock:
+            return self._db.execute("INSERT OR IGNORE INTO subscribers(chat_id, title, created_at) VALUES (?, ?, ?)",
+                                    (chat_id, title, time.time())).rowcount > 0
+
+    def remove(self, chat_id: int) -> bool:
+        with self._lock:
+            return self._db.execute("DELETE FROM subscribers WHERE chat_id=?", (chat_id,)).rowcount > 0
+
+    def move(self, old: int, new: int):
+        """Группа стала супергруппой — у неё новый id."""
+        with self._lock:
+            self._db.execute("UPDATE OR REPLACE subscribers SET chat_id=? WHERE chat_id=?", (new, old))
+
+    def chats(self, page: int = 500) -> Iterable[int]:
+        """Постранично: список подписчиков целиком в памяти не держим."""
+        last = None
+        while True:
+            with self._lock:
+                rows = self._db.execute("SELECT chat_id FROM subscribers WHERE ? IS NULL OR chat_id > ? "
+                                        "ORDER BY chat_id LIMIT ?", (last, last, page)).fetchall()
+            yield from (r[0] for r in rows)
+            if len(rows) < page:
+                return
+            last = rows[-1][0]
+
+def _money(v: float) -> str:
+    return f"{v:,.2f}"
+
+def render(snap: Dict[str, object], now: float | None = None) -> str:
+    day = datetime.fromtimestamp(now or time.time(), DIGEST_TZ).strftime("%Y-%m-%d")
+    opened = sorted(snap["open"].items(), key=lambda kv: -kv[1])
+    unpaid = sorted(snap["unpaid"].items(), key=lambda kv: -kv[1][1])
+    lines = [f"Fleet digest {day}",
+             f"New in 24h: {snap['new_count']} repairs, {_money(snap['new_total'])}",
+             "Open: " + (", ".join(f"{s} {n}" for s, n in opened) or "—"),
+             "Unpaid: " + (", ".join(f"{k} {_money(t)} ({n})" for k, (n, t) in unpaid) or "—"),
+             "Top units this month: " + (", ".join(f"{u} {_money(t)}" for t, u in snap["top_units"]) or "—")]
+    return "\n".join(lines)
+
+class Digest:
+    def __init__(self, mirror: Mirror, subscribers: Subscribers):
+        self.mirror = mirror
+        self.agg = Aggregates()
+        self.subscribers = subscribers
+
+    def text(self) -> str:
+        return render(self.agg.snapshot())
+
+    async def reconcile(self):
+        await asyncio.to_thread(self.agg.reconcile, self.mirror)
+
+    async def broadcast(self, bot) -> int:
+        """Одна отрисовка на всех подписчиков; отправка через лимитер с приоритетом BACKGROUND."""
+        from telegram.error import ChatMigrated, Forbidden
+        if self.mirror.synced_at > self.agg.reconciled_at:
+            await self.reconcile()  # зеркало подтянуло лист после прошлой сверки
+        text = self.text()
+        chats = iter(self.subscribers.chats())
+        sent = 0
+
+        async def worker():
+            nonlocal sent
+            for chat_id in chats:
+                for _ in range(2):
+                    try:
+                        await bot.send_message(chat_id, text, rate_limit_args=BACKGROUND)
+                        sent += 1
+                    except ChatMigrated as e:
+                        self.subscribers.move(chat_id, e.new_chat_id)
+                        chat_id = e.new_chat_id
+                        continue
+                    except Forbidden:
+                        self.subscribers.remove(chat_id)  # бота убрали из чата
+                    except Exception as e:
+                        log.warning("digest to %s failed: %s: %s", chat_id, type(e).__name__, e)
+                    break
+        await asyncio.gather(*(worker() for _ in range(DIGEST_SEND_CONCURRENCY)))
+        return sent
+
+_digests: PerTenant[Digest] = PerTenant(lambda t: Digest(get_mirror(), Subscribers(t.data_name("digest.sqlite3"))))
+
+def get_digest() -> Digest:
+    return _digests.get()
+
+# --- расписание ---
+def _digest_time() -> dtime | None:
+    if not DIGEST_TIME:
+        return None
+    h, m = DIGEST_TIME.split(":")
+    return dtime(int(h), int(m), tzinfo=DIGEST_TZ)
+
+async def _send(bot, tenant: str):
+    with use(tenant):
+        n = await get_digest().broadcast(bot)
+    log.info("digest for %s sent to %d chats", tenant, n)
+
+async def _reconcile(tenant: str):
+    with use(tenant):
+        await get_digest().reconcile()
+
+async def _digest_job(context):
+    await _send(context.bot, context.job.data)
+
+async def _reconcile_job(context):
+    await _reconcile(context.job.data)
+
+_tasks: List[asyncio.Task] = []
+
+async def _every(seconds: float, fn: Callable[[], Awaitable[None]]):
+    while True:
+        await asyncio.sleep(seconds)
+        try:
+            await fn()
+        except Exception:
+            log.exception("digest job failed")
+
+async def _daily(at: dtime, fn: Callable[[], Awaitable[None]]):
+    while True:
+        now = datetime.now(DIGEST_TZ)
+        nxt = datetime.combine(now.date(), at)
+        if nxt <= now:
+            nxt += timedelta(days=1)
+        await asyncio.sleep((nxt - now).total_seconds())
+        try:
+            await fn()
+        except Exception:
+            log.exception("digest job failed")
+
+def schedule(app, tenant: str):
+    """Сводка и сверка на JobQueue бота. Без APScheduler (extra python-telegram-bot[job-queue]) job_queue
+    у Application нет — тогда те же задачи крутятся простыми циклами asyncio."""
+    with warnings.catch_warnings():
+        warnings.simplefilter("ignore")  # PTB предупреждает об отсутствии JobQueue при обращении
+        jq = app.job_queue
+    at = _digest_time()
+    if jq is not None:
+        if at is not None:
+            jq.run_daily(_digest_job, at, data=tenant, name=f"digest:{tenant}")
+        jq.run_repeating(_reconcile_job, DIGEST_RECONCILE_INTERVAL, first=DIGEST_RECONCILE_INTERVAL,
+                         data=tenant, name=f"digest-reconcile:{tenant}")
+        return
+    log.info("no PTB JobQueue (install python-telegram-bot[job-queue]); digest jobs for %s run on asyncio", tenant)
+    _tasks.append(asyncio.create_task(_every(DIGEST_RECONCILE_INTERVAL, lambda: _reconcile(tenant))))
+    if at is not None:
+        _tasks.append(asyncio.create_task(_daily(at, lambda: _send(app.bot, tenant))))
+
+async def stop():
+    for t in _tasks:
+        t.cancel()
+    await asyncio.gather(*_tasks, return_exceptions=True)
+    _tasks.clear()
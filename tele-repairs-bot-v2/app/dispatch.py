@@ -0,0 +1,111 @@
+import os
+import asyncio
+import logging
+from typing import Awaitable, Callable, List
+
+log = logging.getLogger("app.dispatch")
+
+# queue — вебхук сразу отвечает 200, апдейт обрабатывает пул воркеров; inline — как раньше, прямо в запросе
+WEBHOOK_MODE = os.getenv("WEBHOOK_MODE", "queue")
+DISPATCH_WORKERS = int(os.getenv("DISPATCH_WORKERS", "8"))
+DISPATCH_QUEUE_SIZE = int(os.getenv("DISPATCH_QUEUE_SIZE", "200"))  # на одного воркера
+
+_STOP = object()
+
+def _get(obj, *path):
+    """obj[path[0]][path[1]]…, если по пути одни dict'ы; иначе None."""
+    for k in path:
+        if not isinstance(obj, dict):
+            return None
+        obj = obj.get(k)
+    return obj
+
+def _id(v) -> int | None:
+    if isinstance(v, bool):
+        return None
+    if isinstance(v, int):
+        return v
+    if isinstance(v, str) and v.lstrip("-").isdigit():
+        return int(v)
+    return None
+
+def chat_key(payload) -> int:
+    """chat_id прямо из сырого JSON, без Update.de_json: по нему апдейты шардируются по воркерам.
+    Тело не того вида (не dict, чужие типы внутри) — шард 0: разбирать и отвергать его будет PTB."""
+    if not isinstance(payload, dict):
+        return 0
+    for k in ("message", "edited_message", "channel_post", "edited_channel_post"):
+        if isinstance(payload.get(k), dict):
+            return _id(_get(payload, k, "chat", "id")) or 0
+    if isinstance(payload.get("callback_query"), dict):
+        chat = _id(_get(payload, "callback_query", "message", "chat", "id"))
+        return chat if chat is not None else _id(_get(payload, "callback_query", "from", "id")) or 0
+    for m in payload.values():
+        if isinstance(m, dict) and isinstance(m.get("from"), dict):
+            return _id(m["from"].get("id")) or 0
+    return 0
+
+class UpdateDispatcher:
+    """Шардированный пул: апдейты одного чата (одного бота) идут строго по очереди, разные чаты — параллельно."""
+
+    def __init__(self, process: Callable[[dict, str], Awaitable[None]], workers: int = DISPATCH_WORKERS,
+                 maxsize: int = DISPATCH_QUEUE_SIZE):
+        self._process = process
+        self._workers = workers
+        self._maxsize = maxsize
+        self._queues: List[asyncio.Queue] = []
+        self._tasks: List[asyncio.Task] = []
+        self._stopping = False  # stop() начался: новые апдейты не принимаются, у очередей скоро не будет воркеров
+
+    def start(self):
+        if self._tasks:
+            return
+        self._stopping = False
+        self._queues = [asyncio.Queue(self._maxsize) for _ in range(self._workers)]
+        self._tasks = [asyncio.create_task(self._worker(q), name=f"dispatch-{i}") for i, q in enumerate(self._queues)]
+
+    def submit(self, payload: dict, tenant: str = "") -> bool:
+        """False — очередь шарда полна или диспетчер останавливается; вебхук отвечает 503,
+        и Telegram повторит доставку позже (уже следующему процессу)."""
+        if self._stopping or not self._tasks:
+            return False
+        q = self._queues[hash((tenant, chat_key(payload))) % self._workers]
+        try:
+            q.put_nowait((payload, tenant))
+            return True
+        except asyncio.QueueFull:
+            return False
+
+    def depth(self) -> int:
+        return sum(q.qsize() for q in self._queues)
+
+    async def _worker(self, q: asyncio.Queue):
+        while True:
+            item = await q.get()
+            try:
+                if item is _STOP:
+                    return
+                await self._process(*item)
+            except Exception as e:
+                log.exception("update error: %s", e)
+            finally:
+                q.task_done()
+
+    async def stop(self, timeout: float = 20.0):
+        """Дорабатывает уже принятые апдейты (не дольше timeout), потом останавливает воркеры."""
+        self._stopping = True
+        if not self._tasks:
+            return
+        async def _enqueue_stops():
+            for q in self._queues:
+                await q.put(_STOP)
+        try:
+            await asyncio.wait_for(_enqueue_stops(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        done, pending = await asyncio.wait(self._tasks, timeout=timeout)
+        for t in pending:
+            t.cancel()
+        if pending:
+            log.warning("dispatcher stopped with %d updates undelivered", self.depth())
+        self._tasks = []
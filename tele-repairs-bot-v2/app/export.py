@@ -0,0 +1,118 @@
+import io
+import os
+import csv
+import json
+import hashlib
+from email.utils import formatdate, parsedate_to_datetime
+from typing import Iterator, List, Tuple
+
+from .mirror import COLUMNS, Mirror, unit_key
+from .validators import normalize_date
+
+# строк на один запрос к зеркалу; в памяти одновременно только одна страница
+EXPORT_PAGE = int(os.getenv("EXPORT_PAGE", "1000"))
+
+FORMATS = {"csv": "text/csv; charset=utf-8", "ndjson": "application/x-ndjson"}
+FIELDS = list(COLUMNS)
+_SELECT = ", ".join(COLUMNS.values())
+
+class ExportQuery:
+    """Фильтры /export: даты включительно (YYYY-MM-DD), юнит как в /history."""
+
+    def __init__(self, date_from: str | None = None, date_to: str | None = None, unit: str | None = None):
+        # без границы — без условия на дату: пустые и нестандартные даты из листа тоже выгружаются
+        self.lo = self._date(date_from, "from")
+        self.hi = self._date(date_to, "to")
+        if self.lo and self.hi and self.lo > self.hi:
+            raise ValueError("'from' is after 'to'")
+        self.units: List[str] = []
+        if unit:
+            key = unit_key(unit)
+            self.units = [key] if " " in key else [f"TRK {key}", f"TRL {key}"]
+
+    @staticmethod
+    def _date(v: str | None, name: str) -> str | None:
+        if not v:
+            return None
+        d = normalize_date(v)
+        if not d:
+            raise ValueError(f"'{name}' must be YYYY-MM-DD")
+        return d
+
+    def _where(self) -> Tuple[str, tuple]:
+        conds, args = [], ()
+        if self.lo or self.hi:
+            conds.append("date GLOB '[0-9][0-9][0-9][0-9]-[0-9][0-9]-[0-9][0-9]'")  # с границей — только ISO-даты
+        if self.lo:
+            conds.append("date >= ?")
+            args += (self.lo,)
+        if self.hi:
+            conds.append("date <= ?")
+            args += (self.hi,)
+        if self.units:
+            conds.append(f"unit_key IN ({','.join('?' * len(self.units))})")
+            args += tuple(self.units)
+        return " AND ".join(conds) or "1", args
+
+    def pages(self, mirror: Mirror, page: int = EXPORT_PAGE) -> Iterator[List[tuple]]:
+        """Keyset-пагинация по (date, key): каждая страница — отдельный короткий запрос, без OFFSET."""
+        where, args = self._where()
+        last: tuple = ("", "")
+        while True:
+            rows = mirror.query(
+                f"SELECT date, key, {_SELECT} FROM repairs WHERE {where} AND (date, key) > (?, ?) "
+                f"ORDER BY date, key LIMIT ?", args + last + (page,))
+            if not rows:
+                return
+            yield [r[2:] for r in rows]
+            if len(rows) < page:
+                return
+            last = rows[-1][:2]
+
+    def filename(self, fmt: str) -> str:
+        """repairs.csv, repairs-from-2025-01-01.csv, repairs-to-…, repairs-2025-01-01-2025-03-31.csv."""
+        if self.lo and self.hi:
+            span = f"-{self.lo}-{self.hi}"
+        else:
+            span = f"-from-{self.lo}" if self.lo else f"-to-{self.hi}" if self.hi else ""
+        return f"repairs{span}.{fmt}"
+
+    def tag(self, mirror: Mirror, fmt: str) -> str:
+        h = hashlib.blake2b(f"{mirror.changed_at()!r}|{fmt}|{self.lo}|{self.hi}|{self.units}".encode(), digest_size=12)
+        return f'"{h.hexdigest()}"'
+
+def _amount(v) -> str:
+    return "" if v is None else f"{v:.2f}"
+
+def stream_csv(query: ExportQuery, mirror: Mirror) -> Iterator[str]:
+    buf = io.StringIO()
+    w = csv.writer(buf)
+    w.writerow(FIELDS)
+    total = FIELDS.index("Total")
+    for page in query.pages(mirror):
+        for r in page:
+            w.writerow([_amount(v) if i == total else v for i, v in enumerate(r)])
+        yield buf.getvalue()
+        buf.seek(0)
+        buf.truncate()
+    yield buf.getvalue()
+
+def stream_ndjson(query: ExportQuery, mirror: Mirror) -> Iterator[str]:
+    for page in query.pages(mirror):
+        yield "".join(json.dumps(dict(zip(FIELDS, r)), ensure_ascii=False) + "\n" for r in page)
+
+STREAMS = {"csv": stream_csv, "ndjson": stream_ndjson}
+
+def http_date(ts: float) -> str:
+    return formatdate(ts, usegmt=True)
+
+def not_modified(changed_at: float, etag: str, if_none_match: str | None, if_modified_since: str | None) -> bool:
+    """If-None-Match важнее If-Modified-Since (RFC 9110)."""
+    if if_none_match:
+        return etag in [t.strip().removeprefix("W/") for t in if_none_match.split(",")] or if_none_match.strip() == "*"
+    if if_modified_since:
+        try:
+            return int(changed_at) <= parsedate_to_datetime(if_modified_since).timestamp()
+        except (TypeError, ValueError):
+            return False
+    return False
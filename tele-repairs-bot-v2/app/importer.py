@@ -0,0 +1,217 @@
+import os
+import re
+import csv
+import time
+import hashlib
+import logging
+import tempfile
+from dataclasses import dataclass, field
+from datetime import date, datetime
+from typing import AsyncIterator, Callable, Dict, Iterator, List, Tuple
+
+from .dedupe import get_save_index
+from .digest import get_digest
+from .journal import get_journal
+from .mirror import iso_date
+from .sheets import KNOWN_FIELDS
+from .validators import normalize_date, normalize_amount
+
+log = logging.getLogger("app.importer")
+
+# строк на одну проверку и одну транзакцию журнала; в лист их пачками по FLUSH_BATCH дописывает Flusher
+IMPORT_CHUNK = int(os.getenv("IMPORT_CHUNK", "500"))
+# Telegram отдаёт ботам файлы до 20 МБ, HTTP-загрузку ограничиваем так же
+IMPORT_MAX_BYTES = int(os.getenv("IMPORT_MAX_BYTES", str(20 * 1024 * 1024)))
+# кому можно присылать файлы боту (Telegram user id через запятую); пусто — импорт только через HTTP
+IMPORT_ADMINS = {int(x) for x in os.getenv("IMPORT_ADMINS", "").replace(" ", "").split(",") if x}
+IMPORT_MAX_ERRORS = 1000  # в отчёт попадают первые N ошибок, остальные только считаются
+PROGRESS_EVERY = 2.0
+
+REQUIRED = ("Date", "Unit", "Repair", "Total")
+XLSX_MIME = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+
+def _norm(name) -> str:
+    return re.sub(r"[^a-z0-9]", "", str(name or "").lower())
+
+# 'Paid?' / 'paid' / 'PAID' → Paid?; плюс пара частых названий из чужих таблиц
+_FIELDS = {_norm(f): f for f in KNOWN_FIELDS}
+_FIELDS.update({"amount": "Total", "cost": "Total", "truck": "Unit", "unitnumber": "Unit", "invoice": "InvoiceLink"})
+
+def detect_kind(filename: str | None, mime: str | None = None) -> str:
+    name, mime = (filename or "").lower(), (mime or "").split(";")[0].strip().lower()
+    if name.endswith(".xlsx") or mime == XLSX_MIME:
+        return "xlsx"
+    if name.endswith(".csv") or mime in ("text/csv", "application/csv"):
+        return "csv"
+    raise ValueError("only .csv and .xlsx files can be imported")
+
+def iter_csv(path: str) -> Iterator[list]:
+    with open(path, newline="", encoding="utf-8-sig") as f:
+        sample = f.read(8192)
+        f.seek(0)
+        try:
+            dialect = csv.Sniffer().sniff(sample, delimiters=",;\t")
+        except csv.Error:
+            dialect = csv.excel
+        try:
+            yield from csv.reader(f, dialect)
+        except csv.Error as e:
+            raise ValueError(f"CSV parse error: {e}")
+
+def iter_xlsx(path: str) -> Iterator[list]:
+    try:
+        from openpyxl import load_workbook
+    except ImportError:
+        raise RuntimeError("XLSX import needs openpyxl (pip install openpyxl); CSV works without it")
+    # read_only — строки читаются из zip потоком, лист целиком в память не поднимается
+    wb = load_workbook(path, read_only=True, data_only=True)
+    try:
+        for row in wb.worksheets[0].iter_rows(values_only=True):
+            yield list(row)
+    finally:
+        wb.close()
+
+def _cell(v) -> str:
+    if v is None:
+        return ""
+    if isinstance(v, datetime):
+        return v.date().isoformat()
+    if isinstance(v, date):
+        return v.isoformat()
+    if isinstance(v, float):
+        return str(int(v)) if v.is_integer() else f"{v:.2f}"
+    return str(v).strip()
+
+@dataclass
+class ImportReport:
+    rows: int = 0
+    imported: int = 0
+    duplicates: int = 0
+    error_count: int = 0
+    errors: List[Tuple[int, str]] = field(default_factory=list)  # (номер строки в файле, причина)
+    unknown_columns: List[str] = field(default_factory=list)
+
+    def error(self, line: int, reason: str):
+        self.error_count += 1
+        if len(self.errors) < IMPORT_MAX_ERRORS:
+            self.errors.append((line, reason))
+
+    def as_dict(self) -> Dict[str, object]:
+        return {"rows": self.rows, "imported": self.imported, "duplicates": self.duplicates,
+                "error_count": self.error_count, "errors": [{"row": n, "error": e} for n, e in self.errors],
+                "unknown_columns": self.unknown_columns}
+
+    def render(self, max_errors: int = 20) -> str:
+        lines = [f"Import done: {self.rows} rows, {self.imported} queued for the sheet, "
+                 f"{self.duplicates} duplicates skipped, {self.error_count} errors."]
+        if self.unknown_columns:
+            lines.append("Ignored columns: " + ", ".join(self.unknown_columns))
+        lines += [f"Row {n}: {e}" for n, e in self.errors[:max_errors]]
+        if self.error_count > max_errors:
+            lines.append(f"… and {self.error_count - max_errors} more")
+        return "\n".join(lines)
+
+def _map_header(header: list, rep: ImportReport) -> List[Tuple[int, str]]:
+    cols, taken = [], set()
+    for i, name in enumerate(header):
+        f = _FIELDS.get(_norm(_cell(name)))
+        if f and f not in taken:
+            cols.append((i, f))
+            taken.add(f)
+        elif _cell(name):
+            rep.unknown_columns.append(_cell(name))
+    miss = [k for k in REQUIRED if k not in taken]
+    if miss:
+        raise ValueError("missing required columns: " + ", ".join(miss))
+    return cols
+
+def _validate(rec: Dict[str, str]) -> str | None:
+    """Приводит запись к виду, как из анкеты; возвращает причину отказа или None."""
+    miss = [k for k in REQUIRED if not rec.get(k)]
+    if miss:
+        return "empty " + ", ".join(miss)
+    d = normalize_date(iso_date(rec["Date"]))
+    if not d:
+        return f"bad Date {rec['Date']!r}"
+    t = normalize_amount(rec["Total"].replace("$", ""))
+    if t is None:
+        return f"bad Total {rec['Total']!r}"
+    rec["Date"], rec["Total"] = d, t
+    rec.setdefault("Type", "Other")
+    return None
+
+def _row_key(rec: Dict[str, str]) -> str:
+    # повторный импорт того же файла не задваивает строки: ключ — содержимое записи
+    h = hashlib.blake2b("\x1f".join(rec.get(f, "") for f in KNOWN_FIELDS[:13]).encode(), digest_size=12)
+    return "imp:" + h.hexdigest()
+
+def run_import(path: str, kind: str, progress: Callable[[ImportReport], None] | None = None) -> ImportReport:
+    """Читает файл потоком, проверяет по IMPORT_CHUNK строк и кладёт годные в журнал одной транзакцией на пачку."""
+    rows = iter_xlsx(path) if kind == "xlsx" else iter_csv(path)
+    rep = ImportReport()
+    header = next(rows, None)
+    if header is None:
+        raise ValueError("file is empty")
+    cols = _map_header(header, rep)
+    journal, idx, agg = get_journal(), get_save_index(), get_digest().agg
+    seen: set = set()
+    last_progress = time.monotonic()
+
+    def _commit(chunk: List[Tuple[int, list]]):
+        items = []
+        for line, values in chunk:
+            rec = {f: _cell(values[i]) if i < len(values) else "" for i, f in cols}
+            rec = {k: v for k, v in rec.items() if v}
+            reason = _validate(rec)
+            if reason:
+                rep.error(line, reason)
+                continue
+            key = rec.get("MsgKey") or _row_key(rec)
+            if key in seen or idx.lookup(key)[0]:
+                rep.duplicates += 1
+                continue
+            seen.add(key)
+            rec["MsgKey"] = key
+            # старые ремонты — не новые: время создания по дате ремонта, иначе весь импорт
+            # попадёт в «New in 24h» ближайшей сводки и наверх сортированного листа
+            rec.setdefault("CreatedAt", rec["Date"] + "T00:00:00Z")
+            items.append((key, [rec.get(f, "") for f in KNOWN_FIELDS], [key]))
+        if items:
+            journal.append_many(items)
+            for _, row, _ in items:
+                agg.add(dict(zip(KNOWN_FIELDS, row)))
+            rep.imported += len(items)
+
+    chunk: List[Tuple[int, list]] = []
+    for line, values in enumerate(rows, start=2):
+        if not any(_cell(v) for v in values):
+            continue
+        rep.rows += 1
+        chunk.append((line, values))
+        if len(chunk) >= IMPORT_CHUNK:
+            _commit(chunk)
+            chunk = []
+            if progress and time.monotonic() - last_progress >= PROGRESS_EVERY:
+                last_progress = time.monotonic()
+                progress(rep)
+    if chunk:
+        _commit(chunk)
+    log.info("import %s: %d rows, %d queued, %d duplicates, %d errors",
+             kind, rep.rows, rep.imported, rep.duplicates, rep.error_count)
+    return rep
+
+async def spool(chunks: AsyncIterator[bytes], suffix: str) -> str:
+    """Тело запроса → временный файл по кускам; вызывающий удаляет файл сам."""
+    fd, path = tempfile.mkstemp(suffix="." + suffix)
+    size = 0
+    try:
+        with os.fdopen(fd, "wb") as f:
+            async for part in chunks:
+                size += len(part)
+                if size > IMPORT_MAX_BYTES:
+                    raise ValueError(f"file is larger than {IMPORT_MAX_BYTES} bytes")
+                f.write(part)
+    except BaseException:
+        os.unlink(path)
+        raise
+    return path
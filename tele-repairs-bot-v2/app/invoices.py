@@ -0,0 +1,234 @@
+import os
+import re
+import hmac
+import time
+import asyncio
+import hashlib
+import logging
+import tempfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Coroutine, Dict, List, Set, Tuple
+
+from .db import DATA_DIR, connect
+from .tenants import PerTenant, current, tenants
+
+log = logging.getLogger("app.invoices")
+
+# файлы счетов: DATA_DIR/invoices/ab/<sha256>.<ext>, одна копия на содержимое для всех арендаторов
+INVOICE_DIR = os.getenv("INVOICE_DIR", os.path.join(DATA_DIR, "invoices"))
+# Bot API отдаёт ботам файлы до 20 МБ
+INVOICE_MAX_BYTES = int(os.getenv("INVOICE_MAX_BYTES", str(20 * 1024 * 1024)))
+# одновременных скачиваний на процесс: крупные файлы не забирают весь канал
+INVOICE_CONCURRENCY = int(os.getenv("INVOICE_CONCURRENCY", "4"))
+# потоки для миниатюр (Pillow отпускает GIL на декодировании и ресайзе)
+INVOICE_WORKERS = int(os.getenv("INVOICE_WORKERS", "2"))
+# база для ссылок в InvoiceLink; на Render есть RENDER_EXTERNAL_URL
+PUBLIC_BASE_URL = os.getenv("PUBLIC_BASE_URL", os.getenv("RENDER_EXTERNAL_URL", "")).rstrip("/")
+# сколько после Save ждём ещё качающиеся файлы, чтобы дописать их ссылки в запись
+INVOICE_SAVE_WAIT = 120.0
+# сколько остановка процесса ждёт начатые скачивания (и дописывание их ссылок), прежде чем отменить
+INVOICE_SHUTDOWN_WAIT = float(os.getenv("INVOICE_SHUTDOWN_WAIT", "15"))
+THUMB_SIZE = 512
+CHUNK = 64 * 1024
+
+EXTENSIONS = {"image/jpeg": ".jpg", "image/png": ".png", "image/webp": ".webp", "image/heic": ".heic",
+              "application/pdf": ".pdf"}
+FILE_NAME = re.compile(r"[0-9a-f]{64}(\.thumb\.jpg|\.jpg|\.png|\.webp|\.heic|\.pdf)")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS files (
+    unique_id TEXT PRIMARY KEY,
+    name TEXT NOT NULL
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS pending (
+    chat_id INTEGER NOT NULL,
+    name TEXT NOT NULL,
+    added_at REAL NOT NULL,
+    PRIMARY KEY (chat_id, name)
+) WITHOUT ROWID;
+"""
+
+def extension(mime: str | None, filename: str | None = None) -> str | None:
+    ext = EXTENSIONS.get((mime or "").split(";")[0].strip().lower())
+    if ext is None and filename:
+        ext = next((e for e in EXTENSIONS.values() if filename.lower().endswith(e)), None)
+    return ext
+
+def path_of(name: str) -> str:
+    return os.path.join(INVOICE_DIR, name[:2], name)
+
+def _signature(tenant, name: str) -> str:
+    return hmac.new(tenant.WEBHOOK_SECRET_TOKEN.encode(), f"invoice|{name}".encode(), hashlib.sha256).hexdigest()[:32]
+
+def link(name: str) -> str:
+    """Ссылка для InvoiceLink: подписана секретом арендатора. Лист общий, так что одного имени (sha256)
+    мало — без подписи ссылку не собрать, а ссылка одного арендатора не открывает файлы другого."""
+    t = current()
+    return f"{PUBLIC_BASE_URL}/invoices/{t.NAME}/{_signature(t, name)}/{name}"
+
+def verify(tenant: str, signature: str, name: str) -> bool:
+    t = tenants().get(tenant)
+    return t is not None and hmac.compare_digest(signature, _signature(t, name))
+
+_pool: ThreadPoolExecutor | None = None
+# скачивания и дописывание ссылок (bot_flow): shutdown даёт им закончить, а не рвёт файл на середине
+_tasks: Set[asyncio.Task] = set()
+_http = None
+_sem: asyncio.Semaphore | None = None
+
+def _get_pool() -> ThreadPoolExecutor:
+    global _pool
+    if _pool is None:
+        _pool = ThreadPoolExecutor(max_workers=INVOICE_WORKERS, thread_name_prefix="invoice")
+    return _pool
+
+def _get_http():
+    # свой клиент для файлов: стримингом, вне пула соединений Bot API с его таймаутами
+    global _http, _sem
+    if _http is None:
+        import httpx
+        _http = httpx.AsyncClient(timeout=httpx.Timeout(60.0, connect=10.0))
+        _sem = asyncio.Semaphore(INVOICE_CONCURRENCY)
+    return _http
+
+def _thumbnail(name: str):
+    """Миниатюра рядом с оригиналом; без Pillow просто не делается."""
+    try:
+        from PIL import Image
+    except ImportError:
+        return
+    src, dst = path_of(name), path_of(name.rsplit(".", 1)[0] + ".thumb.jpg")
+    if os.path.exists(dst):
+        return
+    try:
+        with Image.open(src) as im:
+            im.draft("RGB", (THUMB_SIZE, THUMB_SIZE))  # JPEG декодируется сразу в уменьшенном масштабе
+            im.thumbnail((THUMB_SIZE, THUMB_SIZE))
+            tmp = dst + ".tmp"
+            im.convert("RGB").save(tmp, "JPEG", quality=80)
+            os.replace(tmp, dst)
+    except Exception as e:
+        log.warning("thumbnail for %s failed: %s: %s", name, type(e).__name__, e)
+
+async def download(url: str, ext: str) -> str:
+    """Качает файл кусками во временный файл, считая sha256 на лету; возвращает имя в хранилище."""
+    client = _get_http()
+    os.makedirs(INVOICE_DIR, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=INVOICE_DIR, suffix=".part")
+    h, size = hashlib.sha256(), 0
+    try:
+        async with _sem:
+            with os.fdopen(fd, "wb") as f:
+                async with client.stream("GET", url) as r:
+                    r.raise_for_status()
+                    async for chunk in r.aiter_bytes(CHUNK):
+                        size += len(chunk)
+                        if size > INVOICE_MAX_BYTES:
+                            raise ValueError(f"file is larger than {INVOICE_MAX_BYTES} bytes")
+                        h.update(chunk)
+                        f.write(chunk)
+        name = h.hexdigest() + ext
+        dst = path_of(name)
+        if os.path.exists(dst):
+            os.unlink(tmp)  # такой файл уже есть — дубль ничего не стоит
+        else:
+            os.makedirs(os.path.dirname(dst), exist_ok=True)
+            os.replace(tmp, dst)
+    except BaseException:
+        if os.path.exists(tmp):
+            os.unlink(tmp)
+        raise
+    if ext != ".pdf":
+        await asyncio.get_running_loop().run_in_executor(_get_pool(), _thumbnail, name)
+    return name
+
+def spawn(coro: Coroutine) -> asyncio.Task:
+    t = asyncio.create_task(coro)
+    _tasks.add(t)
+    t.add_done_callback(_tasks.discard)
+    return t
+
+async def drain(timeout: float = INVOICE_SHUTDOWN_WAIT):
+    """Остановка: ждёт начатые задачи до timeout, остальные отменяет."""
+    if not _tasks:
+        return
+    _, pending = await asyncio.wait(set(_tasks), timeout=timeout)
+    for t in pending:
+        t.cancel()
+    if pending:
+        log.warning("%d invoice downloads cancelled by shutdown", len(pending))
+        await asyncio.gather(*pending, return_exceptions=True)
+
+class InvoiceStore:
+    """Какие файлы уже скачаны (по file_unique_id Telegram) и какие ждут привязки к анкете чата."""
+
+    def __init__(self, name: str = "invoices.sqlite3"):
+        self._db = connect(name)
+        self._db.executescript(_SCHEMA)
+        self._lock = threading.Lock()
+        self._inflight: Dict[int, Set[asyncio.Task]] = {}
+
+    def known(self, unique_id: str) -> str | None:
+        with self._lock:
+            r = self._db.execute("SELECT name FROM files WHERE unique_id=?", (unique_id,)).fetchone()
+        return r[0] if r and os.path.exists(path_of(r[0])) else None
+
+    def add(self, chat_id: int, unique_id: str, name: str, task: asyncio.Task | None = None) -> bool:
+        """Файл скачан. К анкете чата он привязывается, только если скачивание task ещё не отцеплено
+        (см. detach): иначе анкету уже сохранили или отменили, и файл не должен уехать в следующую."""
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO files(unique_id, name) VALUES (?, ?)", (unique_id, name))
+            if task is not None and task not in self._inflight.get(chat_id, ()):
+                return False
+            self._db.execute("INSERT OR IGNORE INTO pending(chat_id, name, added_at) VALUES (?, ?, ?)",
+                             (chat_id, name, time.time()))
+        return True
+
+    def pending(self, chat_id: int) -> List[str]:
+        with self._lock:
+            return [r[0] for r in self._db.execute(
+                "SELECT name FROM pending WHERE chat_id=? ORDER BY added_at", (chat_id,))]
+
+    def discard(self, chat_id: int):
+        """Анкета сохранена или отменена: файлы остаются на диске, привязка к чату снимается,
+        недокачанные файлы к анкете уже не прицепятся."""
+        with self._lock:
+            self._db.execute("DELETE FROM pending WHERE chat_id=?", (chat_id,))
+            self._inflight.pop(chat_id, None)
+
+    def track(self, chat_id: int, task: asyncio.Task):
+        with self._lock:
+            tasks = self._inflight.setdefault(chat_id, set())
+            tasks.add(task)
+        task.add_done_callback(tasks.discard)
+
+    def detach(self, chat_id: int) -> Tuple[List[str], List[asyncio.Task]]:
+        """Для Save: ссылки уже скачанных файлов и ещё качающиеся задачи, которые больше не пишут в анкету.
+        Save их не ждёт — дописывает ссылки в запись, когда файлы докачаются (см. bot_flow._attach_late)."""
+        with self._lock:
+            tasks = list(self._inflight.pop(chat_id, ()))
+            names = [r[0] for r in self._db.execute(
+                "SELECT name FROM pending WHERE chat_id=? ORDER BY added_at", (chat_id,))]
+        return [link(n) for n in names], tasks
+
+    def reattach(self, chat_id: int, tasks: List[asyncio.Task]):
+        """Save не удался: отцепленные скачивания возвращаются к анкете, докачанные — в pending."""
+        for t in tasks:
+            if not t.done():
+                self.track(chat_id, t)
+            elif not t.cancelled() and t.exception() is None and t.result():
+                with self._lock:
+                    self._db.execute("INSERT OR IGNORE INTO pending(chat_id, name, added_at) VALUES (?, ?, ?)",
+                                     (chat_id, t.result(), time.time()))
+
+_stores: PerTenant[InvoiceStore] = PerTenant(lambda t: InvoiceStore(t.data_name("invoices.sqlite3")))
+
+def get_invoices() -> InvoiceStore:
+    return _stores.get()
+
+async def shutdown():
+    if _http is not None:
+        await _http.aclose()
+    if _pool is not None:
+        _pool.shutdown(wait=False)
@@ -0,0 +1,364 @@
+import os
+import re
+import json
+import time
+import random
+import asyncio
+import logging
+import threading
+from typing import Callable, Dict, Iterable, List, Tuple
+
+from .db import connect
+from .sheets import KNOWN_FIELDS, SheetsClient, get_async_sheets
+from .tenants import PerTenant, current
+from .tracing import span, trace
+
+log = logging.getLogger("app.journal")
+
+FLUSH_INTERVAL = float(os.getenv("FLUSH_INTERVAL", "2"))
+FLUSH_BATCH = int(os.getenv("FLUSH_BATCH", "200"))
+FLUSH_MAX_BACKOFF = float(os.getenv("FLUSH_MAX_BACKOFF", "300"))
+# строки, взятые воркером и не подтверждённые за это время, снова считаются свободными
+CLAIM_LEASE = 120.0
+_OWNER = re.compile(r"\d+\|(-?\d+):")
+_KEY = KNOWN_FIELDS.index("MsgKey")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS journal (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    msg_key TEXT,
+    row TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    claimed_at REAL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    flushed_at REAL,
+    sheet_row INTEGER,
+    chat_id INTEGER  -- чат, сохранивший запись: только он правит её через /close, /paid; NULL — импорт
+);
+CREATE INDEX IF NOT EXISTS journal_pending ON journal(id) WHERE flushed_at IS NULL;
+-- правки уже ушедших в лист записей; повторная правка той же ячейки заменяет предыдущую
+CREATE TABLE IF NOT EXISTS edits (
+    msg_key TEXT NOT NULL,
+    field TEXT NOT NULL,
+    value TEXT NOT NULL,
+    created_at REAL NOT NULL,
+    PRIMARY KEY (msg_key, field)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS save_keys (
+    key TEXT PRIMARY KEY,
+    rec_id INTEGER,
+    created_at REAL NOT NULL
+) WITHOUT ROWID;
+"""
+
+class Journal:
+    """Append-only журнал сохранённых записей: строка сначала фиксируется локально, в Sheets — потом."""
+
+    def __init__(self, name: str = "journal.sqlite3"):
+        self._db = connect(name, synchronous="FULL")
+        self._db.executescript(_SCHEMA)
+        self._migrate()
+        self._lock = threading.Lock()
+        # вызываются с (запись до правки, поменявшиеся поля) после каждой правки, под замком журнала:
+        # так бегущие итоги сводки (digest.Aggregates) видят правку ровно один раз, см. pending()
+        self.listeners: List[Callable[[Dict[str, str], Dict[str, str]], None]] = []
+
+    def _migrate(self):
+        # журналы до появления chat_id: владельца достаём из MsgKey вида "update_id|chat_id:message_id"
+        if "chat_id" in {r[1] for r in self._db.execute("PRAGMA table_info(journal)")}:
+            return
+        self._db.execute("BEGIN IMMEDIATE")
+        try:
+            self._db.execute("ALTER TABLE journal ADD COLUMN chat_id INTEGER")
+            owners = [(int(m.group(1)), i) for i, k in self._db.execute("SELECT id, msg_key FROM journal")
+                      if (m := _OWNER.match(k or ""))]
+            self._db.executemany("UPDATE journal SET chat_id=? WHERE id=?", owners)
+            self._db.execute("COMMIT")
+        except BaseException:
+            self._db.execute("ROLLBACK")
+            raise
+
+    def append(self, msg_key: str, row: List[str], keys: Iterable[str] = (), chat_id: int | None = None) -> int:
+        """Пишет строку и её ключи идемпотентности (см. dedupe.SaveIndex) одной транзакцией."""
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                rec_id = self._db.execute(
+                    "INSERT INTO journal(msg_key, row, created_at, chat_id) VALUES (?, ?, ?, ?)",
+                    (msg_key, json.dumps(row, ensure_ascii=False), now, chat_id),
+                ).lastrowid
+                self._db.executemany("INSERT OR REPLACE INTO save_keys(key, rec_id, created_at) VALUES (?, ?, ?)",
+                                     [(k, rec_id, now) for k in keys])
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            return rec_id
+
+    def append_many(self, items: List[Tuple[str, List[str], Iterable[str]]]) -> List[int]:
+        """Пачка (msg_key, row, keys) одной транзакцией — для импорта, где строк тысячи."""
+        now = time.time()
+        ids: List[int] = []
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                for msg_key, row, keys in items:
+                    rec_id = self._db.execute(
+                        "INSERT INTO journal(msg_key, row, created_at) VALUES (?, ?, ?)",
+                        (msg_key, json.dumps(row, ensure_ascii=False), now),
+                    ).lastrowid
+                    self._db.executemany("INSERT OR REPLACE INTO save_keys(key, rec_id, created_at) VALUES (?, ?, ?)",
+                                         [(k, rec_id, now) for k in keys])
+                    ids.append(rec_id)
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        return ids
+
+    def find_key(self, key: str) -> Tuple[int | None, float] | None:
+        with self._lock:
+            return self._db.execute("SELECT rec_id, created_at FROM save_keys WHERE key=?", (key,)).fetchone()
+
+    def add_keys(self, keys: Iterable[str]):
+        """Ключи, пришедшие не из журнала (например, колонка MsgKey в листе)."""
+        now = time.time()
+        with self._lock:
+            self._db.executemany("INSERT OR IGNORE INTO save_keys(key, rec_id, created_at) VALUES (?, NULL, ?)",
+                                 [(k, now) for k in keys])
+
+    def claim(self, limit: int) -> List[Tuple[int, List[str], bool]]:
+        """Забирает до limit неотправленных строк (старые первыми) под аренду CLAIM_LEASE.
+        Третий элемент — строку уже пытались отправить: прошлая попытка могла дойти до листа."""
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                rows = self._db.execute(
+                    "SELECT id, row, claimed_at IS NOT NULL OR attempts > 0 FROM journal "
+                    "WHERE flushed_at IS NULL AND (claimed_at IS NULL OR claimed_at < ?) "
+                    "ORDER BY id LIMIT ?", (now - CLAIM_LEASE, limit),
+                ).fetchall()
+                self._db.executemany("UPDATE journal SET claimed_at=? WHERE id=?", [(now, i) for i, _, _ in rows])
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+        return [(i, json.loads(r), bool(retry)) for i, r, retry in rows]
+
+    def mark_flushed(self, written: List[Tuple[int, int]]):
+        """written — пары (id в журнале, номер строки в листе на момент записи)."""
+        now = time.time()
+        with self._lock:
+            self._db.executemany("UPDATE journal SET flushed_at=?, sheet_row=? WHERE id=?",
+                                 [(now, r, i) for i, r in written])
+
+    def release(self, ids: List[int]):
+        with self._lock:
+            self._db.executemany("UPDATE journal SET claimed_at=NULL, attempts=attempts+1 WHERE id=?", [(i,) for i in ids])
+
+    def edit(self, rec_id: int, fields: Dict[str, str], owner: int | None = None) -> Tuple[str | None, Dict[str, str]]:
+        """Меняет поля сохранённой записи. Строку, которую Flusher ещё ни разу не брал, правим прямо в журнале
+        ('journal'); иначе правка встаёт в очередь и уйдёт в лист пачкой ('queued'). None — записи с таким id нет
+        или owner (чат, просящий правку; None — без проверки) её не сохранял.
+        Второй элемент — запись до правки (см. current); сама строка журнала правится в обоих случаях,
+        чтобы current() не откатывался к старым значениям, когда done_edits уберёт дошедшую правку."""
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                r = self._db.execute("SELECT msg_key, row, flushed_at, claimed_at, chat_id, attempts FROM journal WHERE id=?",
+                                     (rec_id,)).fetchone()
+                if r is None or (owner is not None and r[4] != owner):
+                    self._db.execute("COMMIT")
+                    return None, {}
+                row = json.loads(r[1])
+                row += [""] * (len(KNOWN_FIELDS) - len(row))
+                old = dict(zip(KNOWN_FIELDS, row))
+                old.update(self._db.execute("SELECT field, value FROM edits WHERE msg_key=? ORDER BY created_at",
+                                            (r[0],)).fetchall())
+                for name, value in fields.items():
+                    row[KNOWN_FIELDS.index(name)] = value
+                self._db.execute("UPDATE journal SET row=? WHERE id=?", (json.dumps(row, ensure_ascii=False), rec_id))
+                # и после истёкшей аренды строка могла дойти до листа (таймаут, поток пула дописал пачку):
+                # тогда _skip_written пометит её записанной по MsgKey, не отправив новых значений
+                if r[2] is None and r[3] is None and not r[5]:
+                    result = "journal"
+                else:
+                    self._db.executemany("INSERT OR REPLACE INTO edits(msg_key, field, value, created_at) VALUES (?, ?, ?, ?)",
+                                         [(r[0], name, value, now) for name, value in fields.items()])
+                    result = "queued"
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            changed = {k: v for k, v in fields.items() if str(old.get(k) or "").strip() != v}
+            for fn in self.listeners if changed else ():
+                try:
+                    fn(old, changed)
+                except Exception:
+                    log.exception("edit listener %r failed", fn)
+        return result, old
+
+    def current(self, rec_id: int) -> Dict[str, str] | None:
+        """Запись, как её знает журнал: строка плюс правки, ещё не ушедшие в лист."""
+        with self._lock:
+            r = self._db.execute("SELECT msg_key, row FROM journal WHERE id=?", (rec_id,)).fetchone()
+            if r is None:
+                return None
+            edits = self._db.execute("SELECT field, value FROM edits WHERE msg_key=? ORDER BY created_at", (r[0],)).fetchall()
+        rec = dict(zip(KNOWN_FIELDS, json.loads(r[1])))
+        rec.update(edits)
+        return rec
+
+    def pending(self, before: Callable[[], None] = lambda: None) -> Tuple[List[Dict[str, str]], Dict[str, Dict[str, str]]]:
+        """Неотправленные строки и правки одним чтением (для сверки итогов сводки). before() вызывается под
+        тем же замком, что и слушатели правок: любая правка либо уже в прочитанном, либо придёт слушателю после."""
+        with self._lock:
+            before()
+            rows = self._db.execute("SELECT row FROM journal WHERE flushed_at IS NULL").fetchall()
+            edits = self._pending_edits()
+        return [dict(zip(KNOWN_FIELDS, json.loads(r))) for (r,) in rows], edits
+
+    def pending_edits(self) -> Dict[str, Dict[str, str]]:
+        with self._lock:
+            return self._pending_edits()
+
+    def _pending_edits(self) -> Dict[str, Dict[str, str]]:
+        rows = self._db.execute("SELECT msg_key, field, value FROM edits ORDER BY created_at").fetchall()
+        out: Dict[str, Dict[str, str]] = {}
+        for key, name, value in rows:
+            out.setdefault(key, {})[name] = value
+        return out
+
+    def done_edits(self, done: Dict[str, Dict[str, str]]):
+        # только если значение не поменяли, пока шёл запрос: иначе новая правка уйдёт следующей пачкой
+        with self._lock:
+            self._db.executemany("DELETE FROM edits WHERE msg_key=? AND field=? AND value=?",
+                                 [(k, name, v) for k, fields in done.items() for name, v in fields.items()])
+
+    def pending_count(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM journal WHERE flushed_at IS NULL").fetchone()[0]
+
+class Flusher:
+    """Фоновая задача: раз в FLUSH_INTERVAL пачкой отправляет журнал в Sheets, при ошибках — backoff."""
+
+    def __init__(self, journal: Journal):
+        self.journal = journal
+        # вызываются с (rows, sheet_rows) после успешной записи пачки — так кеши обновляются без чтения листа
+        self.listeners: List[Callable[[List[List[str]], List[int]], None]] = []
+        # MsgKey → номер строки для правок (зеркало); без него правки копятся в журнале
+        self.locator = None
+        self._task: asyncio.Task | None = None
+        self._stop = asyncio.Event()
+
+    async def flush_once(self) -> int:
+        claimed = await asyncio.to_thread(self.journal.claim, FLUSH_BATCH)
+        if not claimed:
+            return 0
+        batch = [(i, r) for i, r, _ in claimed]
+        with trace("flush", tenant=current().NAME, rows=len(batch)):
+            if any(retry for _, _, retry in claimed):
+                batch = await self._skip_written(batch)
+                if not batch:
+                    return len(claimed)
+            ids = [i for i, _ in batch]
+            try:
+                sheet_rows = await get_async_sheets().run(SheetsClient.append_repair_rows, [r for _, r in batch])
+            except (asyncio.TimeoutError, asyncio.CancelledError):
+                # поток пула не прерывается и обычно дописывает пачку: строки не отпускаем, их вернёт
+                # истёкший CLAIM_LEASE, а следующая попытка сначала сверит MsgKey с листом
+                raise
+            except BaseException:
+                await asyncio.to_thread(self.journal.release, ids)
+                raise
+            await asyncio.to_thread(self.journal.mark_flushed, list(zip(ids, sheet_rows)))
+            rows = [r for _, r in batch]
+            for fn in self.listeners:
+                try:
+                    with span(f"listener.{getattr(fn, '__name__', 'fn')}"):
+                        await asyncio.to_thread(fn, rows, sheet_rows)
+                except Exception:
+                    log.exception("flush listener %r failed", fn)
+        return len(claimed)
+
+    async def _skip_written(self, batch: List[Tuple[int, List[str]]]) -> List[Tuple[int, List[str]]]:
+        """Повторная отправка (таймаут, падение процесса между записью и mark_flushed): строки, чьи MsgKey
+        уже есть в листе, помечаем записанными по найденным номерам и второй раз не дописываем."""
+        keys = [r[_KEY] for _, r in batch if len(r) > _KEY and r[_KEY]]
+        found = await get_async_sheets().run(SheetsClient.find_keys, keys) if keys else {}
+        if not found:
+            return batch
+        written = [(i, found[r[_KEY]]) for i, r in batch if len(r) > _KEY and r[_KEY] in found]
+        await asyncio.to_thread(self.journal.mark_flushed, written)
+        log.info("%d journaled rows were already in the sheet, not sent again", len(written))
+        return [(i, r) for i, r in batch if not (len(r) > _KEY and r[_KEY] in found)]
+
+    async def flush_edits(self) -> int:
+        """Все накопившиеся правки — один batch_update (плюс одна сверка MsgKey). Идёт в той же задаче,
+        что и дозапись, поэтому в режиме insert строки не сдвигаются между поиском и записью."""
+        if self.locator is None:
+            return 0
+        edits = await asyncio.to_thread(self.journal.pending_edits)
+        if not edits:
+            return 0
+        rows = await asyncio.to_thread(self.locator.locate, list(edits))
+        # строки, которых ещё нет в зеркале (пачка в пути), подождут следующего прохода
+        batch = {rows[k]: (k, fields) for k, fields in edits.items() if k in rows}
+        if not batch:
+            return 0
+        written = await get_async_sheets().run(SheetsClient.update_records, batch)
+        done = {k: edits[k] for k in written}
+        await asyncio.to_thread(self.journal.done_edits, done)
+        await asyncio.to_thread(self.locator.on_edited, done)
+        return len(done)
+
+    async def _run(self):
+        delay = 0.0  # сразу после старта досылаем то, что осталось с прошлого процесса
+        while True:
+            try:
+                await asyncio.wait_for(self._stop.wait(), delay)
+                return
+            except asyncio.TimeoutError:
+                pass
+            try:
+                while await self.flush_once() == FLUSH_BATCH:
+                    pass
+                await self.flush_edits()
+                delay = FLUSH_INTERVAL
+            except Exception as e:
+                delay = min(max(delay, FLUSH_INTERVAL) * 2, FLUSH_MAX_BACKOFF) * random.uniform(0.8, 1.2)
+                log.warning("flush failed (%s: %s), retry in %.1fs", type(e).__name__, e, delay)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name="journal-flusher")
+
+    async def stop(self, timeout: float = 10.0):
+        """Даёт текущей пачке дописаться (не рвём запрос посередине) и делает последний flush."""
+        self._stop.set()
+        if self._task:
+            try:
+                await asyncio.wait_for(self._task, timeout)
+                await asyncio.wait_for(self.flush_once(), timeout)
+                await asyncio.wait_for(self.flush_edits(), timeout)
+            except Exception as e:
+                log.warning("final flush skipped, rows stay in journal: %s", e)
+            self._task = None
+
+_journals: PerTenant[Journal] = PerTenant(lambda t: Journal(t.data_name("journal.sqlite3")))
+_flushers: PerTenant[Flusher] = PerTenant(lambda t: Flusher(get_journal()))
+
+def get_journal() -> Journal:
+    return _journals.get()
+
+def get_flusher() -> Flusher:
+    return _flushers.get()
+
+def all_journals() -> List[Journal]:
+    return _journals.all()
+
+def all_flushers() -> Dict[str, Flusher]:
+    return _flushers.items()
@@ -1,40 +1,217 @@
+from .startup import PHASES, STARTUP_MODE  # первым: отсюда считаются фазы старта
+
+import os
+import hmac
+import asyncio
 import logging
+import importlib
+from typing import Dict
 from fastapi import FastAPI, Request, Header, HTTPException
-from fastapi.responses import JSONResponse, PlainTextResponse
-from telegram import Update
-from telegram.ext import (
-    Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters
-)
+from fastapi.responses import FileResponse, JSONResponse, PlainTextResponse, Response, StreamingResponse
 
-from .config import load_settings
-from .bot_flow import start, new, cancel, handle_text, handle_callback, do_save
-from .sheets import SheetsClient
+# тяжёлые модули (telegram, gspread, google-auth) здесь не импортируются: см. _warm_up
+from .config import DEFAULT_TENANT, Settings
+from .tenants import by_secret, tenants, use
+from .state import flush_state, live_drafts
+from .dispatch import UpdateDispatcher, WEBHOOK_MODE
+from .metrics import UPDATE_SECONDS, Gauge, render, track
+from .tracing import span, trace
+from .capture import get_capture
 
 logging.basicConfig(level=logging.INFO, format="%(asctime)s %(levelname)s %(name)s: %(message)s")
 log = logging.getLogger("app")
 
-settings = load_settings()
+TENANTS = tenants()  # TENANTS или одиночные TELEGRAM_BOT_TOKEN/WEBHOOK_SECRET_TOKEN/SPREADSHEET_ID
 app = FastAPI()
+_background: set[asyncio.Task] = set()
+
+def _spawn(coro):
+    t = asyncio.create_task(coro)
+    _background.add(t)
+    t.add_done_callback(_background.discard)
+
+def _phase(name: str, tenant: str) -> str:
+    return name if len(TENANTS) == 1 else f"{name}:{tenant}"
+
+def _tenant(secret: str) -> Settings:
+    t = by_secret(secret)
+    if t is None:
+        raise HTTPException(status_code=403, detail="bad path secret")
+    return t
+
+# Telegram: по Application на арендатора, собираются в _warm_up; до этого апдейты ждут в очереди диспетчера
+bots: Dict[str, object] = {}
+_ready: Dict[str, asyncio.Event] = {name: asyncio.Event() for name in TENANTS}
+_warmup: asyncio.Task | None = None
+
+def _build_bot(tenant: Settings):
+    from telegram.ext import Application, CommandHandler, MessageHandler, CallbackQueryHandler, filters
+    from .bot_flow import (start, new, cancel, handle_text, handle_callback, do_save, history, report,
+                           import_document, quick, attach_invoice, close, paid,
+                           digest, subscribe, unsubscribe)
+    from .tglimit import TelegramLimiter
+    limiter = TelegramLimiter("telegram" if tenant.NAME == DEFAULT_TENANT else f"telegram:{tenant.NAME}")
+    bot = Application.builder().token(tenant.TELEGRAM_BOT_TOKEN).rate_limiter(limiter).build()
+    bot.add_handler(CommandHandler("start", start))
+    bot.add_handler(CommandHandler("new", new))
+    bot.add_handler(CommandHandler("cancel", cancel))
+    bot.add_handler(CommandHandler(["quick", "q"], quick))  # вся запись одним сообщением
+    bot.add_handler(CommandHandler("save", do_save))         # ручной сейв
+    bot.add_handler(CommandHandler("history", history))
+    bot.add_handler(CommandHandler("close", close))          # Status → Closed у сохранённой записи
+    bot.add_handler(CommandHandler("paid", paid))            # Paid? → Yes
+    bot.add_handler(CommandHandler("report", report))
+    bot.add_handler(CommandHandler("digest", digest))
+    bot.add_handler(CommandHandler("subscribe", subscribe))      # ежедневная сводка в этот чат
+    bot.add_handler(CommandHandler("unsubscribe", unsubscribe))
+    bot.add_handler(MessageHandler(filters.Document.FileExtension("csv") | filters.Document.FileExtension("xlsx"),
+                                   import_document))
+    # остальные документы — по mime: картинки и PDF считаются счетами
+    bot.add_handler(MessageHandler(filters.PHOTO | filters.Document.IMAGE | filters.Document.PDF, attach_invoice))
+    bot.add_handler(CallbackQueryHandler(handle_callback))   # ловим все коллбеки
+    bot.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), handle_text))
+    return bot
+
+def _update_type(payload: dict) -> str:
+    return next((k for k in payload if k != "update_id"), "unknown")
+
+async def _process_payload(payload: dict, tenant: str):
+    kind = _update_type(payload)
+    with track(UPDATE_SECONDS.labels(kind)), trace("update", type=kind, tenant=tenant, update_id=payload.get("update_id")):
+        ready = _ready[tenant]
+        if not ready.is_set():
+            with span("wait_ready"):
+                await ready.wait()
+        from telegram import Update
+        from .bot_flow import user_data_scope
+        bot = bots[tenant]
+        # хендлеры бота видят своего арендатора: журнал, зеркало, анкеты, лист
+        with use(tenant):
+            with span("de_json"):
+                update = Update.de_json(payload, bot.bot)
+            with span("process_update"), user_data_scope(bot, tenant, update):
+                await bot.process_update(update)
+
+dispatcher = UpdateDispatcher(_process_payload)
+
+def _journal_pending() -> int:
+    from .journal import all_journals
+    return sum(j.pending_count() for j in all_journals())
+
+# значения снимаются при scrape, на горячем пути ничего не считается
+Gauge("repairs_live_drafts", "Unfinished forms across all workers", fn=live_drafts)
+Gauge("repairs_journal_pending", "Saved rows not yet written to Google Sheets", fn=_journal_pending)
+Gauge("repairs_dispatch_queue_depth", "Updates accepted by the webhook and not yet processed", fn=dispatcher.depth)
+
+def _import_heavy():
+    for name in ("telegram.ext", ".bot_flow", ".mirror", ".dedupe", ".reports", ".importer", ".digest"):
+        importlib.import_module(name, __package__)
+
+async def _start_bot(tenant: Settings):
+    with PHASES.timed(_phase("bot_build", tenant.NAME)):
+        # сборка создаёт httpx-клиенты с SSL-контекстом — это сотни миллисекунд, уводим с цикла событий
+        bot = await asyncio.to_thread(_build_bot, tenant)
+    delay = 1.0
+    while True:
+        try:
+            with PHASES.timed(_phase("tg_initialize", tenant.NAME)):
+                await bot.initialize()  # getMe
+            break
+        except Exception as e:
+            log.warning("Telegram initialize failed for %s (%s: %s), retry in %.0fs",
+                        tenant.NAME, type(e).__name__, e, delay)
+            await asyncio.sleep(delay)
+            delay = min(delay * 2, 30.0)
+    await bot.start()
+    from .digest import schedule
+    schedule(bot, tenant.NAME)
+    bots[tenant.NAME] = bot
+    _ready[tenant.NAME].set()
+    if all(e.is_set() for e in _ready.values()):
+        PHASES.mark("ready")
+    log.info("Telegram bot started for %s", tenant.NAME)
+
+async def _warm_sheets(tenant: Settings):
+    """Сессия, OAuth-токен, воркшит и шапка — до первого сохранения, а не во время него."""
+    from .sheets import get_async_sheets
+    from .ratelimit import BACKGROUND
+    try:
+        with PHASES.timed(_phase("sheets_warm", tenant.NAME)):
+            await get_async_sheets().run(lambda sc: sc.header, priority=BACKGROUND)
+    except Exception as e:
+        log.warning("Sheets warm-up failed for %s, first write will retry: %s: %s", tenant.NAME, type(e).__name__, e)
+
+async def _start_tenant(tenant: Settings):
+    from .journal import get_flusher, get_journal
+    from .mirror import get_mirror, get_mirror_sync
+    from .dedupe import get_save_index
+    from .digest import get_digest
+    # задачи, созданные внутри use(), наследуют арендатора
+    with use(tenant.NAME):
+        get_flusher().listeners.append(get_mirror().on_flushed)
+        get_flusher().locator = get_mirror()  # MsgKey → строка для /close и /paid
+        get_journal().listeners.append(get_digest().agg.on_edit)  # правки /close, /paid — в итоги сводки
+        get_flusher().start()
+        get_mirror_sync().start()
+        _spawn(get_save_index().seed_from_sheet())
+        _spawn(get_digest().reconcile())  # бегущие итоги сводки — из зеркала и журнала
+        await asyncio.gather(_start_bot(tenant), _warm_sheets(tenant))
 
-# Telegram
-tg: Application = Application.builder().token(settings.TELEGRAM_BOT_TOKEN).build()
-tg.add_handler(CommandHandler("start", start))
-tg.add_handler(CommandHandler("new", new))
-tg.add_handler(CommandHandler("cancel", cancel))
-tg.add_handler(CommandHandler("save", do_save))         # ручной сейв
-tg.add_handler(CallbackQueryHandler(handle_callback))   # ловим все коллбеки
-tg.add_handler(MessageHandler(filters.TEXT & (~filters.COMMAND), handle_text))
+async def _warm_up():
+    with PHASES.timed("import"):
+        # в потоке: цикл событий тем временем принимает вебхуки
+        await asyncio.to_thread(_import_heavy)
+    await asyncio.gather(*(_start_tenant(t) for t in TENANTS.values()))
+
+def _warm_up_done(task: asyncio.Task):
+    if task.cancelled():
+        return
+    e = task.exception()
+    if e is not None:
+        # без прогрева апдейты ждут ботов вечно: проваливаем health check, чтобы процесс перезапустили
+        PHASES.error = f"{type(e).__name__}: {e}"
+        log.error("warm-up failed, marking the service unhealthy", exc_info=e)
 
 @app.on_event("startup")
 async def on_startup():
-    await tg.initialize()
-    await tg.start()
-    log.info("Telegram bot started")
+    global _warmup
+    if WEBHOOK_MODE == "queue":
+        dispatcher.start()
+    if STARTUP_MODE == "eager":
+        await _warm_up()
+    else:
+        _warmup = asyncio.create_task(_warm_up(), name="warm-up")
+        _warmup.add_done_callback(_warm_up_done)
+    PHASES.mark("accepting")
 
 @app.on_event("shutdown")
 async def on_shutdown():
-    await tg.stop()
-    await tg.shutdown()
+    if _warmup is not None and not _warmup.done():
+        _warmup.cancel()
+        try: await _warmup
+        except asyncio.CancelledError: pass
+    # без ботов очередь разобрать нечем: не ждём её дольше секунды
+    await dispatcher.stop(timeout=20.0 if bots else 1.0)
+    from . import invoices
+    await invoices.drain()  # пока боты и Flusher живы: докачанный счёт успеет попасть в запись
+    from . import digest
+    await digest.stop()
+    for bot in bots.values():
+        await bot.stop()
+        await bot.shutdown()
+    from .journal import all_flushers
+    from .mirror import all_mirror_syncs
+    from .sheets import get_async_sheets
+    for name, sync in all_mirror_syncs().items():
+        await sync.stop()
+    for name, flusher in all_flushers().items():
+        with use(name):  # последний flush пишет в лист своего арендатора
+            await flusher.stop()
+    flush_state()
+    get_async_sheets().shutdown()
+    await invoices.shutdown()
+    from . import capture
+    await asyncio.to_thread(capture.shutdown)
 
 @app.get("/")
 async def root():
@@ -42,7 +219,14 @@ async def root():
 
 @app.get("/healthz")
 async def healthz():
-    return {"ok": True}
+    # ok сразу после старта: пока идёт прогрев, апдейты копятся в очереди; упавший прогрев — 503
+    if PHASES.error:
+        return JSONResponse({"ok": False, "startup": PHASES.as_dict()}, status_code=503)
+    return {"ok": True, "startup": PHASES.as_dict()}
+
+@app.get("/metrics")
+async def metrics():
+    return PlainTextResponse(await asyncio.to_thread(render), media_type="text/plain; version=0.0.4")
 
 # Webhook
 @app.post("/webhook/{secret}")
@@ -51,40 +235,138 @@ async def telegram_webhook(
     secret: str,
     x_telegram_bot_api_secret_token: str = Header(None),
 ):
-    if secret != settings.WEBHOOK_SECRET_TOKEN:
-        raise HTTPException(status_code=403, detail="bad path secret")
+    tenant = _tenant(secret)
     try:
         payload = await request.json()
     except Exception:
         return JSONResponse({"ok": True})
+    if not isinstance(payload, dict):
+        return JSONResponse({"ok": True})  # не Update: как и битый JSON, подтверждаем и забываем
+    # CAPTURE_DIR: для bench.replay; пишем только принятые апдейты, чтобы повтор после 503 не лёг дважды
+    capture = get_capture()
+    if WEBHOOK_MODE == "queue":
+        # отвечаем сразу: Telegram не ждёт Sheets и не шлёт апдейт повторно
+        if not dispatcher.submit(payload, tenant.NAME):
+            return JSONResponse({"ok": False}, status_code=503, headers={"Retry-After": "1"})
+        if capture is not None:
+            capture.record(payload, tenant.NAME)
+        return JSONResponse({"ok": True})
+    if capture is not None:
+        capture.record(payload, tenant.NAME)
     try:
-        update = Update.de_json(payload, tg.bot)
-        await tg.process_update(update)
+        await _process_payload(payload, tenant.NAME)
     except Exception as e:
         log.exception("update error: %s", e)
     return JSONResponse({"ok": True})
 
+@app.get("/report/{secret}")
+async def report_json(secret: str, period: str | None = None):
+    from .reports import get_reports
+    with use(_tenant(secret).NAME):
+        try:
+            # to_thread копирует контекст: в потоке тот же арендатор
+            return await asyncio.to_thread(get_reports().get, period)
+        except ValueError as e:
+            raise HTTPException(status_code=400, detail=str(e))
+
+@app.post("/import/{secret}")
+async def import_upload(request: Request, secret: str, filename: str = "upload.csv"):
+    """Тело запроса — сам файл: curl --data-binary @old.csv '.../import/<secret>?filename=old.csv'."""
+    tenant = _tenant(secret)
+    from .importer import detect_kind, run_import, spool
+    try:
+        kind = detect_kind(filename, request.headers.get("content-type"))
+        path = await spool(request.stream(), kind)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    try:
+        with use(tenant.NAME):
+            rep = await asyncio.to_thread(run_import, path, kind)
+    except (ValueError, RuntimeError) as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    finally:
+        os.remove(path)
+    return rep.as_dict()
+
+@app.get("/export/{secret}")
+async def export(secret: str, request: Request, format: str = "csv", date_from: str | None = None,
+                 date_to: str | None = None, unit: str | None = None):
+    """Выгрузка для бухгалтерии из локального зеркала: ?format=csv|ndjson&date_from=&date_to=&unit=.
+    Повторный запрос с If-None-Match / If-Modified-Since без новых строк — 304 без чтения таблицы."""
+    tenant = _tenant(secret)
+    from .export import FORMATS, STREAMS, ExportQuery, http_date, not_modified
+    from .mirror import get_mirror
+    if format not in FORMATS:
+        raise HTTPException(status_code=400, detail="format must be csv or ndjson")
+    try:
+        query = ExportQuery(date_from, date_to, unit)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    with use(tenant.NAME):
+        mirror = get_mirror()
+    if not mirror.bootstrapped():
+        raise HTTPException(status_code=503, detail="local copy of the sheet is still loading", headers={"Retry-After": "30"})
+    changed_at = mirror.changed_at()
+    headers = {"ETag": query.tag(mirror, format), "Last-Modified": http_date(changed_at), "Cache-Control": "no-cache"}
+    if not_modified(changed_at, headers["ETag"], request.headers.get("if-none-match"), request.headers.get("if-modified-since")):
+        return Response(status_code=304, headers=headers)
+    headers["Content-Disposition"] = f'attachment; filename="{query.filename(format)}"'
+    # синхронный генератор Starlette крутит в пуле потоков: страницы SQLite читаются не на event loop
+    return StreamingResponse(STREAMS[format](query, mirror), media_type=FORMATS[format], headers=headers)
+
+@app.get("/invoices/{tenant}/{signature}/{name}")
+async def invoice_file(tenant: str, signature: str, name: str):
+    """Ссылки из InvoiceLink (см. invoices.link): подпись секретом арендатора, имя — sha256 содержимого."""
+    from .invoices import FILE_NAME, path_of, verify
+    if not FILE_NAME.fullmatch(name) or not verify(tenant, signature, name):
+        raise HTTPException(status_code=403, detail="bad invoice link")
+    if not os.path.exists(path_of(name)):
+        raise HTTPException(status_code=404, detail="not found")
+    return FileResponse(path_of(name), headers={"Cache-Control": "public, max-age=31536000, immutable"})
+
 # --- debug ---
+@app.get("/debug/traces/{secret}")
+async def debug_traces(secret: str, limit: int = 20):
+    """Последние медленные апдейты/пачки (TRACE_SLOW_MS) этого арендатора со спанами по стадиям."""
+    tenant = _tenant(secret)
+    from .tracing import slow_traces
+    return {"traces": slow_traces(limit, tenant.NAME)}
+
+@app.get("/debug/profile/{secret}")
+async def debug_profile(secret: str, seconds: float = 10.0, top: int = 30, sort: str = "cumulative"):
+    """cProfile работающего процесса на seconds секунд (не больше минуты); sort — cumulative | tottime | calls.
+    Профиль общий на все арендаторы, поэтому доступ — по PROFILE_SECRET, а не по секрету арендатора."""
+    from .tracing import PROFILE_SECRET, profile
+    if not PROFILE_SECRET:
+        raise HTTPException(status_code=404, detail="profiling is disabled (set PROFILE_SECRET)")
+    if not hmac.compare_digest(secret.encode(), PROFILE_SECRET.encode()):
+        raise HTTPException(status_code=403, detail="bad path secret")
+    try:
+        return await profile(seconds, top, sort)
+    except RuntimeError as e:
+        raise HTTPException(status_code=409, detail=str(e))
+
 @app.get("/debug/gs-info/{secret}")
 async def gs_info(secret: str):
-    if secret != settings.WEBHOOK_SECRET_TOKEN:
-        raise HTTPException(status_code=403, detail="bad path secret")
-    sc = SheetsClient()
-    header = sc.ws.row_values(1)
-    return {
-        "spreadsheet_title": sc.ws.spreadsheet.title,
-        "worksheet_title": sc.ws.title,
-        "worksheet_gid": getattr(sc.ws, "id", None),
-        "header": header,
-        "cols": len(header),
-    }
+    tenant = _tenant(secret)
+    from .sheets import get_async_sheets
+    def _info(sc):
+        ws, header = sc.ws, sc.header
+        return {
+            "spreadsheet_title": ws.spreadsheet.title,
+            "worksheet_title": ws.title,
+            "worksheet_gid": getattr(ws, "id", None),
+            "header": header,
+            "cols": len(header),
+        }
+    with use(tenant.NAME):
+        return await get_async_sheets().run(_info)
 
 @app.get("/debug/append/{secret}")
 async def gs_append(secret: str):
-    if secret != settings.WEBHOOK_SECRET_TOKEN:
-        raise HTTPException(status_code=403, detail="bad path secret")
+    tenant = _tenant(secret)
     from datetime import datetime as _dt
-    sc = SheetsClient()
+    from .sheets import KNOWN_FIELDS, get_async_sheets
     row = {
         "Date": _dt.utcnow().date().isoformat(),
         "Type": "Test",
@@ -100,6 +382,9 @@ async def gs_append(secret: str):
         "Status": "Open",
         "Notes": "debug",
     }
-    out = [row.get(h, "") for h in sc._header]
-    sc.ws.insert_row(out, index=2, value_input_option="USER_ENTERED")
-    return {"ok": True, "written_to": sc.ws.title, "gid": getattr(sc.ws, "id", None)}
+    def _append(sc):
+        written = sc.append_repair_row([row.get(h, "") for h in KNOWN_FIELDS])
+        ws = sc.ws
+        return {"ok": True, "written_to": ws.title, "gid": getattr(ws, "id", None), "row": written, "mode": sc.write_mode}
+    with use(tenant.NAME):
+        return await get_async_sheets().run(_append)
@@ -0,0 +1,159 @@
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, List, Tuple
+
+# Prometheus text format без внешних зависимостей. Счётчики — голые int без блокировок:
+# из потоков пула Sheets изредка может потеряться инкремент, для метрик это допустимо.
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+_registry: List["_Family"] = []
+
+def _fmt_labels(names: Tuple[str, ...], values: Tuple[str, ...], extra: str = "") -> str:
+    parts = [f'{n}="{v}"' for n, v in zip(names, values)]
+    if extra:
+        parts.append(extra)
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+class _Family:
+    kind = ""
+
+    def __init__(self, name: str, doc: str, labels: Tuple[str, ...] = ()):
+        self.name, self.doc, self.label_names = name, doc, tuple(labels)
+        self._children: Dict[Tuple[str, ...], object] = {}
+        _registry.append(self)
+
+    def labels(self, *values: str):
+        key = tuple(str(v) for v in values)
+        child = self._children.get(key)
+        if child is None:
+            child = self._children.setdefault(key, self._new_child())
+        return child
+
+    def _new_child(self):
+        raise NotImplementedError
+
+    def render(self) -> List[str]:
+        out = [f"# HELP {self.name} {self.doc}", f"# TYPE {self.name} {self.kind}"]
+        for key, child in list(self._children.items()):
+            out.extend(self._render_child(key, child))
+        return out
+
+class _Value:
+    __slots__ = ("value",)
+
+    def __init__(self):
+        self.value = 0.0
+
+    def inc(self, n: float = 1.0):
+        self.value += n
+
+    def dec(self, n: float = 1.0):
+        self.value -= n
+
+    def set(self, v: float):
+        self.value = v
+
+class Counter(_Family):
+    kind = "counter"
+
+    def _new_child(self):
+        return _Value()
+
+    def inc(self, n: float = 1.0):
+        self.labels().inc(n)
+
+    def _render_child(self, key, child):
+        return [f"{self.name}{_fmt_labels(self.label_names, key)} {child.value:g}"]
+
+class Gauge(Counter):
+    kind = "gauge"
+
+    def __init__(self, name: str, doc: str, labels: Tuple[str, ...] = (), fn: Callable[[], object] | None = None):
+        super().__init__(name, doc, labels)
+        self.fn = fn  # значение считается в момент scrape
+
+    def set(self, v: float):
+        self.labels().set(v)
+
+    def dec(self, n: float = 1.0):
+        self.labels().dec(n)
+
+    def render(self) -> List[str]:
+        if self.fn is not None:
+            try:
+                v = self.fn()
+                # fn меченого gauge отдаёт {значение метки: число}
+                for key, x in (v.items() if isinstance(v, dict) else [((), v)]):
+                    self.labels(*((key,) if isinstance(key, str) else key)).set(float(x))
+            except Exception:
+                pass
+        return super().render()
+
+class _Hist:
+    __slots__ = ("bounds", "counts", "sum")
+
+    def __init__(self, bounds: Tuple[float, ...]):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)  # последний — +Inf
+        self.sum = 0.0
+
+    def observe(self, v: float):
+        self.counts[bisect_left(self.bounds, v)] += 1
+        self.sum += v
+
+class Histogram(_Family):
+    kind = "histogram"
+
+    def __init__(self, name: str, doc: str, labels: Tuple[str, ...] = (), buckets: Tuple[float, ...] = LATENCY_BUCKETS):
+        super().__init__(name, doc, labels)
+        self.buckets = tuple(buckets)
+
+    def _new_child(self):
+        return _Hist(self.buckets)
+
+    def observe(self, v: float):
+        self.labels().observe(v)
+
+    def _render_child(self, key, child):
+        out, acc = [], 0
+        for bound, n in zip(self.buckets + (float("inf"),), list(child.counts)):
+            acc += n
+            le = 'le="+Inf"' if bound == float("inf") else 'le="%g"' % bound
+            out.append(f"{self.name}_bucket{_fmt_labels(self.label_names, key, le)} {acc}")
+        out.append(f"{self.name}_sum{_fmt_labels(self.label_names, key)} {child.sum:g}")
+        out.append(f"{self.name}_count{_fmt_labels(self.label_names, key)} {acc}")
+        return out
+
+def render() -> str:
+    lines: List[str] = []
+    for fam in _registry:
+        lines.extend(fam.render())
+    return "\n".join(lines) + "\n"
+
+@contextmanager
+def track(hist: _Hist, errors: _Value | None = None):
+    """Время блока в гистограмму; исключение дополнительно считается в errors."""
+    t0 = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        if errors is not None:
+            errors.inc()
+        raise
+    finally:
+        hist.observe(time.perf_counter() - t0)
+
+# --- метрики приложения ---
+UPDATE_SECONDS = Histogram("repairs_update_seconds", "Time to handle one Telegram update", ("type",))
+STATE_SECONDS = Histogram("repairs_state_seconds", "Time spent in handle_text per conversation state", ("state",))
+SHEETS_SECONDS = Histogram("repairs_sheets_seconds", "Google Sheets call latency", ("op",))
+SHEETS_ERRORS = Counter("repairs_sheets_errors_total", "Failed Google Sheets calls", ("op",))
+SAVES_IN_FLIGHT = Gauge("repairs_saves_in_flight", "do_save calls currently running")
+SAVES = Counter("repairs_saves_total", "Save attempts by outcome", ("result",))
+RATE_WAITS = Counter("repairs_rate_waits_total", "Calls that had to wait for a rate-limit token", ("bucket",))
+RATE_PENALTIES = Counter("repairs_rate_penalties_total", "429 / flood-control responses that slowed a bucket down", ("bucket",))
+DRAFT_EVICTIONS = Counter("repairs_draft_evictions_total", "Drafts dropped: ttl = abandoned and deleted, lru = pushed out of memory", ("reason",))
+CAPTURE_DROPPED = Counter("repairs_capture_dropped_total", "Captured webhook updates dropped because the writer fell behind")
+STARTUP_SECONDS = Gauge("repairs_startup_phase_seconds", "Cold start phases: durations, and accepting/ready since app import", ("phase",))
@@ -0,0 +1,387 @@
+import os
+import re
+import time
+import asyncio
+import hashlib
+import logging
+import threading
+from collections import Counter
+from datetime import date, datetime, timedelta
+from typing import Callable, Dict, Iterable, List
+
+from .db import connect
+from .ratelimit import BACKGROUND
+from .tenants import PerTenant
+from .sheets import KNOWN_FIELDS, SheetsClient, get_async_sheets, get_sheets
+
+log = logging.getLogger("app.mirror")
+
+MIRROR_SYNC_INTERVAL = float(os.getenv("MIRROR_SYNC_INTERVAL", "300"))
+# раз в столько секунд синхронизация перечитывает лист целиком: ручные правки любых колонок, строки без MsgKey
+MIRROR_FULL_SYNC_INTERVAL = float(os.getenv("MIRROR_FULL_SYNC_INTERVAL", "3600"))
+
+# поле листа → колонка зеркала
+COLUMNS = {
+    "Date": "date", "Type": "type", "Unit": "unit", "Category": "category", "Repair": "repair",
+    "Details": "details", "Vendor": "vendor", "Total": "total", "Paid By": "paid_by", "Paid?": "paid",
+    "Reported By": "reported_by", "Status": "status", "Notes": "notes", "InvoiceLink": "invoice_link",
+    "MsgKey": "msg_key", "CreatedAt": "created_at",
+}
+# что в листе правят руками после сохранения и от чего зависят отчёты и сводка;
+# эти колонки сверяем при каждой синхронизации, остальные — полным перечитыванием
+MUTABLE = ("Date", "Unit", "Vendor", "Total", "Status", "Paid?")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS repairs (
+    key TEXT PRIMARY KEY,
+    sheet_row INTEGER,
+    date TEXT, type TEXT, unit TEXT, unit_key TEXT, category TEXT, repair TEXT, details TEXT,
+    vendor TEXT, total REAL, paid_by TEXT, paid TEXT, reported_by TEXT, status TEXT, notes TEXT,
+    invoice_link TEXT, msg_key TEXT, created_at TEXT
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS repairs_unit ON repairs(unit_key, date);
+-- покрывающий: /report агрегирует по периоду, не трогая саму таблицу
+CREATE INDEX IF NOT EXISTS repairs_date ON repairs(date, total, paid, unit_key, category, paid_by);
+CREATE INDEX IF NOT EXISTS repairs_category ON repairs(category, date);
+CREATE INDEX IF NOT EXISTS repairs_status ON repairs(status);
+-- /export идёт страницами по (date, key)
+CREATE INDEX IF NOT EXISTS repairs_export ON repairs(date, key);
+CREATE TABLE IF NOT EXISTS meta (k TEXT PRIMARY KEY, v TEXT);
+"""
+
+_SHEETS_EPOCH = date(1899, 12, 30)
+
+def iso_date(v) -> str:
+    """Дата из листа: серийный номер (UNFORMATTED_VALUE), ISO или M/D/YYYY → YYYY-MM-DD."""
+    if isinstance(v, (int, float)) and not isinstance(v, bool):
+        return (_SHEETS_EPOCH + timedelta(days=int(v))).isoformat()
+    t = str(v or "").strip()
+    for fmt in ("%Y-%m-%d", "%m/%d/%Y", "%d.%m.%Y"):
+        try:
+            return datetime.strptime(t, fmt).date().isoformat()
+        except ValueError:
+            pass
+    return t
+
+def to_amount(v) -> float | None:
+    if isinstance(v, (int, float)) and not isinstance(v, bool):
+        return float(v)
+    t = str(v or "").replace("$", "").replace(",", "").strip()
+    try:
+        return float(t) if t else None
+    except ValueError:
+        return None
+
+def unit_key(unit: str) -> str:
+    """'TRK 2621' / 'trk2621' → 'TRK 2621'; у прицепа — 'TRL 88' без привязанного тягача."""
+    t = re.sub(r"\(.*\)", "", str(unit or "")).upper()
+    m = re.match(r"\s*(TRK|TRL)\s*(\S+)", t)
+    return f"{m.group(1)} {m.group(2)}" if m else " ".join(t.split())
+
+def _checked(rec: Dict[str, object]) -> tuple:
+    """Колонки MUTABLE в том виде, в каком их хранит зеркало."""
+    d, u, v, t, st, p = (rec.get(name, "") for name in MUTABLE)
+    return iso_date(d), str(u), str(v), to_amount(t), str(st), str(p)
+
+class _ManualKeys:
+    """Ключи строк, внесённых руками без MsgKey: по колонкам MUTABLE и номеру среди одинаковых строк.
+    От номера строки не зависят: пачка, вставленная над ними (режим insert), ключи не меняет,
+    а правка или удаление такой строки видны синхронизации как смена ключа."""
+
+    def __init__(self):
+        self._seen: Counter = Counter()
+
+    def __call__(self, checked: tuple) -> str:
+        h = hashlib.blake2b(repr(checked).encode(), digest_size=8).hexdigest()
+        n = self._seen[h]
+        self._seen[h] += 1
+        return f"row:{h}:{n}"
+
+def _keys(recs: Iterable[Dict[str, object]]) -> List[str]:
+    """Ключи зеркала для записей листа, идущих по порядку строк."""
+    manual = _ManualKeys()
+    return [str(rec.get("MsgKey") or "").strip() or manual(_checked(rec)) for rec in recs]
+
+_INSERT = "INSERT OR REPLACE INTO repairs VALUES ({})".format(",".join("?" * (len(COLUMNS) + 3)))
+
+class Mirror:
+    """Локальная SQLite-копия листа ремонтов для запросов без Google API."""
+
+    def __init__(self, name: str = "mirror.sqlite3"):
+        self._db = connect(name)
+        self._db.executescript(_SCHEMA)
+        self._lock = threading.Lock()
+        self.generation = 0  # растёт при каждом изменении; по нему сбрасываются кеши отчётов
+        self.synced_at = 0.0
+        # пачки Flusher'а (сдвиг, строки), записанные, пока синхронизация читает лист; None — не читает
+        self._flushes: List[tuple] | None = None
+        # ключи, которые синхронизация уже увидела в листе и вот-вот дочитает (см. sync)
+        self._reading: set = set()
+
+    def _stamp(self):
+        # внутри транзакции записи: момент последнего изменения содержимого — для ETag/Last-Modified /export
+        self._db.execute("INSERT OR REPLACE INTO meta(k, v) VALUES ('changed_at', ?)", (repr(time.time()),))
+
+    def changed_at(self) -> float:
+        return float(self._meta("changed_at") or 0.0)
+
+    def bootstrapped(self) -> bool:
+        return self._meta("bootstrapped") is not None
+
+    def _row(self, key: str, sheet_row, rec: Dict[str, object]) -> tuple:
+        vals = {col: rec.get(name, "") for name, col in COLUMNS.items()}
+        vals["date"] = iso_date(vals["date"])
+        vals["total"] = to_amount(vals["total"])
+        return (key, sheet_row, vals["date"], str(vals["type"]), str(vals["unit"]), unit_key(vals["unit"]),
+                str(vals["category"]), str(vals["repair"]), str(vals["details"]), str(vals["vendor"]), vals["total"],
+                str(vals["paid_by"]), str(vals["paid"]), str(vals["reported_by"]), str(vals["status"]),
+                str(vals["notes"]), str(vals["invoice_link"]), str(vals["msg_key"]), str(vals["created_at"]))
+
+    def _write(self, fn: Callable):
+        """fn(db) одной транзакцией с отметкой изменения; при ошибке — откат, зеркало остаётся прежним.
+        fn вернул False — менять было нечего, отметки нет. Возвращает результат fn."""
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                result = fn(self._db)
+                if result is not False:
+                    self._stamp()
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            if result is not False:
+                self.generation += 1
+        return result
+
+    @staticmethod
+    def _shift(db, n: int, from_row: int = 2):
+        """Вставка n строк под шапку сдвигает все известные номера строк вниз."""
+        db.execute("UPDATE repairs SET sheet_row = sheet_row + ? WHERE sheet_row >= ?", (n, from_row))
+
+    def _unseen(self, read_keys: set) -> List[tuple]:
+        """Пачки Flusher'а, легшие в лист уже после чтения синхронизацией (под замком). Пачка пишется одним
+        запросом, поэтому чтение видит её целиком или не видит вовсе."""
+        return [(n, rows) for n, rows in self._flushes or () if not any(r[0] in read_keys for r in rows)]
+
+    def replace_all(self, records: Iterable[tuple]):
+        """Полное перечитывание листа: содержимое зеркала заменяется целиком одной транзакцией. Пачки,
+        записанные после чтения, накладываются сверху заново — как их положил on_flushed."""
+        records = list(records)
+        rows = [self._row(key, sheet_row, rec) for key, (sheet_row, rec) in zip(_keys(rec for _, rec in records), records)]
+
+        def _replace(db):
+            db.execute("DELETE FROM repairs")
+            db.executemany(_INSERT, rows)
+            for n, batch in self._unseen({r[0] for r in rows}):
+                if n:
+                    self._shift(db, n)
+                db.executemany(_INSERT, batch)
+        self._write(_replace)
+
+    def locate(self, keys: List[str]) -> Dict[str, int]:
+        """MsgKey → текущий номер строки в листе (держится on_flushed и синхронизацией, без чтения колонки)."""
+        out: Dict[str, int] = {}
+        with self._lock:
+            for i in range(0, len(keys), 500):
+                part = keys[i:i + 500]
+                out.update(self._db.execute(
+                    f"SELECT key, sheet_row FROM repairs WHERE key IN ({','.join('?' * len(part))}) "
+                    f"AND sheet_row IS NOT NULL", part).fetchall())
+        return out
+
+    def on_edited(self, done: Dict[str, Dict[str, str]]):
+        """Хук Flusher'а после batch_update: те же поля в зеркале, чтобы /history и отчёты видели правку сразу."""
+        rows = [(COLUMNS[name], value, key) for key, fields in done.items() for name, value in fields.items()
+                if name in COLUMNS and name not in ("Date", "Total", "Unit", "MsgKey")]
+        if not rows:
+            return
+
+        def _edit(db):
+            for col, value, key in rows:
+                db.execute(f"UPDATE repairs SET {col}=? WHERE key=?", (value, key))
+        self._write(_edit)
+
+    def version(self) -> tuple:
+        """Меняется при любой записи в зеркало, в том числе из другого воркера (PRAGMA data_version)."""
+        with self._lock:
+            return self.generation, self._db.execute("PRAGMA data_version").fetchone()[0]
+
+    def query(self, sql: str, params: tuple = ()) -> List[tuple]:
+        with self._lock:
+            return self._db.execute(sql, params).fetchall()
+
+    def _meta(self, k: str) -> str | None:
+        with self._lock:
+            r = self._db.execute("SELECT v FROM meta WHERE k=?", (k,)).fetchone()
+        return r[0] if r else None
+
+    def _set_meta(self, k: str, v: str):
+        with self._lock:
+            self._db.execute("INSERT OR REPLACE INTO meta(k, v) VALUES (?, ?)", (k, v))
+
+    def count(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM repairs").fetchone()[0]
+
+    def history(self, unit: str, limit: int = 10) -> List[Dict[str, object]]:
+        key = unit_key(unit)
+        keys = [key] if " " in key else [f"TRK {key}", f"TRL {key}"]
+        with self._lock:
+            cur = self._db.execute(
+                f"SELECT date, unit, category, repair, vendor, total, status, paid FROM repairs "
+                f"WHERE unit_key IN ({','.join('?' * len(keys))}) ORDER BY date DESC, created_at DESC LIMIT ?",
+                (*keys, limit),
+            )
+            cols = [c[0] for c in cur.description]
+            return [dict(zip(cols, r)) for r in cur.fetchall()]
+
+    # --- синхронизация с листом ---
+    def on_flushed(self, rows: List[List[str]], sheet_rows: List[int]):
+        """Хук Flusher'а: только что записанные строки кладём сразу, без чтения из Google.
+        В режиме insert пачка встала под шапку: сдвиг остальных строк и вставка — одной транзакцией."""
+        shift = len(rows) if get_sheets().write_mode == "insert" else 0
+        recs = [dict(zip(KNOWN_FIELDS, row)) for row in rows]
+        batch = [self._row(key, r, rec) for key, r, rec in zip(_keys(recs), sheet_rows, recs)]
+
+        def _apply(db):
+            keys = [r[0] for r in batch]
+            if self._reading.intersection(keys) or db.execute(
+                    f"SELECT 1 FROM repairs WHERE key IN ({','.join('?' * len(keys))}) LIMIT 1", keys).fetchone():
+                return False  # синхронизация уже прочитала лист с этой пачкой: её номера строк новее
+            if shift:
+                self._shift(db, shift)
+            db.executemany(_INSERT, batch)
+            if self._flushes is not None:
+                self._flushes.append((shift, batch))
+        if batch:
+            self._write(_apply)
+
+    def sync(self, sc: SheetsClient) -> int:
+        """Первый раз и раз в MIRROR_FULL_SYNC_INTERVAL — лист целиком; между ними — колонки MsgKey и MUTABLE,
+        целиком читаются только новые строки и изменившиеся строки без MsgKey."""
+        # флаг, а не count(): Flusher мог положить свежие строки раньше первой синхронизации
+        full_at = float(self._meta("full_synced_at") or self._meta("bootstrapped") or 0.0)
+        with self._lock:
+            self._flushes = []  # пачки Flusher'а с этого момента: чтение листа может их не увидеть
+        try:
+            if not self._meta("bootstrapped") or time.time() - full_at >= MIRROR_FULL_SYNC_INTERVAL:
+                return self._sync_full(sc)
+            return self._sync_changes(sc)
+        finally:
+            with self._lock:
+                self._flushes = None
+                self._reading = set()
+
+    def _sync_full(self, sc: SheetsClient) -> int:
+        recs = sc.read_all()
+        self.replace_all((i + 2, rec) for i, rec in enumerate(recs) if any(str(v).strip() for v in rec.values()))
+        now = str(time.time())
+        self._set_meta("full_synced_at", now)
+        if not self._meta("bootstrapped"):
+            self._set_meta("bootstrapped", now)
+        self.synced_at = time.time()
+        return len(recs)
+
+    def _sync_changes(self, sc: SheetsClient) -> int:
+        cols = sc.read_columns(("MsgKey",) + MUTABLE)
+        cell = lambda name, i: cols[name][i] if i < len(cols[name]) else ""
+        # пустые хвосты колонок Sheets не отдаёт: строк столько, сколько в самой длинной
+        n = max(len(v) for v in cols.values())
+        manual = _ManualKeys()
+        read = []  # (номер строки, ключ, колонки MUTABLE)
+        for i in range(n):
+            rec = {name: cell(name, i) for name in MUTABLE}
+            key = str(cell("MsgKey", i) or "").strip()
+            if not key:
+                if not any(str(v).strip() for v in rec.values()):
+                    continue  # пустая строка в середине листа
+                key = manual(_checked(rec))  # ручная строка с новым содержимым получит новый ключ
+            read.append((i + 2, key, _checked(rec)))
+
+        new_rows: List[tuple] = []  # (номер строки сейчас, ключ) — дочитать целиком
+
+        def _apply(db):
+            read_keys = {k for _, k, _ in read}
+            unseen = self._unseen(read_keys)
+            # пачки, вставленные под шапку после чтения, сдвинули прочитанные строки; сами они уже в зеркале
+            shift = sum(n for n, _ in unseen)
+            fresh = {r[0] for _, rows in unseen for r in rows}
+            known = {k: tuple(v) for k, *v in db.execute(
+                "SELECT key, sheet_row, date, unit, vendor, total, status, paid FROM repairs")}
+            moved = []
+            for row, key, checked in read:
+                cur = (row + shift,) + checked
+                have = known.get(key)
+                if have == cur:
+                    continue
+                if have is None:
+                    new_rows.append((row + shift, key))
+                else:
+                    moved.append((cur[0], cur[1], cur[2], unit_key(cur[2]), cur[3], cur[4], cur[5], cur[6], key))
+            gone = [(k,) for k in known.keys() - read_keys - fresh]  # строки удалили из листа
+            db.executemany("UPDATE repairs SET sheet_row=?, date=?, unit=?, unit_key=?, vendor=?, total=?, status=?, "
+                           "paid=? WHERE key=?", moved)
+            db.executemany("DELETE FROM repairs WHERE key=?", gone)
+            self._reading = {k for _, k in new_rows}
+            mark.append(len(self._flushes))
+            return len(moved) + len(gone) or False
+        mark: List[int] = []
+        changed = self._write(_apply) or 0
+        if new_rows:
+            got = sc.read_rows([r for r, _ in new_rows])
+            checked = {k: c for _, k, c in read}
+
+            def _fill(db):
+                # пачка, вставленная под шапку до read_rows, сдвигает строки: содержимое не совпадёт, строка
+                # дочитается следующей синхронизацией; вставленная после — сдвигаем номер, как on_flushed
+                shift = sum(n for n, _ in self._flushes[mark[0]:])
+                rows = [self._row(key, r + shift, got[r]) for r, key in new_rows if r in got
+                        and str(got[r].get("MsgKey") or "").strip() in ("", key) and _checked(got[r]) == checked[key]]
+                db.executemany(_INSERT, rows)
+                return bool(rows)
+            self._write(_fill)
+        self.synced_at = time.time()
+        return len(new_rows) + changed
+
+class MirrorSync:
+    """Фоновая синхронизация зеркала раз в MIRROR_SYNC_INTERVAL."""
+
+    def __init__(self, mirror: Mirror):
+        self.mirror = mirror
+        self._task: asyncio.Task | None = None
+
+    async def sync_once(self) -> int:
+        return await get_async_sheets().run(lambda sc: self.mirror.sync(sc), timeout=120, priority=BACKGROUND)
+
+    async def _run(self):
+        while True:
+            try:
+                n = await self.sync_once()
+                if n: log.info("mirror synced: %d rows changed", n)
+            except Exception as e:
+                log.warning("mirror sync failed: %s: %s", type(e).__name__, e)
+            await asyncio.sleep(MIRROR_SYNC_INTERVAL)
+
+    def start(self):
+        if self._task is None:
+            self._task = asyncio.create_task(self._run(), name="mirror-sync")
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            try: await self._task
+            except asyncio.CancelledError: pass
+            self._task = None
+
+_mirrors: PerTenant[Mirror] = PerTenant(lambda t: Mirror(t.data_name("mirror.sqlite3")))
+_syncs: PerTenant[MirrorSync] = PerTenant(lambda t: MirrorSync(get_mirror()))
+
+def get_mirror() -> Mirror:
+    return _mirrors.get()
+
+def get_mirror_sync() -> MirrorSync:
+    return _syncs.get()
+
+def all_mirror_syncs() -> Dict[str, MirrorSync]:
+    return _syncs.items()
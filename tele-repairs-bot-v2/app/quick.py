@@ -0,0 +1,186 @@
+import re
+from typing import Dict, List, Tuple
+
+from .mirror import iso_date
+from .validators import normalize_date, normalize_amount
+
+# Быстрый ввод одним сообщением. Два формата:
+#   2025-03-02 TRK 2621 Tires "replace steer" Loves 412.50 Company No Open
+#   Date: 2025-03-02 / Unit: TRL 55 (TRK 2621) / Total: 412.50 … — по полю на строке
+# Модуль чистый: списки вариантов передаёт bot_flow, здесь только разбор и проверка.
+
+UNIT_WORDS = {"trk": "TRK", "truck": "TRK", "trl": "TRL", "trailer": "TRL"}
+_UNIT_GLUED = re.compile(r"(trk|trl|truck|trailer)#?(\w*\d\w*)", re.I)
+# "..." и «ёлочки» Telegram; одиночные кавычки не трогаем — Love's
+_TOKEN = re.compile(r'"([^"]*)"|“([^”]*)”|«([^»]*)»|(\S+)')
+_KV_LINE = re.compile(r"\s*([A-Za-z][A-Za-z ?/]*?)\s*:\s*(.*)")
+
+# порядок важен: неоднозначное слово ("Other") достаётся первому незаполненному полю
+CHOICE_FIELDS = ("Category", "Type", "Paid By", "Paid?", "Status")
+FREE_FIELDS = ("Repair", "Details", "Vendor", "Reported By", "Notes")
+
+def _norm(name: str) -> str:
+    return re.sub(r"[^a-z0-9]", "", name.lower())
+
+_KEYS = {_norm(f): f for f in ("Date", "Type", "Unit", "Total") + CHOICE_FIELDS + FREE_FIELDS}
+_KEYS.update({"amount": "Total", "cost": "Total", "truck": "Unit", "trailer": "Unit", "shop": "Vendor",
+              "by": "Reported By", "reporter": "Reported By", "note": "Notes", "title": "Repair"})
+
+def _tokens(text: str) -> List[Tuple[str, bool]]:
+    """(токен, был ли в кавычках): текст в кавычках — всегда одно свободное значение."""
+    out = []
+    for m in _TOKEN.finditer(text):
+        quoted = next((g for g in m.groups()[:3] if g is not None), None)
+        out.append((quoted.strip(), True) if quoted is not None else (m.group(4), False))
+    return out
+
+def _date(v: str) -> str | None:
+    return normalize_date(iso_date(v)) if v else None
+
+def _amount(v: str) -> str | None:
+    t = v.strip()
+    return normalize_amount(t[1:] if t.startswith("$") else t) if any(c.isdigit() for c in t) else None
+
+def _unit(words: List[str], i: int) -> Tuple[Dict[str, str], int]:
+    """Номер юнита с позиции i: TRK 2621 / TRK2621 / TRL 55 (TRK 2621). Возвращает (поля, сколько слов съедено)."""
+    w = words[i].strip("()")
+    m = _UNIT_GLUED.fullmatch(w)
+    if m:
+        kind, num, n = UNIT_WORDS[m.group(1).lower()], m.group(2), 1
+    elif w.lower() in UNIT_WORDS and i + 1 < len(words) and re.search(r"\d", words[i + 1]):
+        kind, num, n = UNIT_WORDS[w.lower()], words[i + 1].strip("()#"), 2
+    else:
+        return {}, 0
+    if kind == "TRK":
+        return {"UnitType": "TRK", "Unit": f"TRK {num}"}, n
+    out = {"UnitType": "TRL", "TrailerNum": num}
+    # у прицепа тягач: следом TRK 2621 или (TRK 2621); без него спросим отдельно
+    if i + n < len(words):
+        linked, k = _unit(words, i + n)
+        if linked.get("UnitType") == "TRK":
+            out["Unit"] = f"TRL {num} ( {linked['Unit']} )"
+            n += k
+    return out, n
+
+def _choice(v: str, choices: List[str]) -> str | None:
+    t = v.strip().lower()
+    return next((c for c in choices if c.lower() == t), None)
+
+def _set(form: Dict[str, str], field: str, value: str, choices: Dict[str, List[str]], errors: List[str]):
+    value = value.strip()
+    if not value:
+        return
+    if field == "Date":
+        v = _date(value)
+    elif field == "Total":
+        v = _amount(value)
+    elif field == "Unit":
+        words = value.split()
+        unit, n = _unit(words, 0) if words else ({}, 0)
+        if unit and n == len(words):
+            form.update(unit)
+            return
+        v = None
+    elif field == "Type":
+        v = _choice(value, choices["Type"]) or value  # в анкете Type — свободный текст с подсказками
+    elif field in CHOICE_FIELDS:
+        v = _choice(value, choices[field])
+    else:
+        v = value
+    if v is None:
+        errors.append(f"{field}: can't read {value!r}")
+    else:
+        form[field] = v
+
+def _parse_block(lines: List[str], choices, errors) -> Dict[str, str]:
+    form: Dict[str, str] = {}
+    field = None
+    for line in lines:
+        m = _KV_LINE.fullmatch(line)
+        key = _KEYS.get(_norm(m.group(1))) if m else None
+        if key:
+            field = key
+            _set(form, field, m.group(2), choices, errors)
+        elif field in FREE_FIELDS and line.strip():
+            # продолжение многострочного Details/Notes
+            form[field] = f"{form.get(field, '')}\n{line.strip()}".strip()
+        elif line.strip():
+            errors.append(f"can't read line {line.strip()!r}")
+    return form
+
+def _parse_line(text: str, choices) -> Dict[str, str]:
+    toks = _tokens(text)
+    words = [t for t, _ in toks]
+    form: Dict[str, str] = {}
+    pos: Dict[str, int] = {}     # поле → номер фразы, перед которой оно стояло
+    phrases: List[str] = []      # свободный текст; слова без кавычек подряд склеиваются в одну фразу
+    quoted_at: set = set()       # номера фраз, пришедших в кавычках
+    glue = False
+    i = 0
+    while i < len(toks):
+        tok, quoted = toks[i]
+        n, got = 1, {}
+        if not quoted:
+            if "Date" not in form and _date(tok):
+                got = {"Date": _date(tok)}
+            elif "Unit" not in form and "TrailerNum" not in form:
+                got, n = _unit(words, i)
+                n = n or 1
+            if not got:
+                for span in (2, 1):  # "PM Service", "In Progress", "On Hold"
+                    v = " ".join(words[i:i + span]) if i + span <= len(toks) else ""
+                    if span == 2 and toks[i + 1:i + 2] and toks[i + 1][1]:
+                        continue
+                    f = next((f for f in CHOICE_FIELDS if f not in form and _choice(v, choices[f])), None)
+                    if v and f:
+                        got, n = {f: _choice(v, choices[f])}, span
+                        break
+            if not got and "Total" not in form and _amount(tok):
+                got = {"Total": _amount(tok)}
+        if got:
+            for k in got:
+                pos.setdefault(k, len(phrases))
+            form.update(got)
+            glue = False
+        elif glue and not quoted:
+            phrases[-1] += " " + tok
+        else:
+            if quoted:
+                quoted_at.add(len(phrases))
+            phrases.append(tok)
+            glue = not quoted
+        i += n
+
+    # до суммы: Repair [, Details…], Vendor; после суммы: до Status — Reported By, потом Notes.
+    # Одна фраза без кавычек перед суммой: последнее слово — мастерская, остальное — ремонт
+    # (replace steer tires Loves 412.50); одно слово — только мастерская, ремонт спросим
+    cut = pos.get("Total", len(phrases))
+    head, tail = phrases[:cut], phrases[cut:]
+    if len(head) == 1 and 0 not in quoted_at:
+        head = head[0].rsplit(" ", 1)
+    if len(head) == 1 and 0 not in quoted_at:
+        form["Vendor"] = head[0]
+    elif head:
+        form["Repair"] = head[0]
+    if len(head) > 2:
+        form["Details"] = "\n".join(head[1:-1])
+    if len(head) > 1:
+        form["Vendor"] = head[-1]
+    status_at = pos.get("Status", -1) - cut
+    by, notes = (tail[:status_at], tail[status_at:]) if status_at > 0 else ([], tail)
+    if by:
+        form["Reported By"] = " ".join(by)
+    if notes:
+        form["Notes"] = " ".join(notes)
+    return form
+
+def parse(text: str, choices: Dict[str, List[str]]) -> Tuple[Dict[str, str], List[str]]:
+    """Сообщение → (поля анкеты, ошибки). Нераспознанное просто не заполняется — бот спросит это поле."""
+    errors: List[str] = []
+    lines = [l for l in (text or "").strip().splitlines() if l.strip()]
+    if not lines:
+        return {}, errors
+    m = _KV_LINE.fullmatch(lines[0])
+    if m and _norm(m.group(1)) in _KEYS:
+        return _parse_block(lines, choices, errors), errors
+    return _parse_line(" ".join(lines), choices), errors
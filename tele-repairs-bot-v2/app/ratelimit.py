@@ -0,0 +1,117 @@
+import os
+import time
+import asyncio
+import threading
+from contextvars import ContextVar
+from typing import Dict
+
+from .metrics import RATE_WAITS, RATE_PENALTIES, Gauge
+
+# Telegram: сообщений в секунду на бота; 0 — без ограничения (ведро на чат — в app.tglimit)
+TG_RATE_GLOBAL = float(os.getenv("TG_RATE_GLOBAL", "30"))
+# Sheets API: запросов в минуту на сервисный аккаунт (квота Google — 60 чтений и 60 записей)
+SHEETS_READS_PER_MIN = float(os.getenv("SHEETS_READS_PER_MIN", "60"))
+SHEETS_WRITES_PER_MIN = float(os.getenv("SHEETS_WRITES_PER_MIN", "60"))
+# доля запаса ведра, которую фоновая работа не трогает: он остаётся ответам пользователям
+RATE_BACKGROUND_RESERVE = float(os.getenv("RATE_BACKGROUND_RESERVE", "0.5"))
+# после 429 скорость ведра падает вдвое и линейно возвращается к базовой за это время
+RATE_RECOVER_SECONDS = 60.0
+
+USER, BACKGROUND = 0, 1
+# приоритет текущего вызова Sheets; выставляется в потоке пула (см. AsyncSheets.run)
+PRIORITY: ContextVar[int] = ContextVar("rate_priority", default=USER)
+
+class Throttled(Exception):
+    """Ждать токен пришлось бы дольше max_wait: вызывающий отступает и повторяет позже."""
+
+    def __init__(self, bucket: str, retry_after: float):
+        super().__init__(f"{bucket} rate limit, retry in {retry_after:.1f}s")
+        self.bucket, self.retry_after = bucket, retry_after
+
+class TokenBucket:
+    """Ведро токенов с адаптивной скоростью. Годится и для потоков (wait), и для event loop (take)."""
+
+    def __init__(self, name: str, rate: float, burst: float, reserve: float = RATE_BACKGROUND_RESERVE):
+        self.name = name
+        self.base_rate = self.rate = rate
+        self.burst = max(1.0, burst)
+        self.reserve = reserve
+        self.tokens = self.burst
+        self._t = time.monotonic()
+        self._paused_until = 0.0
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        dt, self._t = now - self._t, now
+        if self.rate < self.base_rate:
+            self.rate = min(self.base_rate, self.rate + self.base_rate * dt / RATE_RECOVER_SECONDS)
+        self.tokens = min(self.burst, self.tokens + dt * self.rate)
+
+    def try_take(self, priority: int = USER) -> float:
+        """0 — токен взят; иначе сколько секунд подождать до следующей попытки."""
+        now = time.monotonic()
+        with self._lock:
+            if now < self._paused_until:
+                return self._paused_until - now
+            if self.base_rate <= 0:
+                return 0.0
+            self._refill(now)
+            floor = self.burst * self.reserve if priority == BACKGROUND else 0.0
+            if self.tokens - 1.0 >= floor:
+                self.tokens -= 1.0
+                return 0.0
+            return (floor + 1.0 - self.tokens) / self.rate
+
+    def penalize(self, pause: float):
+        """Сервер ответил 429: пауза на pause секунд и половина скорости."""
+        now = time.monotonic()
+        with self._lock:
+            if self.base_rate > 0:
+                self._refill(now)
+                self.rate = max(self.base_rate * 0.1, self.rate / 2)
+                self.tokens = 0.0
+            self._paused_until = max(self._paused_until, now + pause)
+        RATE_PENALTIES.labels(self.name).inc()
+
+    def wait(self, priority: int = USER, max_wait: float | None = None):
+        waited = 0.0
+        while True:
+            w = self.try_take(priority)
+            if not w:
+                return
+            if max_wait is not None and waited + w > max_wait:
+                raise Throttled(self.name, w)
+            if not waited:
+                RATE_WAITS.labels(self.name).inc()
+            time.sleep(w)
+            waited += w
+
+    async def take(self, priority: int = USER):
+        waited = False
+        while True:
+            w = self.try_take(priority)
+            if not w:
+                return
+            if not waited:
+                RATE_WAITS.labels(self.name).inc()
+                waited = True
+            await asyncio.sleep(w)
+
+    def budget(self) -> float:
+        """Доля свободного запаса: 1 — ведро полное, 0 — всё израсходовано."""
+        with self._lock:
+            if self.base_rate > 0:
+                self._refill(time.monotonic())
+            return self.tokens / self.burst
+
+# общие вёдра процесса; по ним же отдаются метрики
+BUCKETS: Dict[str, TokenBucket] = {
+    "telegram": TokenBucket("telegram", TG_RATE_GLOBAL, TG_RATE_GLOBAL),
+    "sheets_read": TokenBucket("sheets_read", SHEETS_READS_PER_MIN / 60, SHEETS_READS_PER_MIN / 6),
+    "sheets_write": TokenBucket("sheets_write", SHEETS_WRITES_PER_MIN / 60, SHEETS_WRITES_PER_MIN / 6),
+}
+
+Gauge("repairs_rate_budget", "Free share of a rate-limit bucket (1 = full)", ("bucket",),
+      fn=lambda: {k: b.budget() for k, b in BUCKETS.items()})
+Gauge("repairs_rate_per_second", "Current adaptive rate of a bucket, lowered after 429", ("bucket",),
+      fn=lambda: {k: b.rate for k, b in BUCKETS.items()})
@@ -0,0 +1,85 @@
+import re
+import threading
+from collections import OrderedDict
+from datetime import date
+from typing import Dict, List, Tuple
+
+from .mirror import Mirror, get_mirror
+from .tenants import PerTenant
+
+_PERIOD = re.compile(r"(\d{4})(?:-(\d{2}))?")
+_CACHE_SIZE = 64
+
+def period_bounds(period: str | None) -> Tuple[str, str, str]:
+    """'2025-03' → месяц, '2025' → год, пусто → текущий месяц. Возвращает (period, from, to) — to не включается."""
+    if not period:
+        period = date.today().strftime("%Y-%m")
+    m = _PERIOD.fullmatch(period.strip())
+    if not m:
+        raise ValueError("period must be YYYY-MM or YYYY")
+    y = int(m.group(1))
+    if m.group(2) is None:
+        return period, f"{y:04d}-01-01", f"{y + 1:04d}-01-01"
+    mo = int(m.group(2))
+    if not 1 <= mo <= 12:
+        raise ValueError("month must be 01..12")
+    nxt = (y + 1, 1) if mo == 12 else (y, mo + 1)
+    return period, f"{y:04d}-{mo:02d}-01", f"{nxt[0]:04d}-{nxt[1]:02d}-01"
+
+# одна агрегация SQLite по индексу repairs_date на каждую группировку
+_ROLLUP = ("SELECT {col}, COUNT(*), ROUND(SUM(COALESCE(total, 0)), 2), "
+           "ROUND(SUM(CASE WHEN paid = 'Yes' THEN 0 ELSE COALESCE(total, 0) END), 2) "
+           "FROM repairs WHERE date >= ? AND date < ? GROUP BY {col} ORDER BY 3 DESC")
+GROUPS = {"by_unit": "unit_key", "by_category": "category", "by_paid_by": "paid_by"}
+
+def build_report(mirror: Mirror, period: str | None = None) -> Dict[str, object]:
+    period, lo, hi = period_bounds(period)
+    rep: Dict[str, object] = {"period": period, "from": lo, "to": hi}
+    for name, col in GROUPS.items():
+        rep[name] = [{"key": k or "—", "count": n, "total": t or 0.0, "unpaid": u or 0.0}
+                     for k, n, t, u in mirror.query(_ROLLUP.format(col=col), (lo, hi))]
+    units = rep["by_unit"]
+    rep["count"] = sum(r["count"] for r in units)
+    rep["total"] = round(sum(r["total"] for r in units), 2)
+    rep["unpaid"] = round(sum(r["unpaid"] for r in units), 2)
+    return rep
+
+class ReportCache:
+    """Отчёты по периодам; запись живёт, пока не изменилось зеркало (Mirror.version)."""
+
+    def __init__(self, mirror: Mirror):
+        self.mirror = mirror
+        self._items: "OrderedDict[str, tuple]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, period: str | None = None) -> Dict[str, object]:
+        key = period_bounds(period)[0]
+        ver = self.mirror.version()
+        with self._lock:
+            hit = self._items.get(key)
+            if hit and hit[0] == ver:
+                self._items.move_to_end(key)
+                return hit[1]
+        rep = build_report(self.mirror, key)
+        with self._lock:
+            self._items[key] = (ver, rep)
+            self._items.move_to_end(key)
+            while len(self._items) > _CACHE_SIZE:
+                self._items.popitem(last=False)
+        return rep
+
+def render_report(rep: Dict[str, object], top: int = 10) -> str:
+    def block(title: str, rows: List[dict]) -> str:
+        lines = [f"  {r['key']}: {r['total']:.2f} ({r['count']})" + (f", unpaid {r['unpaid']:.2f}" if r["unpaid"] else "")
+                 for r in rows[:top]]
+        more = f"\n  … +{len(rows) - top} more" if len(rows) > top else ""
+        return f"{title}:\n" + ("\n".join(lines) or "  —") + more
+    return (f"Report {rep['period']}: {rep['count']} repairs, total {rep['total']:.2f}, unpaid {rep['unpaid']:.2f}\n\n"
+            + block("By unit", rep["by_unit"]) + "\n\n"
+            + block("By category", rep["by_category"]) + "\n\n"
+            + block("By paid by", rep["by_paid_by"]))
+
+_caches: PerTenant[ReportCache] = PerTenant(lambda t: ReportCache(get_mirror()))
+
+def get_reports() -> ReportCache:
+    return _caches.get()
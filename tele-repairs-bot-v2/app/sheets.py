@@ -1,13 +1,56 @@
 import os
-from typing import List, Dict
+import re
+import asyncio
+import functools
+import contextvars
+import logging
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta
+from typing import Iterable, List, Dict, Tuple
 import gspread
+from gspread.utils import ValueRenderOption, DateTimeOption, rowcol_to_a1
 from google.oauth2.service_account import Credentials
 
+from .metrics import SHEETS_SECONDS, SHEETS_ERRORS, track
+from .ratelimit import BACKGROUND, BUCKETS, PRIORITY, USER
+from .config import Settings
+from .tenants import current
+from .tracing import span
+
+log = logging.getLogger("app.sheets")
+
 KNOWN_FIELDS = [
     "Date","Type","Unit","Category","Repair","Details","Vendor","Total",
     "Paid By","Paid?","Reported By","Status","Notes","InvoiceLink","MsgKey","CreatedAt"
 ]
 
+# сколько живут закешированные воркшит/шапка и за сколько секунд до истечения обновляем токен
+CACHE_TTL = float(os.getenv("SHEETS_CACHE_TTL", "600"))
+TOKEN_REFRESH_MARGIN = float(os.getenv("SHEETS_TOKEN_REFRESH_MARGIN", "300"))
+# сколько одновременных вызовов Google держим и сколько ждём один вызов
+SHEETS_CONCURRENCY = int(os.getenv("SHEETS_CONCURRENCY", "4"))
+# фоновые вызовы (синхронизация зеркала, прогрев) — в своих слотах: ожидая квоту, они не занимают слоты пользователей
+SHEETS_BACKGROUND_CONCURRENCY = int(os.getenv("SHEETS_BACKGROUND_CONCURRENCY", "2"))
+SHEETS_TIMEOUT = float(os.getenv("SHEETS_TIMEOUT", "20"))
+# сколько арендаторов держат открытый воркшит и шапку; остальные переоткрываются при обращении
+SHEETS_POOL_SIZE = int(os.getenv("SHEETS_POOL_SIZE", "16"))
+# insert — как раньше, физическая вставка под шапку: новые сверху (Google сдвигает все строки);
+# append — по желанию: values.append в конец таблицы, стоимость не зависит от размера листа, но порядок другой
+WRITE_MODE = os.getenv("SHEETS_WRITE_MODE", "insert")
+# лист-представление «новые сверху» для режима append: формула SORT поверх основного листа
+VIEW_TITLE = os.getenv("SHEETS_VIEW_TITLE", "").strip()
+# дольше этого вызов не ждёт токен квоты, а отдаёт Throttled — Flusher/синхронизация повторят позже
+RATE_MAX_WAIT = float(os.getenv("SHEETS_RATE_MAX_WAIT", "10"))
+QUOTA_RETRIES = 2
+# из таймаута вызова на ожидание квоты не тратим столько: остаётся на сам запрос к Google
+CALL_RESERVE = 3.0
+# monotonic-срок, до которого AsyncSheets.run ещё ждёт результат; None — вызов не через run
+_DEADLINE: contextvars.ContextVar[float | None] = contextvars.ContextVar("sheets_deadline", default=None)
+
 def _normalize_pkey(pkey: str) -> str:
     p = (pkey or "").strip()
     if (p.startswith('"') and p.endswith('"')) or (p.startswith("'") and p.endswith("'")):
@@ -29,42 +72,373 @@ def _client() -> gspread.Client:
     )
     return gspread.authorize(creds)
 
-def _open_ws():
-    ss_id = os.getenv("SPREADSHEET_ID")
-    if not ss_id: raise RuntimeError("SPREADSHEET_ID not set")
-    ss = _client().open_by_key(ss_id)
+def _open_ws(gc: gspread.Client, tenant: Settings):
+    if not tenant.SPREADSHEET_ID: raise RuntimeError(f"SPREADSHEET_ID not set for tenant {tenant.NAME}")
+    ss = gc.open_by_key(tenant.SPREADSHEET_ID)
 
-    gid = os.getenv("WORKSHEET_GID")
-    if gid:
-        target = int(gid)
-        for ws in ss.worksheets():
-            if getattr(ws, "id", None) == target:
-                return ws
+    if tenant.WORKSHEET_GID:
+        try:
+            return ss.get_worksheet_by_id(int(tenant.WORKSHEET_GID))
+        except gspread.WorksheetNotFound:
+            pass
 
-    title = os.getenv("WORKSHEET_TITLE", "").strip()
-    if title:
+    if tenant.WORKSHEET_TITLE:
         try:
-            return ss.worksheet(title)
+            return ss.worksheet(tenant.WORKSHEET_TITLE)
         except gspread.WorksheetNotFound:
             pass
 
     return ss.get_worksheet(0)
 
+_gc: gspread.Client | None = None
+_gc_lock = threading.Lock()
+
+def _authorized() -> gspread.Client:
+    """Одна авторизованная сессия на процесс: сервисный аккаунт общий для всех арендаторов."""
+    global _gc
+    if _gc is None:
+        with _gc_lock:
+            if _gc is None:
+                gc = _client()
+                gc.http_client.set_timeout(SHEETS_TIMEOUT)
+                _gc = gc
+    return _gc
+
+@contextmanager
+def _timed(op: str):
+    with span("sheets." + op), track(SHEETS_SECONDS.labels(op), SHEETS_ERRORS.labels(op)):
+        yield
+
+_UPDATED_ROW = re.compile(r"![A-Z]+(\d+)")
+
+def _updated_start(resp) -> int | None:
+    """Первая строка из ответа values.append: updates.updatedRange вида 'Repairs'!A1042:P1044."""
+    rng = ((resp or {}).get("updates") or {}).get("updatedRange") or ""
+    m = _UPDATED_ROW.search(rng)
+    return int(m.group(1)) if m else None
+
+def _quote_title(title: str) -> str:
+    return "'" + title.replace("'", "''") + "'"
+
+def _status(e: Exception) -> int | None:
+    return getattr(getattr(e, "response", None), "status_code", None)
+
+def _schema_changed(e: Exception) -> bool:
+    # 400/404 — лист переименован/удалён или диапазон больше не парсится; 429/5xx ретраить тут нельзя
+    return _status(e) in (400, 404)
+
+# auth (OAuth) в квоту Sheets API не входит, остальные операции — чтение или запись
+_WRITE_OPS = ("append", "insert", "update")
+
+def _api(op: str, fn, *args, **kw):
+    """Вызов Sheets API через ведро квоты: ждём токен (не дольше RATE_MAX_WAIT),
+    на 429 притормаживаем ведро и повторяем — запрос, отбитый квотой, Google не выполнял.
+    Ожидания и повторы укладываются в таймаут AsyncSheets.run: что туда не влезает, отдаётся как Throttled,
+    а не продолжается в потоке пула после того, как вызывающий уже сдался."""
+    bucket = BUCKETS["sheets_write" if op in _WRITE_OPS else "sheets_read"]
+    deadline = _DEADLINE.get()
+    for attempt in range(QUOTA_RETRIES + 1):
+        max_wait = RATE_MAX_WAIT
+        if deadline is not None:
+            max_wait = max(0.0, min(max_wait, deadline - time.monotonic() - CALL_RESERVE))
+        bucket.wait(PRIORITY.get(), max_wait=max_wait)
+        try:
+            with _timed(op):
+                return fn(*args, **kw)
+        except gspread.exceptions.APIError as e:
+            if _status(e) != 429 or attempt == QUOTA_RETRIES:
+                raise
+            bucket.penalize(5.0 * 2 ** attempt)  # Retry-After Google не присылает
+
 class SheetsClient:
-    def __init__(self):
-        self.ws = _open_ws()
-        self._header = [h.strip() for h in (self.ws.row_values(1) or [])]
+    """Воркшит и шапка одного арендатора поверх общей сессии (см. get_sheets)."""
+
+    def __init__(self, tenant: Settings):
+        self.tenant = tenant
+        self._lock = threading.RLock()
+        self._gc: gspread.Client | None = None
+        self._ws = None
+        self._header: List[str] = []
+        self._col_idx: Dict[str, int] = {}
+        self._loaded_at = 0.0
+        self.write_mode = WRITE_MODE
+        self._next_row: int | None = None  # первая свободная строка по последнему ответу append
+
+    def _ensure_token(self):
+        http = self._gc.http_client
+        creds = http.auth
+        expiry = getattr(creds, "expiry", None)
+        if not creds.token or not expiry or expiry - datetime.utcnow() < timedelta(seconds=TOKEN_REFRESH_MARGIN):
+            with _timed("auth"):
+                http.login()
+
+    def _load_header(self):
+        self._header = [h.strip() for h in (_api("header", self._ws.row_values, 1) or [])]
         if not self._header:
             self._header = ["Date","Type","Unit","Category","Repair","Details","Vendor","Total","Paid By","Paid?","Reported By","Status","Notes"]
-            self.ws.update("A1", [self._header])
-        self._col_idx: Dict[str, int] = {name: i for i, name in enumerate(self._header) if name}
+            _api("update", self._ws.update, "A1", [self._header])
+        self._col_idx = {name: i for i, name in enumerate(self._header) if name}
+        self._loaded_at = time.monotonic()
 
-    def append_repair_row(self, row: List[str]) -> int:
-        """Вставляет строку сразу под шапку. Возвращает индекс вставки (обычно 2)."""
+    def _load(self, reopen: bool = False):
+        with self._lock:
+            if self._gc is None:
+                self._gc = _authorized()
+            self._ensure_token()
+            if reopen or self._ws is None:
+                self._ws = _api("open", _open_ws, self._gc, self.tenant)
+                self._next_row = None
+                self._load_header()
+                if VIEW_TITLE and self.write_mode == "append":
+                    self._ensure_view()
+            elif time.monotonic() - self._loaded_at > CACHE_TTL:
+                self._load_header()
+            return self._ws
+
+    def _ensure_view(self):
+        """Лист VIEW_TITLE показывает те же строки, отсортированные по CreatedAt (или Date) по убыванию.
+        Формулу переписываем, только если она разошлась с текущей шапкой."""
+        key = next((n for n in ("CreatedAt", "Date") if n in self._col_idx), None)
+        if key is None or self._ws.title == VIEW_TITLE:
+            return
+        src, last = _quote_title(self._ws.title), self._col_letter(len(self._header) - 1)
+        formula = (f"={{{src}!A1:{last}1; SORT(FILTER({src}!A2:{last}, {src}!A2:A<>\"\"), "
+                   f"{self._col_idx[key] + 1}, FALSE)}}")
+        ss = self._ws.spreadsheet
+        try:
+            try:
+                view = ss.worksheet(VIEW_TITLE)
+            except gspread.WorksheetNotFound:
+                view = ss.add_worksheet(VIEW_TITLE, rows=1, cols=len(self._header))
+            if _api("view", view.acell, "A1", value_render_option=ValueRenderOption.formula).value != formula:
+                _api("update", view.update, "A1", [[formula]], value_input_option="USER_ENTERED")
+        except gspread.exceptions.APIError as e:
+            # представление — удобство для людей, запись в основной лист от него не зависит
+            log.warning("view sheet %r not updated: %s", VIEW_TITLE, e)
+
+    def invalidate(self):
+        with self._lock:
+            self._ws = None
+
+    @property
+    def ws(self):
+        return self._load()
+
+    @property
+    def header(self) -> List[str]:
+        self._load()
+        return self._header
+
+    def _to_sheet_row(self, row: List[str]) -> List[str]:
         data = dict(zip(KNOWN_FIELDS, row + [""] * max(0, len(KNOWN_FIELDS) - len(row))))
         out = ["" for _ in range(len(self._header))]
         for name, idx in self._col_idx.items():
             if name in data:
                 out[idx] = data[name]
-        self.ws.insert_row(out, index=2, value_input_option="USER_ENTERED")
-        return 2
+        return out
+
+    def column_values(self, name: str) -> List[str]:
+        """Значения колонки по имени из шапки, без самой шапки; [] если колонки нет."""
+        ws = self._load()
+        idx = self._col_idx.get(name)
+        if idx is None:
+            return []
+        return _api("read", ws.col_values, idx + 1)[1:]
+
+    # --- чтение для локальных кешей: сырые значения (числа и даты-серийники), без локального форматирования ---
+    _RAW = dict(value_render_option=ValueRenderOption.unformatted, date_time_render_option=DateTimeOption.serial_number)
+
+    def _col_letter(self, idx: int) -> str:
+        return rowcol_to_a1(1, idx + 1)[:-1]
+
+    def _to_record(self, values: list) -> Dict[str, object]:
+        return {name: (values[i] if i < len(values) else "") for name, i in self._col_idx.items()}
+
+    def read_columns(self, names: Iterable[str]) -> Dict[str, list]:
+        """Несколько колонок (без шапки) одним batch_get; отсутствующие в шапке — пустые списки."""
+        ws = self._load()
+        names = list(names)
+        present = [n for n in names if n in self._col_idx]
+        out: Dict[str, list] = {n: [] for n in names}
+        if not present:
+            return out
+        ranges = [f"{self._col_letter(self._col_idx[n])}2:{self._col_letter(self._col_idx[n])}" for n in present]
+        data = _api("read", ws.batch_get, ranges, **self._RAW)
+        for n, vr in zip(present, data):
+            out[n] = [r[0] if r else "" for r in vr]
+        return out
+
+    def find_keys(self, keys: Iterable[str]) -> Dict[str, int]:
+        """MsgKey → номер строки для тех keys, что уже есть в листе (одно чтение колонки MsgKey)."""
+        want = set(keys)
+        col = self.read_columns(("MsgKey",))["MsgKey"]
+        return {k: i + 2 for i, k in ((i, str(v).strip()) for i, v in enumerate(col)) if k in want}
+
+    def read_rows(self, row_numbers: Iterable[int]) -> Dict[int, Dict[str, object]]:
+        """Строки по номерам одним batch_get; подряд идущие номера склеиваются в один диапазон."""
+        ws = self._load()
+        runs: List[List[int]] = []
+        for n in sorted(set(row_numbers)):
+            if runs and n == runs[-1][1] + 1: runs[-1][1] = n
+            else: runs.append([n, n])
+        if not runs:
+            return {}
+        last = self._col_letter(len(self._header) - 1)
+        out: Dict[int, Dict[str, object]] = {}
+        data = _api("read", ws.batch_get, [f"A{a}:{last}{b}" for a, b in runs], **self._RAW)
+        for (a, b), vr in zip(runs, data):
+            for i in range(b - a + 1):
+                out[a + i] = self._to_record(vr[i] if i < len(vr) else [])
+        return out
+
+    def read_all(self) -> List[Dict[str, object]]:
+        """Весь лист записями (без шапки). Только для первичной загрузки кеша."""
+        ws = self._load()
+        values = _api("read", ws.get_values, **self._RAW)
+        return [self._to_record(r) for r in values[1:]]
+
+    def append_repair_rows(self, rows: List[List[str]]) -> List[int]:
+        """Пишет пачку строк одним запросом (см. WRITE_MODE). rows идут от старых к новым;
+        возвращает номера строк в листе для каждой из них на момент записи."""
+        if self.write_mode == "insert":
+            return self._insert_top(rows)
+        return self._append_bottom(rows)
+
+    def _append_bottom(self, rows: List[List[str]]) -> List[int]:
+        ws = self._load()
+        # OVERWRITE: занимаем пустые строки сразу за таблицей, ничего не сдвигая
+        kw = dict(value_input_option="USER_ENTERED", insert_data_option="OVERWRITE", table_range="A1")
+        try:
+            resp = _api("append", ws.append_rows, [self._to_sheet_row(r) for r in rows], **kw)
+        except gspread.exceptions.APIError as e:
+            if not _schema_changed(e):
+                raise
+            ws = self._load(reopen=True)
+            resp = _api("append", ws.append_rows, [self._to_sheet_row(r) for r in rows], **kw)
+        start = _updated_start(resp)
+        if start is None:
+            if self._next_row is None:
+                raise RuntimeError(f"values.append returned no updatedRange: {resp!r}")
+            start = self._next_row
+        elif self._next_row is not None and start != self._next_row:
+            log.info("sheet changed outside the bot: expected row %d, appended at %d", self._next_row, start)
+        self._next_row = start + len(rows)
+        return [start + i for i in range(len(rows))]
+
+    def _insert_top(self, rows: List[List[str]]) -> List[int]:
+        ws = self._load()
+        # rows идут от старых к новым, а в листе новые должны оказаться выше
+        try:
+            _api("insert", ws.insert_rows, [self._to_sheet_row(r) for r in reversed(rows)], row=2,
+                 value_input_option="USER_ENTERED")
+        except gspread.exceptions.APIError as e:
+            if not _schema_changed(e):
+                raise
+            ws = self._load(reopen=True)
+            _api("insert", ws.insert_rows, [self._to_sheet_row(r) for r in reversed(rows)], row=2,
+                 value_input_option="USER_ENTERED")
+        n = len(rows)
+        return [2 + (n - 1 - i) for i in range(n)]
+
+    def update_records(self, edits: Dict[int, Tuple[str, Dict[str, str]]]) -> List[str]:
+        """Правки записанных строк: {номер строки: (MsgKey, {поле: значение})}. Одним batch_get сверяем MsgKey
+        в этих строках (лист могли пересортировать руками), одним batch_update пишем совпавшие.
+        Возвращает MsgKey записанных; остальные ждут, пока синхронизация зеркала найдёт их строки."""
+        ws = self._load()
+        key_idx = self._col_idx.get("MsgKey")
+        if key_idx is None:
+            raise RuntimeError("sheet has no MsgKey column, records can't be located")
+        rows = sorted(edits)
+        letter = self._col_letter(key_idx)
+        found = _api("read", ws.batch_get, [f"{letter}{r}" for r in rows])
+        data, written = [], []
+        for r, vr in zip(rows, found):
+            key, fields = edits[r]
+            if (vr[0][0] if vr and vr[0] else "") != key:
+                log.info("row %d no longer holds %s, edit waits for mirror sync", r, key)
+                continue
+            for name, value in fields.items():
+                if name in self._col_idx:
+                    data.append({"range": f"{self._col_letter(self._col_idx[name])}{r}", "values": [[value]]})
+            written.append(key)
+        if data:
+            _api("update", ws.batch_update, data, value_input_option="USER_ENTERED")
+        return written
+
+    def append_repair_row(self, row: List[str]) -> int:
+        """Пишет одну строку; возвращает её номер в листе (в режиме insert — 2)."""
+        return self.append_repair_rows([row])[0]
+
+_pool: "OrderedDict[str, SheetsClient]" = OrderedDict()
+_pool_lock = threading.Lock()
+
+def get_sheets() -> SheetsClient:
+    """SheetsClient текущего арендатора. Пул LRU на SHEETS_POOL_SIZE: вытесненный клиент
+    просто переоткроет воркшит при следующем обращении, сессия и токен общие."""
+    t = current()
+    with _pool_lock:
+        sc = _pool.get(t.NAME)
+        if sc is None:
+            sc = _pool[t.NAME] = SheetsClient(t)
+            while len(_pool) > SHEETS_POOL_SIZE:
+                _pool.popitem(last=False)
+        else:
+            _pool.move_to_end(t.NAME)
+    return sc
+
+def _with_priority(priority: int, deadline: float, fn, *args):
+    token, dl = PRIORITY.set(priority), _DEADLINE.set(deadline)
+    try:
+        return fn(*args)
+    finally:
+        _DEADLINE.reset(dl)
+        PRIORITY.reset(token)
+
+class AsyncSheets:
+    """Async-фасад над SheetsClient: блокирующий gspread уходит в свой пул потоков, общий для всех арендаторов."""
+
+    def __init__(self, workers: int = SHEETS_CONCURRENCY, timeout: float = SHEETS_TIMEOUT,
+                 background: int = SHEETS_BACKGROUND_CONCURRENCY):
+        # приоритет → (слотов, пул); фоновый вызов ждёт токен квоты в потоке до RATE_MAX_WAIT,
+        # поэтому у него свои потоки и семафор, а не общие с сохранениями пользователей
+        self._workers = {USER: workers, BACKGROUND: background}
+        self._pools = {USER: ThreadPoolExecutor(max_workers=workers, thread_name_prefix="sheets"),
+                       BACKGROUND: ThreadPoolExecutor(max_workers=background, thread_name_prefix="sheets-bg")}
+        self._sems: Dict[int, asyncio.Semaphore] = {}  # создаём лениво, уже внутри event loop
+        self.timeout = timeout
+
+    async def _call(self, priority: int, deadline: float, fn, *args):
+        lane = BACKGROUND if priority == BACKGROUND else USER
+        if lane not in self._sems:
+            self._sems[lane] = asyncio.Semaphore(self._workers[lane])
+        async with self._sems[lane]:
+            loop = asyncio.get_running_loop()
+            # контекст (арендатор, трейс) едет в поток вместе с вызовом, как у asyncio.to_thread
+            ctx = contextvars.copy_context()
+            return await loop.run_in_executor(self._pools[lane], functools.partial(ctx.run, _with_priority, priority, deadline, fn, *args))
+
+    async def run(self, fn, *args, timeout: float | None = None, priority: int = USER):
+        """Выполняет fn(client, *args) в пуле с клиентом текущего арендатора; ожидание слота входит в таймаут.
+        priority=BACKGROUND — вызов не трогает запас квоты, оставленный под пользовательские запросы,
+        и идёт в отдельных слотах (SHEETS_BACKGROUND_CONCURRENCY)."""
+        timeout = timeout or self.timeout
+        deadline = time.monotonic() + timeout
+        return await asyncio.wait_for(self._call(priority, deadline, fn, get_sheets(), *args), timeout)
+
+    async def append_repair_row(self, row: List[str]) -> int:
+        return await self.run(SheetsClient.append_repair_row, row)
+
+    async def header(self) -> List[str]:
+        return await self.run(lambda c: c.header)
+
+    def shutdown(self):
+        for pool in self._pools.values():
+            pool.shutdown(wait=False, cancel_futures=True)
+
+_async_shared: AsyncSheets | None = None
+
+def get_async_sheets() -> AsyncSheets:
+    global _async_shared
+    if _async_shared is None:
+        _async_shared = AsyncSheets()
+    return _async_shared
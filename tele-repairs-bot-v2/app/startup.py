@@ -0,0 +1,44 @@
+import os
+import time
+from contextlib import contextmanager
+from typing import Dict
+
+from .metrics import STARTUP_SECONDS
+
+# lazy — вебхук принимает апдейты сразу, а импорт telegram/gspread, getMe и прогрев Sheets идут фоном;
+# eager — всё внутри startup, как раньше
+STARTUP_MODE = os.getenv("STARTUP_MODE", "lazy")
+
+T0 = time.perf_counter()  # раньше этого момента приложение ничего не контролирует
+
+class Phases:
+    """Длительности фаз холодного старта, секунды. Видны в /healthz и /metrics."""
+
+    def __init__(self):
+        self.durations: Dict[str, float] = {}
+        self.error: str | None = None  # фоновый прогрев упал: /healthz отвечает 503, платформа перезапустит
+
+    def record(self, name: str, seconds: float):
+        self.durations[name] = seconds
+        STARTUP_SECONDS.labels(name).set(seconds)
+
+    def mark(self, name: str):
+        """Отметка «от импорта приложения до сейчас»: accepting, ready."""
+        self.record(name, time.perf_counter() - T0)
+
+    @contextmanager
+    def timed(self, name: str):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - t0)
+
+    def as_dict(self) -> Dict[str, object]:
+        out = {"mode": STARTUP_MODE, "ready": "ready" in self.durations,
+               "phases": {k: round(v, 4) for k, v in self.durations.items()}}
+        if self.error:
+            out["error"] = self.error
+        return out
+
+PHASES = Phases()
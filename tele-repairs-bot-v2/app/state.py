@@ -1,12 +1,288 @@
-# простое in-memory хранилище
-_store = {}
+import os
+import sys
+import json
+import time
+import atexit
+import logging
+import threading
+from collections import OrderedDict
+from typing import Dict
+
+from .metrics import DRAFT_EVICTIONS
+from .tenants import PerTenant
+
+log = logging.getLogger("app.state")
+
+# memory — как раньше, только в процессе; sqlite — файл в DATA_DIR, общий для всех воркеров
+STATE_BACKEND = os.getenv("STATE_BACKEND", "sqlite")
+# шаги анкеты внутри этого окна схлопываются в одну запись на диск. Другие воркеры видят шаг только после
+# записи, то есть с опозданием до STATE_FLUSH_DELAY: если апдейты одного чата могут прийти в разные воркеры
+# быстрее, ставьте 0 — тогда каждый шаг пишется сразу (write-through)
+STATE_FLUSH_DELAY = float(os.getenv("STATE_FLUSH_DELAY", "0.3"))
+# после неудачной записи следующая попытка — через удваивающуюся паузу, не дольше этой
+STATE_FLUSH_MAX_BACKOFF = 30.0
+# анкета без изменений дольше STATE_TTL считается брошенной и удаляется
+STATE_TTL = float(os.getenv("STATE_TTL", str(3 * 86400)))
+# сколько чатов держать в памяти процесса (LRU); остальные читаются из backend по требованию
+STATE_MAX_ENTRIES = int(os.getenv("STATE_MAX_ENTRIES", "10000"))
+STATE_SWEEP_INTERVAL = float(os.getenv("STATE_SWEEP_INTERVAL", "600"))
+
+# анкета в хранилище — массив по слотам, а не dict со строковыми ключами: в памяти кортеж,
+# на диске короткий JSON без имён полей. Ключи вне FORM_SLOTS (на будущее) идут хвостовым dict'ом
+FORM_SLOTS = ("Date", "Type", "UnitType", "Unit", "TrailerNum", "Category", "Repair", "Details", "Vendor",
+              "Total", "Paid By", "Paid?", "Reported By", "Status", "Notes", "_edit", "_fill")
+_SLOT = {name: i for i, name in enumerate(FORM_SLOTS)}
+
+def encode_form(form: dict) -> list:
+    slots: list = [None] * len(FORM_SLOTS)
+    extra = {}
+    for k, v in (form or {}).items():
+        i = _SLOT.get(k)
+        if i is None:
+            extra[k] = v
+        else:
+            slots[i] = v
+    if extra:
+        return slots + [extra]
+    while slots and slots[-1] is None:
+        slots.pop()
+    return slots
+
+def decode_form(data) -> dict:
+    if isinstance(data, dict):
+        return dict(data)  # записи старого формата
+    form = {FORM_SLOTS[i]: v for i, v in enumerate(data[:len(FORM_SLOTS)]) if v is not None}
+    if len(data) > len(FORM_SLOTS):
+        form.update(data[len(FORM_SLOTS)])
+    return form
+
+class _Draft:
+    __slots__ = ("state", "slots", "at")
+
+    def __init__(self, state: str, slots, at: float):
+        self.state, self.slots, self.at = sys.intern(state), tuple(slots), at
+
+    @classmethod
+    def of(cls, entry: dict | None):
+        return None if entry is None else cls(entry["state"], encode_form(entry["form"]), time.time())
+
+    def entry(self) -> dict:
+        return {"state": self.state, "form": decode_form(list(self.slots))}
+
+class MemoryBackend:
+    def __init__(self):
+        self._data: "OrderedDict[int, _Draft]" = OrderedDict()
+
+    def load(self, chat_id: int):
+        d = self._data.get(chat_id)
+        return d.entry() if d else None
+
+    def save_many(self, items: Dict[int, dict | None]):
+        for chat_id, entry in items.items():
+            if entry is None:
+                self._data.pop(chat_id, None)
+                continue
+            self._data[chat_id] = _Draft.of(entry)
+            self._data.move_to_end(chat_id)
+        # здесь вытеснение из памяти — это потеря анкеты, поэтому тот же лимит, что и у кеша
+        while len(self._data) > STATE_MAX_ENTRIES:
+            self._data.popitem(last=False)
+            DRAFT_EVICTIONS.labels("lru").inc()
+
+    def sweep(self, cutoff: float) -> int:
+        old = [k for k, d in self._data.items() if d.at < cutoff]
+        for k in old:
+            del self._data[k]
+        return len(old)
+
+    def changed(self) -> bool:
+        return False
+
+    def count(self) -> int:
+        return len(self._data)
+
+class SqliteBackend:
+    def __init__(self, name: str = "state.sqlite3"):
+        from .db import connect
+        self._db = connect(name)
+        self._db.execute("CREATE TABLE IF NOT EXISTS drafts (chat_id INTEGER PRIMARY KEY, state TEXT, form TEXT, updated_at REAL)")
+        self._db.execute("CREATE INDEX IF NOT EXISTS drafts_updated ON drafts(updated_at)")
+        self._lock = threading.Lock()
+        self._version = self._data_version()
+
+    def _data_version(self) -> int:
+        return self._db.execute("PRAGMA data_version").fetchone()[0]
+
+    def load(self, chat_id: int):
+        with self._lock:
+            r = self._db.execute("SELECT state, form FROM drafts WHERE chat_id=?", (chat_id,)).fetchone()
+        return {"state": r[0], "form": decode_form(json.loads(r[1] or "{}"))} if r else None
+
+    def save_many(self, items: Dict[int, dict | None]):
+        now = time.time()
+        with self._lock:
+            self._db.execute("BEGIN")
+            try:
+                for chat_id, entry in items.items():
+                    if entry is None:
+                        self._db.execute("DELETE FROM drafts WHERE chat_id=?", (chat_id,))
+                    else:
+                        form = json.dumps(encode_form(entry["form"]), ensure_ascii=False, separators=(",", ":"))
+                        self._db.execute("INSERT OR REPLACE INTO drafts(chat_id, state, form, updated_at) VALUES (?, ?, ?, ?)",
+                                         (chat_id, entry["state"], form, now))
+                self._db.execute("COMMIT")
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+
+    def sweep(self, cutoff: float) -> int:
+        with self._lock:
+            return self._db.execute("DELETE FROM drafts WHERE updated_at < ?", (cutoff,)).rowcount
+
+    def count(self) -> int:
+        with self._lock:
+            return self._db.execute("SELECT COUNT(*) FROM drafts").fetchone()[0]
+
+    def changed(self) -> bool:
+        """True, если файл менял другой процесс (data_version не видит наши собственные коммиты)."""
+        with self._lock:
+            v = self._data_version()
+            if v == self._version:
+                return False
+            self._version = v
+            return True
+
+class _CachedStore:
+    """Локальный кеш поверх backend: чтения из памяти, записи копятся и уходят пачкой через STATE_FLUSH_DELAY.
+    Кеш — LRU на STATE_MAX_ENTRIES чатов; вытесненная анкета остаётся в backend и прочитается заново."""
+
+    def __init__(self, backend):
+        self.backend = backend
+        self._cache: "OrderedDict[int, _Draft | None]" = OrderedDict()
+        self._dirty: Dict[int, dict | None] = {}
+        self._lock = threading.Lock()
+        self._timer: threading.Timer | None = None
+        self._failures = 0
+
+    def _arm(self, delay: float):
+        # под self._lock
+        if self._timer is None:
+            self._timer = threading.Timer(delay, self.flush)
+            self._timer.daemon = True
+            self._timer.start()
+
+    def _remember(self, chat_id: int, draft):
+        self._cache[chat_id] = draft
+        self._cache.move_to_end(chat_id)
+        while len(self._cache) > STATE_MAX_ENTRIES:
+            _, old = self._cache.popitem(last=False)
+            if old is not None:
+                DRAFT_EVICTIONS.labels("lru").inc()
+
+    def get(self, chat_id: int):
+        if self.backend.changed():
+            with self._lock:
+                self._cache.clear()
+        with self._lock:
+            if chat_id in self._dirty:
+                return self._dirty[chat_id]
+            if chat_id in self._cache:
+                self._cache.move_to_end(chat_id)
+                d = self._cache[chat_id]
+                return d.entry() if d else None
+        entry = self.backend.load(chat_id)
+        with self._lock:
+            if chat_id not in self._dirty:
+                self._remember(chat_id, _Draft.of(entry))
+        return entry
+
+    def put(self, chat_id: int, entry: dict | None):
+        with self._lock:
+            self._remember(chat_id, _Draft.of(entry))
+            self._dirty[chat_id] = entry
+            if STATE_FLUSH_DELAY > 0:
+                self._arm(STATE_FLUSH_DELAY)
+                return
+        self.flush()
+
+    def flush(self):
+        with self._lock:
+            dirty, self._dirty = self._dirty, {}
+            self._timer = None
+        if not dirty:
+            return
+        try:
+            self.backend.save_many(dirty)
+        except Exception:
+            with self._lock:
+                for k, v in dirty.items():
+                    self._dirty.setdefault(k, v)
+                self._failures += 1
+                delay = min(max(STATE_FLUSH_DELAY, 0.1) * 2 ** self._failures, STATE_FLUSH_MAX_BACKOFF)
+                # без нового таймера черновики ждали бы следующего шага какого-нибудь чата
+                self._arm(delay)
+            log.exception("state flush failed, %d drafts kept, retry in %.1fs", len(dirty), delay)
+            return
+        self._failures = 0
+
+    def sweep(self) -> int:
+        """Брошенные анкеты старше STATE_TTL: из памяти и из backend. Возвращает, сколько удалено."""
+        cutoff = time.time() - STATE_TTL
+        with self._lock:
+            for k in [k for k, d in self._cache.items() if d is None or d.at < cutoff]:
+                del self._cache[k]
+        n = self.backend.sweep(cutoff)
+        if n:
+            DRAFT_EVICTIONS.labels("ttl").inc(n)
+        return n
+
+def _make_backend(tenant):
+    if STATE_BACKEND == "memory":
+        return MemoryBackend()
+    if STATE_BACKEND == "sqlite":
+        return SqliteBackend(tenant.data_name("state.sqlite3"))
+    raise RuntimeError(f"unknown STATE_BACKEND: {STATE_BACKEND}")
+
+_sweeper: threading.Thread | None = None
+
+def _sweep_loop():
+    while True:
+        time.sleep(STATE_SWEEP_INTERVAL)
+        for store in _stores.all():
+            try:
+                n = store.sweep()
+                if n: log.info("dropped %d abandoned drafts", n)
+            except Exception:
+                log.exception("draft sweep failed")
+
+def _new_store(tenant) -> _CachedStore:
+    global _sweeper
+    store = _CachedStore(_make_backend(tenant))
+    atexit.register(store.flush)
+    if _sweeper is None:
+        _sweeper = threading.Thread(target=_sweep_loop, name="draft-sweeper", daemon=True)
+        _sweeper.start()
+    return store
+
+_stores: PerTenant[_CachedStore] = PerTenant(_new_store)
+
+def _get_store() -> _CachedStore:
+    return _stores.get()
+
+def flush_state():
+    for store in _stores.all():
+        store.flush()
+
+def live_drafts() -> int:
+    """Незавершённые анкеты по всем воркерам и арендаторам (с точностью до STATE_FLUSH_DELAY)."""
+    return sum(store.backend.count() for store in _stores.all())
 
 class StateStore:
     def get(self, chat_id):
-        return _store.get(int(chat_id))
+        return _get_store().get(int(chat_id))
 
     def set(self, chat_id, state, form):
-        _store[int(chat_id)] = {"state": state, "form": dict(form or {})}
+        _get_store().put(int(chat_id), {"state": state, "form": dict(form or {})})
 
     def clear(self, chat_id):
-        _store.pop(int(chat_id), None)
+        _get_store().put(int(chat_id), None)
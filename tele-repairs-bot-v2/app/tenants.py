@@ -0,0 +1,64 @@
+import threading
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Callable, Dict, Generic, List, TypeVar
+
+from .config import Settings, load_tenants
+
+T = TypeVar("T")
+
+# арендатор текущего апдейта/запроса; asyncio.create_task и to_thread наследуют значение
+CURRENT: ContextVar[str | None] = ContextVar("tenant", default=None)
+
+_tenants: Dict[str, Settings] | None = None
+_lock = threading.Lock()
+
+def tenants() -> Dict[str, Settings]:
+    global _tenants
+    if _tenants is None:
+        with _lock:
+            if _tenants is None:
+                _tenants = load_tenants()
+    return _tenants
+
+def current() -> Settings:
+    """Настройки текущего арендатора; вне контекста — первый из списка (в однотенантном режиме — единственный)."""
+    ts = tenants()
+    name = CURRENT.get()
+    return ts[name] if name is not None else next(iter(ts.values()))
+
+def by_secret(secret: str) -> Settings | None:
+    return next((t for t in tenants().values() if t.WEBHOOK_SECRET_TOKEN == secret), None)
+
+@contextmanager
+def use(name: str):
+    token = CURRENT.set(name)
+    try:
+        yield tenants()[name]
+    finally:
+        CURRENT.reset(token)
+
+class PerTenant(Generic[T]):
+    """Ленивые объекты по одному на арендатора: журнал, зеркало, хранилище анкет и т.п."""
+
+    def __init__(self, factory: Callable[[Settings], T]):
+        self._factory = factory
+        self._items: Dict[str, T] = {}
+        self._lock = threading.Lock()
+
+    def get(self) -> T:
+        t = current()
+        obj = self._items.get(t.NAME)
+        if obj is None:
+            with self._lock:
+                obj = self._items.get(t.NAME)
+                if obj is None:
+                    obj = self._items[t.NAME] = self._factory(t)
+        return obj
+
+    def all(self) -> List[T]:
+        return list(self._items.values())
+
+    def items(self) -> Dict[str, T]:
+        """Уже созданные объекты по имени арендатора — чтобы остановить каждый в своём контексте."""
+        return dict(self._items)
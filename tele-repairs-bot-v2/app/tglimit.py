@@ -0,0 +1,74 @@
+import os
+import asyncio
+import logging
+from typing import Dict
+
+from telegram.error import RetryAfter
+from telegram.ext import BaseRateLimiter
+
+from .ratelimit import BUCKETS, BACKGROUND, USER, TG_RATE_GLOBAL, TokenBucket
+
+log = logging.getLogger("app.tglimit")
+
+# Telegram: сообщений в секунду на личный чат / в минуту на группу; 0 — без ограничения
+TG_RATE_CHAT = float(os.getenv("TG_RATE_CHAT", "1"))
+TG_RATE_GROUP_PER_MIN = float(os.getenv("TG_RATE_GROUP_PER_MIN", "20"))
+TG_MAX_RETRIES = 3
+
+# что Telegram считает сообщениями; getMe/getFile/answerCallbackQuery лимитом не ограничиваем
+_MESSAGE_ENDPOINTS = ("send", "edit", "copy", "forward")
+_CHAT_BUCKETS_MAX = 2000
+
+class TelegramLimiter(BaseRateLimiter[int]):
+    """Rate limiter для PTB: общее ведро бота + ведро на чат, RetryAfter → пауза и повтор.
+    Фоновые рассылки передают rate_limit_args=BACKGROUND и уступают ответам пользователям."""
+
+    def __init__(self, bucket: str = "telegram"):
+        # у каждого бота (арендатора) свой общий лимит Telegram
+        if bucket not in BUCKETS:
+            BUCKETS[bucket] = TokenBucket(bucket, TG_RATE_GLOBAL, TG_RATE_GLOBAL)
+        self.glob = BUCKETS[bucket]
+        self._chats: Dict[str, TokenBucket] = {}
+
+    async def initialize(self):
+        pass
+
+    async def shutdown(self):
+        pass
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        key = str(chat_id)
+        b = self._chats.get(key)
+        if b is None:
+            if len(self._chats) >= _CHAT_BUCKETS_MAX:
+                # полные вёдра ничего не помнят — их можно выбросить без потери лимита
+                for k in [k for k, v in self._chats.items() if v.budget() >= 1.0]:
+                    del self._chats[k]
+            group = key.startswith("-") or key.startswith("@")
+            rate = TG_RATE_GROUP_PER_MIN / 60 if group else TG_RATE_CHAT
+            b = self._chats[key] = TokenBucket("telegram_chat", rate, 5 if group else 3)
+        return b
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        priority = BACKGROUND if rate_limit_args == BACKGROUND else USER
+        limited = endpoint.startswith(_MESSAGE_ENDPOINTS)
+        chat = self._chat_bucket(data["chat_id"]) if limited and data.get("chat_id") is not None else None
+        for attempt in range(TG_MAX_RETRIES + 1):
+            if limited:
+                await self.glob.take(priority)
+                if chat is not None:
+                    await chat.take(priority)
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                if attempt == TG_MAX_RETRIES:
+                    raise
+                ra = e.retry_after
+                pause = ra.total_seconds() if hasattr(ra, "total_seconds") else float(ra)
+                log.warning("Telegram flood control on %s, retry in %.0fs", endpoint, pause)
+                if chat is not None:
+                    chat.penalize(pause)
+                elif limited:
+                    self.glob.penalize(pause)
+                else:
+                    await asyncio.sleep(pause)  # вне вёдер (getMe и т.п.) ждём сами
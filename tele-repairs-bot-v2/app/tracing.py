@@ -0,0 +1,98 @@
+import os
+import time
+import random
+import asyncio
+import cProfile
+import threading
+import pstats
+from collections import deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Dict, List
+
+# доля апдейтов, для которых пишутся спаны; запись — пара perf_counter и append на стадию
+TRACE_SAMPLE = float(os.getenv("TRACE_SAMPLE", "1.0"))
+# в кольцо попадают только трейсы дольше этого порога
+TRACE_SLOW_MS = float(os.getenv("TRACE_SLOW_MS", "500"))
+TRACE_RING = int(os.getenv("TRACE_RING", "100"))
+PROFILE_MAX_SECONDS = 60.0
+# профиль снимается со всего процесса (все арендаторы), поэтому ключ свой, не webhook-секрет; пусто — выключено
+PROFILE_SECRET = os.getenv("PROFILE_SECRET", "")
+
+class Trace:
+    __slots__ = ("name", "attrs", "t0", "spans", "total", "at")
+
+    def __init__(self, name: str, attrs: Dict[str, object]):
+        self.name, self.attrs = name, attrs
+        self.t0 = time.perf_counter()
+        self.spans: List[tuple] = []  # (имя, начало от t0, длительность, поток)
+        self.total = 0.0
+        self.at = time.time()
+
+    def as_dict(self) -> Dict[str, object]:
+        return {"name": self.name, "at": self.at, "ms": round(self.total * 1000, 2), **self.attrs,
+                "spans": [{"name": n, "start_ms": round(s * 1000, 2), "ms": round(d * 1000, 2),
+                           **({"thread": th} if th else {})} for n, s, d, th in self.spans]}
+
+_CURRENT: ContextVar[Trace | None] = ContextVar("trace", default=None)
+_slow: deque = deque(maxlen=TRACE_RING)
+
+@contextmanager
+def trace(name: str, **attrs):
+    """Корень трейса: апдейт или пачка Flusher'а. Медленные складываются в кольцо (см. slow_traces)."""
+    if TRACE_SAMPLE < 1.0 and random.random() >= TRACE_SAMPLE:
+        yield None
+        return
+    t = Trace(name, attrs)
+    token = _CURRENT.set(t)
+    try:
+        yield t
+    finally:
+        _CURRENT.reset(token)
+        t.total = time.perf_counter() - t.t0
+        if t.total * 1000 >= TRACE_SLOW_MS:
+            _slow.append(t)
+
+@contextmanager
+def span(name: str):
+    """Стадия внутри текущего трейса; вне трейса ничего не стоит. Пулы потоков Sheets и to_thread
+    копируют контекст, поэтому спаны из потоков попадают в трейс апдейта."""
+    t = _CURRENT.get()
+    if t is None:
+        yield
+        return
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        th = threading.current_thread()
+        t.spans.append((name, t0 - t.t0, time.perf_counter() - t0,
+                        None if th is threading.main_thread() else th.name))
+
+def slow_traces(limit: int = TRACE_RING, tenant: str | None = None) -> List[Dict[str, object]]:
+    """Последние медленные трейсы, новые первыми; tenant — только трейсы этого арендатора."""
+    ts = [t for t in list(_slow)[::-1] if tenant is None or t.attrs.get("tenant") == tenant]
+    return [t.as_dict() for t in ts[:limit]]
+
+_profiling = asyncio.Lock()
+
+async def profile(seconds: float, top: int = 30, sort: str = "cumulative") -> Dict[str, object]:
+    """cProfile на event loop (основной поток) на seconds секунд; горячие функции по sort.
+    Потоки пулов Sheets/импорта сюда не попадают — их время видно в спанах трейсов."""
+    if _profiling.locked():
+        raise RuntimeError("profiler is already running")
+    seconds = max(0.1, min(seconds, PROFILE_MAX_SECONDS))
+    async with _profiling:
+        prof = cProfile.Profile()
+        prof.enable()
+        try:
+            await asyncio.sleep(seconds)
+        finally:
+            prof.disable()
+    st = pstats.Stats(prof)
+    key = {"cumulative": 3, "tottime": 2, "calls": 1}.get(sort, 3)
+    rows = sorted(st.stats.items(), key=lambda kv: kv[1][key], reverse=True)[:top]
+    return {"seconds": seconds, "sort": sort, "total_calls": st.total_calls,
+            "functions": [{"function": f"{os.path.basename(f)}:{line}({fn})", "calls": nc,
+                           "tottime_ms": round(tt * 1000, 3), "cumtime_ms": round(ct * 1000, 3)}
+                          for (f, line, fn), (cc, nc, tt, ct, _) in rows]}
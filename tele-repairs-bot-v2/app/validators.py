@@ -1,10 +1,33 @@
-from datetime import datetime
+from datetime import date, datetime
 import re
 
+def _month_day(t: str) -> str | None:
+    """M/D, M/D/YY, M/D/YYYY. Без года — последний уже наступивший такой день: 12/30 в январе — прошлый год,
+    2/29 — ближайший прошедший високосный."""
+    m = re.fullmatch(r"(\d{1,2})/(\d{1,2})(?:/(\d{2}|\d{4}))?", t)
+    if not m: return None
+    month, day, y = int(m.group(1)), int(m.group(2)), m.group(3)
+    if y:
+        try:
+            return date(int(y) + 2000 if len(y) == 2 else int(y), month, day).isoformat()
+        except ValueError:
+            return None
+    today = datetime.utcnow().date()
+    for year in range(today.year, today.year - 8, -1):
+        try:
+            d = date(year, month, day)
+        except ValueError:
+            continue
+        if d <= today:
+            return d.isoformat()
+    return None
+
 def normalize_date(text: str) -> str | None:
     t = (text or "").strip().lower()
     if t in ("today","now"):
         return datetime.utcnow().date().isoformat()
+    if "/" in t:
+        return _month_day(t)
     m = re.fullmatch(r"(\d{4})-(\d{2})-(\d{2})", t)
     if not m: return None
     try:
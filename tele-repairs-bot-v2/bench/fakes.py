@@ -0,0 +1,177 @@
+"""Подмены Telegram Bot API и листа gspread в памяти процесса — для нагрузочных прогонов и реплея."""
+import json
+import time
+import asyncio
+import threading
+from collections import Counter
+from datetime import datetime, timedelta
+
+import gspread
+from gspread.utils import a1_range_to_grid_range, a1_to_rowcol
+from telegram.request import BaseRequest
+
+class FakeTelegram(BaseRequest):
+    """Отвечает на любой метод Bot API как Telegram, с задержкой latency секунд."""
+
+    def __init__(self, latency: float = 0.0):
+        self.latency = latency
+        self.calls: Counter = Counter()
+        self._message_id = 1000
+
+    async def initialize(self): pass
+    async def shutdown(self): pass
+
+    async def do_request(self, url, method, request_data=None, read_timeout=None, write_timeout=None,
+                         connect_timeout=None, pool_timeout=None):
+        api = url.rsplit("/", 1)[-1]
+        self.calls[api] += 1
+        if self.latency:
+            await asyncio.sleep(self.latency)
+        params = request_data.parameters if request_data else {}
+        if api == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Bench", "username": "bench_bot"}
+        elif api in ("sendMessage", "editMessageText", "sendDocument", "sendPhoto"):
+            self._message_id += 1
+            result = {"message_id": self._message_id, "date": int(time.time()), "text": params.get("text", ""),
+                      "chat": {"id": int(params.get("chat_id") or 0), "type": "private"}}
+        else:
+            result = True
+        return 200, json.dumps({"ok": True, "result": result}).encode()
+
+class _Response:
+    def __init__(self, code: int, message: str):
+        self.status_code = code
+        self.text = message
+        self._body = {"error": {"code": code, "message": message, "status": "RESOURCE_EXHAUSTED"}}
+
+    def json(self):
+        return self._body
+
+class FakeWorksheet:
+    """Лист в памяти с API gspread.Worksheet, которое использует app.sheets.
+
+    latency — задержка на каждый вызов (блокирующая, как у настоящего HTTP);
+    quota_every — каждый N-й вызов записи падает с 429, как при исчерпании квоты."""
+
+    title = "Repairs"
+    id = 0
+
+    def __init__(self, header, latency: float = 0.0, quota_every: int = 0):
+        self.rows = [list(header)]
+        self.latency = latency
+        self.quota_every = quota_every
+        self.calls: Counter = Counter()
+        self.spreadsheet = type("Spreadsheet", (), {"title": "Bench"})()
+        self._lock = threading.Lock()
+        self._writes = 0
+
+    def _call(self, name: str, write: bool = False):
+        self.calls[name] += 1
+        if self.latency:
+            time.sleep(self.latency)
+        if write and self.quota_every:
+            with self._lock:
+                self._writes += 1
+                if self._writes % self.quota_every == 0:
+                    raise gspread.exceptions.APIError(_Response(429, "Quota exceeded"))
+
+    def row_values(self, i, **kw):
+        self._call("row_values")
+        return list(self.rows[i - 1]) if len(self.rows) >= i else []
+
+    def col_values(self, c, **kw):
+        self._call("col_values")
+        return [r[c - 1] if len(r) >= c else "" for r in self.rows]
+
+    def update(self, rng, values, **kw):
+        self._call("update", write=True)
+        self._write_at(rng, values)
+
+    def insert_row(self, values, index=1, **kw):
+        self._call("insert_row", write=True)
+        with self._lock:
+            self.rows.insert(index - 1, list(values))
+
+    def insert_rows(self, values, row=1, **kw):
+        self._call("insert_rows", write=True)
+        with self._lock:
+            self.rows[row - 1:row - 1] = [list(v) for v in values]
+
+    def append_rows(self, values, **kw):
+        self._call("append_rows", write=True)
+        with self._lock:
+            start = len(self.rows) + 1
+            self.rows.extend(list(v) for v in values)
+        end = start + len(values) - 1
+        return {"updates": {"updatedRange": f"'{self.title}'!A{start}:Z{end}", "updatedRows": len(values)}}
+
+    def batch_update(self, data, **kw):
+        self._call("batch_update", write=True)
+        for d in data:
+            self._write_at(d["range"], d["values"])
+
+    def _write_at(self, rng, values):
+        r, c = a1_to_rowcol(rng.split("!")[-1].split(":")[0])
+        with self._lock:
+            for i, vals in enumerate(values):
+                while len(self.rows) < r + i:
+                    self.rows.append([])
+                row = self.rows[r + i - 1]
+                for j, v in enumerate(vals):
+                    while len(row) < c + j:
+                        row.append("")
+                    row[c + j - 1] = v
+
+    def _range(self, rng):
+        g = a1_range_to_grid_range(rng.split("!")[-1]) if rng else {}
+        rs, re_ = g.get("startRowIndex", 0), g.get("endRowIndex", len(self.rows))
+        cs, ce = g.get("startColumnIndex", 0), g.get("endColumnIndex")
+        out = [list(r)[cs:ce] for r in self.rows[rs:re_]]
+        while out and not any(out[-1]):
+            out.pop()
+        return out
+
+    def get_values(self, rng=None, **kw):
+        self._call("get_values")
+        return self._range(rng)
+
+    def get_all_values(self, **kw):
+        self._call("get_all_values")
+        return [list(r) for r in self.rows]
+
+    def batch_get(self, ranges, **kw):
+        self._call("batch_get")
+        return [self._range(r) for r in ranges]
+
+class _Creds:
+    token = None
+    expiry = None
+
+class _HTTP:
+    def __init__(self, calls: Counter):
+        self.auth = _Creds()
+        self._calls = calls
+
+    def login(self):
+        self._calls["auth"] += 1
+        self.auth.token = "bench"
+        self.auth.expiry = datetime.utcnow() + timedelta(hours=1)
+
+    def set_timeout(self, timeout):
+        pass
+
+class FakeGspread:
+    """Замена gspread.Client: open_by_key отдаёт один FakeWorksheet."""
+
+    def __init__(self, ws: FakeWorksheet):
+        self.ws = ws
+        self.http_client = _HTTP(ws.calls)
+
+    def open_by_key(self, key):
+        self.ws.calls["open"] += 1
+        ws = self.ws
+        return type("Spreadsheet", (), {
+            "get_worksheet_by_id": lambda self, i: ws,
+            "worksheet": lambda self, t: ws,
+            "get_worksheet": lambda self, i: ws,
+        })()
@@ -0,0 +1,154 @@
+"""Нагрузочный прогон: N чатов параллельно проходят анкету от /new до Save через POST /webhook/{secret}.
+
+    python -m bench.loadtest --chats 200 --sheets-latency 0.3 --tg-latency 0.05
+    python -m bench.loadtest --update-baseline     # записать bench/baseline.json
+
+Код выхода 1 — метрики хуже baseline больше чем на --tolerance."""
+import json
+import time
+import asyncio
+import argparse
+import os
+import sys
+
+from bench.harness import FLOW, SECRET, Updates, boot, peak_rss_mb, percentile, time_updates
+
+BASELINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "baseline.json")
+
+async def _chat(client, updates: Updates, chat_id: int, latencies: list, stats: dict):
+    for text in FLOW:
+        await _post(client, updates.message(chat_id, text), latencies, stats)
+    await _post(client, updates.callback(chat_id, "save", message_id=chat_id), latencies, stats)
+
+async def _post(client, payload: dict, latencies: list, stats: dict):
+    stats["updates"] += 1
+    while True:
+        t0 = time.perf_counter()
+        r = await client.post(f"/webhook/{SECRET}", json=payload)
+        latencies.append(time.perf_counter() - t0)
+        if r.status_code != 503:
+            return
+        # backpressure: Telegram повторил бы доставку, делаем так же
+        stats["rejected"] += 1
+        await asyncio.sleep(0.05)
+
+async def run(args) -> dict:
+    import httpx
+    # по умолчанию lazy, как в проде: первые апдейты ждут прогрева и попадают в хвост задержек;
+    # --startup eager меряет уже прогретый бот. Лимиты исходящих вызовов выключены: baseline меряет бот, а не квоты
+    env = {"STARTUP_MODE": args.startup, "TG_RATE_GLOBAL": str(args.tg_rate), "TG_RATE_CHAT": "0",
+           "SHEETS_READS_PER_MIN": str(args.sheets_quota), "SHEETS_WRITES_PER_MIN": str(args.sheets_quota)}
+    main, tg, ws = boot(args.tg_latency, args.sheets_latency, args.quota_every, env=env)
+    updates = Updates()
+    latencies: list = []
+    processing: list = []
+    time_updates(main, lambda payload, s: processing.append(s))
+    stats = {"updates": 0, "rejected": 0}
+    rows_before = len(ws.rows)
+
+    await main.on_startup()
+    transport = httpx.ASGITransport(app=main.app)
+    t0 = time.perf_counter()
+    async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+        await asyncio.gather(*(_chat(client, updates, 10_000 + i, latencies, stats) for i in range(args.chats)))
+        # shutdown дожидается очереди апдейтов и последнего flush журнала
+        await main.on_shutdown()
+    elapsed = time.perf_counter() - t0
+
+    saved = len(ws.rows) - rows_before
+    google_calls = sum(ws.calls.values())
+    return {
+        "chats": args.chats,
+        "startup": args.startup,
+        "updates": stats["updates"],
+        "rejected_503": stats["rejected"],
+        "saved": saved,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "update_p50_ms": round(percentile(processing, 50) * 1000, 2),
+        "update_p95_ms": round(percentile(processing, 95) * 1000, 2),
+        "update_p99_ms": round(percentile(processing, 99) * 1000, 2),
+        "throughput_ups": round(stats["updates"] / elapsed, 1),
+        "google_calls_per_record": round(google_calls / max(saved, 1), 3),
+        "google_calls": dict(ws.calls),
+        "telegram_calls": dict(tg.calls),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+# метрика → в какую сторону лучше; допуск применяется как множитель
+_CHECKS = {
+    "p95_ms": "lower",
+    "p99_ms": "lower",
+    # задержка обработки апдейта важнее задержки ответа вебхука: в режиме queue тот отвечает сразу
+    "update_p95_ms": "lower",
+    "update_p99_ms": "lower",
+    "throughput_ups": "higher",
+    "google_calls_per_record": "lower",
+    "peak_rss_mb": "lower",
+}
+
+_MS_SLACK = 2.0
+
+def regressions(result: dict, baseline: dict, tolerance: float, checks: dict = _CHECKS) -> list:
+    failures = []
+    for key, better in checks.items():
+        if key not in baseline:
+            continue
+        got, ref = result[key], baseline[key]
+        # у субмиллисекундных задержек шум больше любого процента, поэтому ещё и абсолютный запас
+        slack = _MS_SLACK if key.endswith("_ms") else 0.0
+        if better == "lower" and got > ref * (1 + tolerance) + slack:
+            failures.append(f"{key}: {got} > {ref} (+{tolerance:.0%})")
+        if better == "higher" and got < ref * (1 - tolerance):
+            failures.append(f"{key}: {got} < {ref} (-{tolerance:.0%})")
+    return failures
+
+def compare(result: dict, baseline: dict, tolerance: float) -> list:
+    failures = regressions(result, baseline, tolerance)
+    if result["saved"] != result["chats"]:
+        failures.append(f"saved {result['saved']} of {result['chats']} records")
+    return failures
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("--chats", type=int, default=100)
+    p.add_argument("--tg-latency", type=float, default=0.02, help="seconds per Bot API call")
+    p.add_argument("--sheets-latency", type=float, default=0.2, help="seconds per Sheets API call")
+    p.add_argument("--quota-every", type=int, default=0, help="every Nth Sheets write fails with 429")
+    # лимит на чат не включаем: чаты бенча печатают быстрее людей
+    p.add_argument("--tg-rate", type=float, default=0, help="global Bot API messages/s limit (0 = off; real: 30)")
+    p.add_argument("--sheets-quota", type=float, default=0, help="Sheets requests/min limit (0 = off; real: 60)")
+    p.add_argument("--startup", choices=("lazy", "eager"), default="lazy",
+                   help="STARTUP_MODE of the bot under test; lazy includes the warm-up in the first updates")
+    p.add_argument("--baseline", default=BASELINE)
+    p.add_argument("--tolerance", type=float, default=0.3)
+    p.add_argument("--update-baseline", action="store_true")
+    args = p.parse_args(argv)
+
+    result = asyncio.run(run(args))
+    print(json.dumps(result, indent=2))
+
+    if args.update_baseline:
+        keep = {k: result[k] for k in ("chats", "startup", *_CHECKS)}
+        with open(args.baseline, "w") as f:
+            json.dump(keep, f, indent=2)
+            f.write("\n")
+        print(f"baseline written to {args.baseline}")
+        return 0
+    if not os.path.exists(args.baseline):
+        print("no baseline; run with --update-baseline first", file=sys.stderr)
+        return 0
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    if (baseline.get("chats"), baseline.get("startup", args.startup)) != (args.chats, args.startup):
+        print(f"baseline was recorded with --chats {baseline.get('chats')} --startup {baseline.get('startup')}, "
+              "comparison skipped", file=sys.stderr)
+        return 0
+    failures = compare(result, baseline, args.tolerance)
+    for msg in failures:
+        print("REGRESSION", msg, file=sys.stderr)
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,151 @@
+"""Реплей записи вебхука (CAPTURE_DIR, см. app.capture) через POST /webhook/{secret} поверх bench.fakes.
+
+    python -m bench.replay /var/data/capture                      # в исходном темпе
+    python -m bench.replay capture-20250302-*.ndjson.gz --speed 20
+    python -m bench.replay /var/data/capture --speed 0 --out new.json --compare old.json
+
+Апдейты уходят строго в порядке записи; --speed 0 — без пауз, как можно быстрее.
+Код выхода 1 — сборка хуже --compare больше чем на --tolerance или сохранила другое число записей."""
+import os
+import sys
+import gzip
+import json
+import time
+import asyncio
+import argparse
+from collections import Counter, defaultdict
+from typing import Dict, Iterator, List
+
+from bench.harness import SECRET, boot, peak_rss_mb, percentile, time_updates
+from bench.loadtest import _CHECKS, regressions
+
+def _paths(args: List[str]) -> List[str]:
+    from app.capture import files  # после boot(): app читает окружение при импорте
+    out = []
+    for a in args:
+        out.extend(files(a) if os.path.isdir(a) else [a])
+    return out
+
+def read(paths: List[str], tenant: str | None = None) -> Iterator[dict]:
+    for path in paths:
+        with (gzip.open(path, "rt", encoding="utf-8") if path.endswith(".gz") else open(path, encoding="utf-8")) as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                try:
+                    rec = json.loads(line)
+                except ValueError:
+                    continue  # недописанная последняя строка текущего файла
+                if tenant is None or rec.get("tenant") == tenant:
+                    yield rec
+
+async def run(args) -> dict:
+    import httpx
+    # все арендаторы записи играются одним ботом; id чатов в записи уже псевдонимы и не пересекаются
+    env = {"STARTUP_MODE": "eager", "CAPTURE_DIR": "", "TG_RATE_GLOBAL": str(args.tg_rate),
+           "TG_RATE_CHAT": str(args.tg_chat_rate),
+           "SHEETS_READS_PER_MIN": str(args.sheets_quota), "SHEETS_WRITES_PER_MIN": str(args.sheets_quota)}
+    main, tg, ws = boot(args.tg_latency, args.sheets_latency, args.quota_every, env=env)
+    from app.main import _update_type
+    records = sorted(read(_paths(args.capture), args.tenant), key=lambda r: r["t"])
+    if not records:
+        raise SystemExit("capture is empty")
+
+    by_type: Dict[str, list] = defaultdict(list)
+    time_updates(main, lambda payload, s: by_type[_update_type(payload)].append(s))
+
+    latencies: list = []
+    rejected = 0
+    rows_before = len(ws.rows)
+    await main.on_startup()
+    transport = httpx.ASGITransport(app=main.app)
+    first = records[0]["t"]
+    t0 = time.perf_counter()
+    async with httpx.AsyncClient(transport=transport, base_url="http://replay") as client:
+        for rec in records:
+            if args.speed > 0:
+                delay = (rec["t"] - first) / args.speed - (time.perf_counter() - t0)
+                if delay > 0:
+                    await asyncio.sleep(delay)
+            while True:
+                t = time.perf_counter()
+                r = await client.post(f"/webhook/{SECRET}", json=rec["u"])
+                latencies.append(time.perf_counter() - t)
+                if r.status_code != 503:
+                    break
+                rejected += 1
+                await asyncio.sleep(0.05)
+        await main.on_shutdown()
+    elapsed = time.perf_counter() - t0
+
+    updates = [v for vs in by_type.values() for v in vs]
+    saved = len(ws.rows) - rows_before
+    google_calls = sum(ws.calls.values())
+    return {
+        "updates": len(records),
+        "chats": len({_chat(r["u"]) for r in records}),
+        "captured_seconds": round(records[-1]["t"] - first, 1),
+        "speed": args.speed,
+        "elapsed_seconds": round(elapsed, 1),
+        "rejected_503": rejected,
+        "saved": saved,
+        "p50_ms": round(percentile(latencies, 50) * 1000, 2),
+        "p95_ms": round(percentile(latencies, 95) * 1000, 2),
+        "p99_ms": round(percentile(latencies, 99) * 1000, 2),
+        "update_p50_ms": round(percentile(updates, 50) * 1000, 2),
+        "update_p95_ms": round(percentile(updates, 95) * 1000, 2),
+        "update_p99_ms": round(percentile(updates, 99) * 1000, 2),
+        "by_type": {k: {"n": len(v), "p50_ms": round(percentile(v, 50) * 1000, 2),
+                        "p95_ms": round(percentile(v, 95) * 1000, 2)} for k, v in sorted(by_type.items())},
+        "throughput_ups": round(len(records) / elapsed, 1),
+        "google_calls_per_record": round(google_calls / max(saved, 1), 3),
+        "google_calls": dict(ws.calls),
+        "telegram_calls": dict(tg.calls),
+        "peak_rss_mb": round(peak_rss_mb(), 1),
+    }
+
+def _chat(payload: dict) -> int:
+    from app.dispatch import chat_key
+    return chat_key(payload)
+
+def main(argv=None):
+    p = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    p.add_argument("capture", nargs="+", help="capture files or CAPTURE_DIR directories")
+    p.add_argument("--tenant", help="replay only this tenant's updates")
+    p.add_argument("--speed", type=float, default=1.0, help="time scale: 1 = as captured, 10 = ten times faster, 0 = no pauses")
+    p.add_argument("--tg-latency", type=float, default=0.02, help="seconds per Bot API call")
+    p.add_argument("--sheets-latency", type=float, default=0.2, help="seconds per Sheets API call")
+    p.add_argument("--quota-every", type=int, default=0, help="every Nth Sheets write fails with 429")
+    p.add_argument("--tg-rate", type=float, default=0, help="global Bot API messages/s limit (0 = off; real: 30)")
+    p.add_argument("--tg-chat-rate", type=float, default=0, help="Bot API messages/s per chat (0 = off; real: 1)")
+    p.add_argument("--sheets-quota", type=float, default=0, help="Sheets requests/min limit (0 = off; real: 60)")
+    p.add_argument("--out", help="write the result JSON here (a --compare reference for the next build)")
+    p.add_argument("--compare", help="result JSON of a previous replay of the same capture")
+    p.add_argument("--tolerance", type=float, default=0.3)
+    args = p.parse_args(argv)
+
+    result = asyncio.run(run(args))
+    print(json.dumps(result, indent=2))
+    if args.out:
+        with open(args.out, "w") as f:
+            json.dump(result, f, indent=2)
+            f.write("\n")
+    if not args.compare:
+        return 0
+    with open(args.compare) as f:
+        ref = json.load(f)
+    if (ref.get("updates"), ref.get("speed")) != (result["updates"], result["speed"]):
+        print("reference is from another capture or --speed, comparison skipped", file=sys.stderr)
+        return 0
+    failures = regressions(result, ref, args.tolerance)
+    if result["saved"] != ref.get("saved"):
+        failures.append(f"saved {result['saved']} records, reference saved {ref.get('saved')}")
+    counts = Counter(result["telegram_calls"]) - Counter(ref.get("telegram_calls", {}))
+    if counts:
+        failures.append(f"more Bot API calls than the reference: {dict(counts)}")
+    for msg in failures:
+        print("REGRESSION", msg, file=sys.stderr)
+    return 1 if failures else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,11 @@
+import os
+import atexit
+import shutil
+import tempfile
+
+# модули app читают окружение при импорте: задаём его до первого импорта, как bench.harness.boot
+os.environ.setdefault("TELEGRAM_BOT_TOKEN", "123456:TEST")
+os.environ.setdefault("WEBHOOK_SECRET_TOKEN", "test-secret")
+if "DATA_DIR" not in os.environ:
+    os.environ["DATA_DIR"] = tempfile.mkdtemp(prefix="tests-")
+    atexit.register(shutil.rmtree, os.environ["DATA_DIR"], ignore_errors=True)
@@ -0,0 +1,51 @@
+import asyncio
+
+import pytest
+
+from app import dedupe
+from app.dedupe import SaveIndex, fingerprint
+from app.journal import Journal
+
+@pytest.fixture
+def journal(tmp_path):
+    return Journal(str(tmp_path / "journal.sqlite3"))
+
+def test_pending_then_saved(journal):
+    idx = SaveIndex(journal)
+    idx.reserve(["k1"])
+    assert idx.lookup("k1") == (True, None)
+    idx.remember(["k1"], 7)
+    assert asyncio.run(idx.find(["k0", "k1"])) == (True, 7)
+    idx.release(["k1"])
+    assert idx.lookup("k1") == (False, None)
+
+def test_memory_is_capped_and_falls_back_to_journal(journal, monkeypatch):
+    monkeypatch.setattr(dedupe, "DEDUPE_MEM_KEYS", 3)
+    idx = SaveIndex(journal)
+    for i in range(5):
+        keys = [f"k{i}"]
+        rec_id = journal.append(f"k{i}", [], keys)
+        idx.remember(keys, rec_id)
+    assert list(idx._mem) == ["k2", "k3", "k4"]
+    assert idx.lookup("k0") == (True, 1)
+    assert asyncio.run(idx.find(["k1"])) == (True, 2)
+    assert asyncio.run(idx.find(["nope"])) == (False, None)
+
+def test_old_entries_leave_memory(journal, monkeypatch):
+    idx = SaveIndex(journal)
+    now = [1000.0]
+    monkeypatch.setattr(dedupe.time, "time", lambda: now[0])
+    fp = fingerprint(1, {"Repair": "brakes"})
+    idx.remember([fp, "k1"], 1)
+    now[0] += dedupe.FINGERPRINT_WINDOW + 1
+    idx.remember(["k2"], 2)
+    assert list(idx._mem) == ["k2"]
+    assert idx.lookup(fp) == (False, None)
+
+def test_fingerprint_expires_but_msg_key_does_not(journal, monkeypatch):
+    idx = SaveIndex(journal)
+    fp = fingerprint(1, {"Repair": "brakes"})
+    journal.append("k1", [], ["k1", fp])
+    monkeypatch.setattr(dedupe, "FINGERPRINT_WINDOW", -1)
+    assert idx.lookup(fp) == (False, None)
+    assert idx.lookup("k1") == (True, 1)
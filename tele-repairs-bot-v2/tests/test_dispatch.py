@@ -0,0 +1,42 @@
+import asyncio
+
+from app.dispatch import UpdateDispatcher, chat_key
+
+def _msg(chat: int) -> dict:
+    return {"update_id": chat, "message": {"chat": {"id": chat}, "from": {"id": chat}}}
+
+def test_chat_key():
+    assert chat_key(_msg(-100)) == -100
+    assert chat_key({"callback_query": {"from": {"id": 5}}}) == 5
+    assert chat_key(["not", "a", "dict"]) == 0
+
+def test_accepted_updates_drain_and_late_ones_are_rejected():
+    done = []
+
+    async def process(payload, tenant):
+        await asyncio.sleep(0)
+        done.append(payload["update_id"])
+
+    async def run():
+        d = UpdateDispatcher(process, workers=2, maxsize=2)
+        assert not d.submit(_msg(1))  # ещё не запущен
+        d.start()
+        assert all(d.submit(_msg(i)) for i in (1, 2, 3))
+        stopping = asyncio.create_task(d.stop(timeout=1.0))
+        await asyncio.sleep(0)
+        assert not d.submit(_msg(4))  # остановка началась: 503, Telegram повторит
+        await stopping
+        assert not d.submit(_msg(5))
+
+    asyncio.run(run())
+    assert sorted(done) == [1, 2, 3]
+
+def test_full_shard_is_rejected():
+    async def run():
+        d = UpdateDispatcher(lambda p, t: asyncio.sleep(0), workers=1, maxsize=1)
+        d.start()
+        assert d.submit(_msg(1))
+        assert not d.submit(_msg(2))
+        await d.stop(timeout=1.0)
+
+    asyncio.run(run())
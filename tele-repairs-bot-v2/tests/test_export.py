@@ -0,0 +1,103 @@
+import csv
+import io
+import json
+
+import pytest
+
+from app.export import ExportQuery, http_date, not_modified, stream_csv, stream_ndjson
+from app.mirror import Mirror
+
+RECS = [
+    {"Date": "2025-01-05", "Unit": "TRK 2621", "Total": "100", "MsgKey": "a"},
+    {"Date": "2025-02-10", "Unit": "TRL 88", "Total": "$1,250.5", "MsgKey": "b"},
+    {"Date": "2025-02-11", "Unit": "trk2621", "Total": "", "MsgKey": "c"},
+    {"Date": "2025-03-31", "Unit": "TRK 77", "Total": "40", "MsgKey": "d"},
+    {"Date": "sometime in May", "Unit": "TRK 2621", "Total": "5", "MsgKey": "e"},
+]
+
+@pytest.fixture
+def m(tmp_path):
+    m = Mirror(str(tmp_path / "mirror.sqlite3"))
+    m.replace_all((i + 2, rec) for i, rec in enumerate(RECS))
+    return m
+
+def _keys(q: ExportQuery, m: Mirror, page: int = 1000) -> list:
+    return [r[-2] for rows in q.pages(m, page) for r in rows]
+
+@pytest.mark.parametrize("args, keys", [
+    ((), ["a", "b", "c", "d", "e"]),  # без границ — и строка с нестандартной датой
+    (("2025-02-10",), ["b", "c", "d"]),
+    ((None, "2025-02-10"), ["a", "b"]),
+    (("2025-02-10", "2025-02-11"), ["b", "c"]),
+    (("2/10/2025", "3/31/2025"), ["b", "c", "d"]),
+    ((None, None, "TRK 2621"), ["a", "c", "e"]),
+    ((None, None, "88"), ["b"]),  # номер без TRK/TRL — оба вида
+    (("2025-01-01", "2025-12-31", "trk 2621"), ["a", "c"]),
+])
+def test_filters(m, args, keys):
+    assert _keys(ExportQuery(*args), m) == keys
+
+def test_pages_cover_everything_once(m):
+    assert _keys(ExportQuery(), m, page=2) == ["a", "b", "c", "d", "e"]
+
+@pytest.mark.parametrize("args", [("2025-13-01",), ("2025-03-01", "2025-02-01")])
+def test_bad_dates(args):
+    with pytest.raises(ValueError):
+        ExportQuery(*args)
+
+@pytest.mark.parametrize("args, name", [
+    ((), "repairs.csv"),
+    (("2025-01-01",), "repairs-from-2025-01-01.csv"),
+    ((None, "2025-03-31"), "repairs-to-2025-03-31.csv"),
+    (("2025-01-01", "2025-03-31"), "repairs-2025-01-01-2025-03-31.csv"),
+])
+def test_filename(args, name):
+    assert ExportQuery(*args).filename("csv") == name
+
+def test_streams(m):
+    rows = list(csv.DictReader(io.StringIO("".join(stream_csv(ExportQuery("2025-02-01", "2025-02-28"), m)))))
+    assert [(r["MsgKey"], r["Total"]) for r in rows] == [("b", "1250.50"), ("c", "")]
+    lines = "".join(stream_ndjson(ExportQuery(unit="TRK 77"), m)).splitlines()
+    assert [json.loads(l)["Total"] for l in lines] == [40.0]
+
+def test_tag_changes_with_content_and_query(m):
+    q = ExportQuery("2025-01-01")
+    tag = q.tag(m, "csv")
+    assert tag == q.tag(m, "csv") and tag.startswith('"')
+    assert tag != q.tag(m, "ndjson") and tag != ExportQuery().tag(m, "csv")
+    m.replace_all((i + 2, rec) for i, rec in enumerate(RECS[:2]))
+    assert q.tag(m, "csv") != tag
+
+def test_not_modified(m):
+    changed = m.changed_at()
+    tag = ExportQuery().tag(m, "csv")
+    assert not_modified(changed, tag, tag, None)
+    assert not_modified(changed, tag, f'"other", W/{tag}', None)
+    assert not_modified(changed, tag, "*", None)
+    assert not not_modified(changed, tag, '"other"', None)
+    # If-None-Match важнее If-Modified-Since
+    assert not not_modified(changed, tag, '"other"', http_date(changed + 60))
+    assert not_modified(changed, tag, None, http_date(changed))
+    assert not not_modified(changed, tag, None, http_date(changed - 60))
+    assert not not_modified(changed, tag, None, "not a date")
+    assert not not_modified(changed, tag, None, None)
+
+def test_export_route_304(m, monkeypatch):
+    from fastapi.testclient import TestClient
+    from app import main, mirror
+    m._set_meta("bootstrapped", "1")
+    monkeypatch.setattr(mirror, "get_mirror", lambda: m)
+    c = TestClient(main.app)
+    url = "/export/test-secret"
+    r = c.get(url, params={"date_from": "2025-02-01"})
+    assert r.status_code == 200
+    assert r.headers["content-disposition"] == 'attachment; filename="repairs-from-2025-02-01.csv"'
+    assert r.text.count("\n") == 4  # шапка и три строки
+    etag, since = r.headers["etag"], r.headers["last-modified"]
+    assert c.get(url, params={"date_from": "2025-02-01"}, headers={"If-None-Match": etag}).status_code == 304
+    assert c.get(url, params={"date_from": "2025-02-01"}, headers={"If-Modified-Since": since}).status_code == 304
+    assert c.get(url, params={"format": "ndjson", "date_from": "2025-02-01"},
+                 headers={"If-None-Match": etag}).status_code == 200
+    m.on_edited({"b": {"Status": "Closed"}})
+    assert c.get(url, params={"date_from": "2025-02-01"}, headers={"If-None-Match": etag}).status_code == 200
+    assert c.get(url, params={"date_to": "2025-01-01", "date_from": "2025-02-01"}).status_code == 400
@@ -0,0 +1,146 @@
+import asyncio
+
+import pytest
+
+from app import journal as jmod
+from app.journal import CLAIM_LEASE, Flusher, Journal
+from app.sheets import KNOWN_FIELDS
+
+def _row(key: str, **fields) -> list:
+    rec = {"Date": "2025-03-02", "Unit": "TRK 2621", "Repair": "brakes", "Total": "100", "Status": "Open",
+           "MsgKey": key, **fields}
+    return [rec.get(f, "") for f in KNOWN_FIELDS]
+
+class FakeSheets:
+    """AsyncSheets.run поверх списка строк; fail — исключение для следующей дозаписи."""
+
+    def __init__(self):
+        self.rows: list = []
+        self.updates: list = []
+        self.fail: BaseException | None = None
+
+    async def run(self, fn, *args, **kw):
+        name = fn.__name__
+        if name == "append_repair_rows":
+            self.rows.extend(args[0])
+            if self.fail is not None:
+                e, self.fail = self.fail, None
+                raise e  # запрос дошёл до листа, а ответ — нет
+            return list(range(len(self.rows) - len(args[0]) + 2, len(self.rows) + 2))
+        if name == "find_keys":
+            want = set(args[0])
+            return {r[jmod._KEY]: i + 2 for i, r in enumerate(self.rows) if r[jmod._KEY] in want}
+        if name == "update_records":
+            self.updates.append(args[0])
+            return [key for key, _ in args[0].values()]
+        raise AssertionError(name)
+
+class Locator:
+    def __init__(self, sheets: FakeSheets):
+        self.sheets = sheets
+
+    def locate(self, keys):
+        return {r[jmod._KEY]: i + 2 for i, r in enumerate(self.sheets.rows) if r[jmod._KEY] in keys}
+
+    def on_edited(self, done):
+        pass
+
+@pytest.fixture
+def journal(tmp_path):
+    return Journal(str(tmp_path / "journal.sqlite3"))
+
+@pytest.fixture
+def sheets(monkeypatch):
+    fake = FakeSheets()
+    monkeypatch.setattr(jmod, "get_async_sheets", lambda: fake)
+    return fake
+
+def _expire(journal: Journal, rec_id: int):
+    journal._db.execute("UPDATE journal SET claimed_at=claimed_at-? WHERE id=?", (CLAIM_LEASE + 1, rec_id))
+
+def test_edit_before_claim_rewrites_row(journal):
+    rec_id = journal.append("k1", _row("k1"), chat_id=5)
+    where, old = journal.edit(rec_id, {"Status": "Closed"}, owner=5)
+    assert (where, old["Status"]) == ("journal", "Open")
+    assert journal.current(rec_id)["Status"] == "Closed"
+    assert journal.pending_edits() == {}
+
+def test_edit_checks_owner(journal):
+    rec_id = journal.append("k1", _row("k1"), chat_id=5)
+    assert journal.edit(rec_id, {"Status": "Closed"}, owner=6) == (None, {})
+    assert journal.edit(rec_id + 1, {"Status": "Closed"}) == (None, {})
+    assert journal.current(rec_id)["Status"] == "Open"
+
+def test_edit_while_claimed_is_queued(journal):
+    rec_id = journal.append("k1", _row("k1"))
+    journal.claim(10)
+    assert journal.edit(rec_id, {"Paid?": "Yes"})[0] == "queued"
+    assert journal.pending_edits() == {"k1": {"Paid?": "Yes"}}
+    assert journal.current(rec_id)["Paid?"] == "Yes"
+
+def test_edit_after_lapsed_lease_is_queued(journal):
+    rec_id = journal.append("k1", _row("k1"))
+    journal.claim(10)
+    _expire(journal, rec_id)
+    assert journal.edit(rec_id, {"Status": "Closed"})[0] == "queued"
+    journal.release([rec_id])
+    assert journal.edit(rec_id, {"Paid?": "Yes"})[0] == "queued"
+
+def test_claim_lease(journal):
+    rec_id = journal.append("k1", _row("k1"))
+    assert [(i, retry) for i, _, retry in journal.claim(10)] == [(rec_id, False)]
+    assert journal.claim(10) == []
+    _expire(journal, rec_id)
+    assert [(i, retry) for i, _, retry in journal.claim(10)] == [(rec_id, True)]
+
+def test_flush_marks_rows_and_notifies(journal, sheets):
+    journal.append("k1", _row("k1"))
+    journal.append("k2", _row("k2"))
+    flusher = Flusher(journal)
+    seen = []
+    flusher.listeners.append(lambda rows, sheet_rows: seen.append(sheet_rows))
+    assert asyncio.run(flusher.flush_once()) == 2
+    assert seen == [[2, 3]]
+    assert journal.pending_count() == 0
+
+def test_failed_flush_releases_rows(journal, sheets):
+    journal.append("k1", _row("k1"))
+    sheets.fail = RuntimeError("quota")
+    with pytest.raises(RuntimeError):
+        asyncio.run(Flusher(journal).flush_once())
+    sheets.rows.clear()  # ошибка до записи
+    assert [retry for _, _, retry in journal.claim(10)] == [True]
+
+def test_edit_after_timed_out_flush_reaches_sheet(journal, sheets):
+    """Таймаут: строки держат аренду, пачка всё же дописана. Правка после истечения аренды не теряется,
+    а повтор не дописывает строку второй раз."""
+    rec_id = journal.append("k1", _row("k1"))
+    flusher = Flusher(journal)
+    flusher.locator = Locator(sheets)
+    sheets.fail = asyncio.TimeoutError()
+    with pytest.raises(asyncio.TimeoutError):
+        asyncio.run(flusher.flush_once())
+    _expire(journal, rec_id)
+    assert journal.edit(rec_id, {"Status": "Closed"})[0] == "queued"
+
+    assert asyncio.run(flusher.flush_once()) == 1
+    assert len(sheets.rows) == 1
+    assert journal.pending_count() == 0
+    assert asyncio.run(flusher.flush_edits()) == 1
+    assert sheets.updates == [{2: ("k1", {"Status": "Closed"})}]
+    assert journal.pending_edits() == {}
+
+def test_edit_listeners_get_changed_fields(journal):
+    rec_id = journal.append("k1", _row("k1"))
+    seen = []
+    journal.listeners.append(lambda old, changed: seen.append((old["Status"], changed)))
+    journal.edit(rec_id, {"Status": "Closed", "Repair": "brakes"})
+    journal.edit(rec_id, {"Status": "Closed"})
+    assert seen == [("Open", {"Status": "Closed"})]
+
+def test_pending_runs_hook_under_lock(journal):
+    journal.append("k1", _row("k1"))
+    calls = []
+    rows, edits = journal.pending(lambda: calls.append(journal._lock.locked()))
+    assert calls == [True]
+    assert [r["MsgKey"] for r in rows] == ["k1"] and edits == {}
@@ -0,0 +1,96 @@
+import pytest
+
+from app import mirror as mmod
+from app.mirror import Mirror
+from app.sheets import KNOWN_FIELDS
+
+def _rec(key: str = "", **fields) -> dict:
+    return {"Date": "2025-03-02", "Unit": "TRK 2621", "Vendor": "Pilot", "Total": "100", "Status": "Open",
+            "MsgKey": key, **fields}
+
+class FakeSheet:
+    """SheetsClient поверх списка записей; on_read — вызывается сразу после чтения (гонка с Flusher'ом)."""
+
+    def __init__(self, recs):
+        self.recs = list(recs)
+        self.on_read = None
+        self.write_mode = "insert"
+
+    def _after(self):
+        if self.on_read:
+            fn, self.on_read = self.on_read, None
+            fn()
+
+    def read_all(self):
+        out = [dict(r) for r in self.recs]
+        self._after()
+        return out
+
+    def read_columns(self, names):
+        out = {n: [r.get(n, "") for r in self.recs] for n in names}
+        self._after()
+        return out
+
+    def read_rows(self, numbers):
+        return {n: dict(self.recs[n - 2]) for n in numbers if 0 <= n - 2 < len(self.recs)}
+
+    def insert(self, m: Mirror, recs):
+        """Как Flusher в режиме insert: строки под шапку, затем хук зеркала."""
+        self.recs[0:0] = recs
+        m.on_flushed([[r.get(f, "") for f in KNOWN_FIELDS] for r in recs], list(range(2, len(recs) + 2)))
+
+@pytest.fixture
+def sheet(monkeypatch):
+    sc = FakeSheet([_rec("a"), _rec(Vendor="Loves"), _rec("b")])
+    monkeypatch.setattr(mmod, "get_sheets", lambda: sc)
+    return sc
+
+@pytest.fixture
+def m(tmp_path):
+    return Mirror(str(tmp_path / "mirror.sqlite3"))
+
+def _rows(m: Mirror) -> dict:
+    return dict(m.query("SELECT key, sheet_row FROM repairs"))
+
+def _synced(m: Mirror, sc: FakeSheet) -> dict:
+    """Что зеркало должно знать о листе: ключ → номер строки."""
+    keys = mmod._keys(sc.recs)
+    return {k: i + 2 for i, k in enumerate(keys)}
+
+def test_flush_shifts_rows_in_one_write(m, sheet):
+    m.sync(sheet)
+    gen, changed = m.generation, m.changed_at()
+    sheet.insert(m, [_rec("c")])
+    assert _rows(m) == _synced(m, sheet)
+    assert m.generation == gen + 1 and m.changed_at() >= changed
+
+def test_manual_rows_keep_keys_across_inserts(m, sheet, monkeypatch):
+    m.sync(sheet)
+    sheet.insert(m, [_rec("c"), _rec("d")])
+    monkeypatch.setattr(sheet, "read_rows", lambda numbers: pytest.fail(f"re-read {numbers}"))
+    assert m.sync(sheet) == 0  # ручная строка уехала вниз, но осталась той же: перечитывать нечего
+
+def test_manual_row_edit_is_reread(m, sheet):
+    m.sync(sheet)
+    sheet.recs[1]["Total"] = "250"
+    assert m.sync(sheet) == 2  # старый ключ ушёл, новый дочитан
+    assert m.query("SELECT total FROM repairs WHERE key LIKE 'row:%'") == [(250.0,)]
+
+def test_full_sync_replays_flush_after_read(m, sheet):
+    sheet.on_read = lambda: sheet.insert(m, [_rec("c")])
+    m.sync(sheet)
+    assert _rows(m) == _synced(m, sheet)
+
+def test_incremental_sync_with_flush_after_read(m, sheet):
+    m.sync(sheet)
+    sheet.recs.append(_rec("n"))
+    sheet.on_read = lambda: sheet.insert(m, [_rec("c")])
+    m.sync(sheet)
+    assert _rows(m) == _synced(m, sheet)
+
+def test_flush_already_read_by_sync_is_not_shifted_twice(m, sheet):
+    m.sync(sheet)
+    sheet.recs[0:0] = [_rec("c")]  # запись дошла до листа, хук ещё не отработал
+    sheet.on_read = lambda: m.on_flushed([[_rec("c").get(f, "") for f in KNOWN_FIELDS]], [2])
+    m.sync(sheet)
+    assert _rows(m) == _synced(m, sheet)
@@ -0,0 +1,66 @@
+from datetime import date, datetime, timedelta
+
+import pytest
+
+from app.bot_flow import QUICK_CHOICES
+from app.quick import parse
+from app.validators import normalize_date
+
+YEAR = datetime.utcnow().year
+
+CASES = [
+    ('2025-03-02 TRK 2621 Tires "replace steer" Loves 412.50 Company No Open',
+     {"Date": "2025-03-02", "UnitType": "TRK", "Unit": "TRK 2621", "Category": "Tires", "Repair": "replace steer",
+      "Vendor": "Loves", "Total": "412.50", "Paid By": "Company", "Paid?": "No", "Status": "Open"}),
+    ('03/02/2025 TRK 2621 Engine "oil leak" TA Petro 1,200',
+     {"Date": "2025-03-02", "UnitType": "TRK", "Unit": "TRK 2621", "Category": "Engine", "Repair": "oil leak",
+      "Vendor": "TA Petro", "Total": "1200"}),
+    ("3/2/25 TRK 2621 Tires Loves 412.50",
+     {"Date": "2025-03-02", "UnitType": "TRK", "Unit": "TRK 2621", "Category": "Tires", "Vendor": "Loves",
+      "Total": "412.50"}),
+    ("TRK 2621 Tires Loves 412.50 Company",
+     {"UnitType": "TRK", "Unit": "TRK 2621", "Category": "Tires", "Vendor": "Loves", "Total": "412.50",
+      "Paid By": "Company"}),
+    ("2025-03-02 TRK 2621 Tires replace steer tires Loves 412.50",
+     {"Date": "2025-03-02", "UnitType": "TRK", "Unit": "TRK 2621", "Category": "Tires",
+      "Repair": "replace steer tires", "Vendor": "Loves", "Total": "412.50"}),
+    ('TRK 2621 Engine "oil leak" "TA Petro" 1200',
+     {"UnitType": "TRK", "Unit": "TRK 2621", "Category": "Engine", "Repair": "oil leak", "Vendor": "TA Petro",
+      "Total": "1200"}),
+    ('TRK2621 "replace steer" 412.50',
+     {"UnitType": "TRK", "Unit": "TRK 2621", "Repair": "replace steer", "Total": "412.50"}),
+    ('TRL 55 (TRK 2621) Tires "flat" "both axles" Loves $90 Company Yes Closed',
+     {"UnitType": "TRL", "TrailerNum": "55", "Unit": "TRL 55 ( TRK 2621 )", "Category": "Tires", "Repair": "flat",
+      "Details": "both axles", "Vendor": "Loves", "Total": "90", "Paid By": "Company", "Paid?": "Yes",
+      "Status": "Closed"}),
+    ("Date: 2025-03-02\nUnit: TRL 55 (TRK 2621)\nRepair: replace steer\nTotal: 412.50\nNotes: first line\nsecond line",
+     {"Date": "2025-03-02", "UnitType": "TRL", "TrailerNum": "55", "Unit": "TRL 55 ( TRK 2621 )",
+      "Repair": "replace steer", "Total": "412.50", "Notes": "first line\nsecond line"}),
+]
+
+@pytest.mark.parametrize("text,expected", CASES)
+def test_parse(text, expected):
+    form, errors = parse(text, QUICK_CHOICES)
+    assert errors == []
+    assert form == expected
+
+def test_month_day_without_year():
+    form, _ = parse('1/1 TRK 2621 "oil leak" 100', QUICK_CHOICES)
+    assert form["Date"] == f"{YEAR}-01-01"
+    assert form["Repair"] == "oil leak"
+
+def test_block_reports_bad_values():
+    form, errors = parse("Date: 13/45\nTotal: lots", QUICK_CHOICES)
+    assert form == {}
+    assert len(errors) == 2
+
+def test_month_day_leap_day_without_year():
+    today = datetime.utcnow().date()
+    d = date.fromisoformat(normalize_date("2/29"))
+    assert (d.month, d.day) == (2, 29)
+    assert today - d < timedelta(days=4 * 366)
+    assert d <= today
+
+@pytest.mark.parametrize("text", ["2/30", "13/1", "2/29/2025", "0/5"])
+def test_month_day_rejects_impossible_dates(text):
+    assert normalize_date(text) is None
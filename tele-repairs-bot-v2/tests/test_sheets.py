@@ -0,0 +1,22 @@
+import asyncio
+import threading
+
+from app.ratelimit import BACKGROUND
+from app.sheets import AsyncSheets
+
+def test_background_calls_do_not_take_user_slots():
+    gate = threading.Event()
+
+    async def run():
+        s = AsyncSheets(workers=1, timeout=5, background=1)
+        stuck = asyncio.create_task(s.run(lambda sc: gate.wait(5), priority=BACKGROUND))
+        await asyncio.sleep(0.05)
+        try:
+            # фоновый вызов занял свой слот (как при ожидании квоты), пользовательский проходит сразу
+            assert await asyncio.wait_for(s.run(lambda sc: "saved"), 1) == "saved"
+        finally:
+            gate.set()
+            await stuck
+            s.shutdown()
+
+    asyncio.run(run())